@@ -0,0 +1,4 @@
+"""
+Benchmarks of the bot's commands and buttons against in-process stand-ins
+for LNbits and discord, see ``python -m bench --help``.
+"""
@@ -0,0 +1,190 @@
+"""
+Runs the benchmarks and stores the results as JSON, optionally comparing them
+with an earlier run:
+
+    python -m bench --latency 0.02 --concurrency 20
+    python -m bench --compare bench/results/<earlier run>.json
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+from .fake_lnbits import FakeLnbits
+from .report import git_revision, latency_stats, write_results
+from .scenarios import SCENARIOS, Bench
+
+
+async def run_scenario(name: str, size: int, args: argparse.Namespace) -> dict:
+    lnbits = FakeLnbits(
+        latency=args.latency,
+        payment_latency=args.payment_latency,
+        jitter=args.jitter,
+    )
+    bench = Bench(
+        lnbits,
+        members=max(args.members, size + 1),
+        discord_latency=args.discord_latency,
+    )
+    scenario = SCENARIOS[name]
+    semaphore = asyncio.Semaphore(args.concurrency)
+    durations: List[float] = []
+    errors: List[str] = []
+
+    async def operation(record: bool):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await scenario(bench, size)
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+                return
+            if record:
+                durations.append(time.perf_counter() - start)
+
+    try:
+        await asyncio.gather(*(operation(False) for _ in range(args.warmup)))
+        requests_before = lnbits.requests
+        start = time.perf_counter()
+        await asyncio.gather(*(operation(True) for _ in range(args.operations)))
+        elapsed = time.perf_counter() - start
+    finally:
+        await bench.close()
+
+    return {
+        "size": size,
+        "operations": args.operations,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "throughput": round(len(durations) / elapsed, 2),
+        **latency_stats(durations),
+        "lnbits_requests": round(
+            (lnbits.requests - requests_before) / args.operations, 2
+        ),
+    }
+
+
+def print_results(results: dict, baseline: dict = None, threshold: float = 10):
+    """Prints the results, returns whether anything regressed beyond threshold %"""
+    regressed = False
+    if baseline and baseline.get("config") != results["config"]:
+        print("Warning: the baseline was run with a different configuration\n")
+    header = f"{'scenario':<16}{'ops/s':>10}{'p50':>10}{'p95':>10}{'p99':>10}"
+    print(header + f"{'errors':>8}{'req/op':>8}")
+    for name, result in results["scenarios"].items():
+        print(
+            f"{name:<16}{result['throughput']:>10}"
+            + "".join(f"{result[key] * 1000:>8.1f}ms" for key in ("p50", "p95", "p99"))
+            + f"{result['errors']:>8}{result['lnbits_requests']:>8}"
+        )
+        previous = (baseline or {}).get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        changes = []
+        for key in ("throughput", "p50", "p95", "p99"):
+            if not previous[key]:
+                continue
+            change = (result[key] - previous[key]) / previous[key] * 100
+            # Less throughput or more latency is worse
+            worse = -change if key == "throughput" else change
+            marker = " !" if worse > threshold else ""
+            regressed = regressed or worse > threshold
+            changes.append(f"{key} {change:+.1f}%{marker}")
+        print(f"{'':<16}vs {baseline.get('revision')}: " + ", ".join(changes))
+    return regressed
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m bench",
+        description="Benchmarks commands and buttons against a fake LNbits",
+    )
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        default=list(SCENARIOS),
+        help=f"Scenarios to run, one of {', '.join(SCENARIOS)} (default: all)",
+    )
+    parser.add_argument("--operations", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument(
+        "--recipients", type=int, default=10, help="Users per rain / multitip"
+    )
+    parser.add_argument("--entries", type=int, default=10, help="Coinflip players")
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="LNbits latency in seconds"
+    )
+    parser.add_argument(
+        "--payment-latency",
+        type=float,
+        default=None,
+        help="Latency of paying an invoice (default: --latency)",
+    )
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument(
+        "--discord-latency",
+        type=float,
+        default=0.0,
+        help="Latency of responses, followups and DMs",
+    )
+    parser.add_argument("--output", type=Path, default=None)
+    parser.add_argument("--compare", type=Path, default=None)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10,
+        help="Regression in percent which makes --compare fail",
+    )
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+    return args
+
+
+async def run(args: argparse.Namespace) -> dict:
+    sizes = {
+        "rain": args.recipients,
+        "multitip": args.recipients,
+        "coinflip": args.entries,
+    }
+    results = {
+        "revision": git_revision(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "compare", "threshold")
+        },
+        "scenarios": {},
+    }
+    for name in args.scenarios:
+        results["scenarios"][name] = await run_scenario(name, sizes.get(name, 1), args)
+    return results
+
+
+def main(argv: List[str] = None) -> int:
+    args = parse_args(argv)
+    # The bot logs every handled error, which drowns out the results
+    logging.getLogger("discord").setLevel(logging.CRITICAL)
+
+    results = asyncio.run(run(args))
+
+    output = write_results(results, args.output)
+
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    regressed = print_results(results, baseline, args.threshold)
+    print(f"\nResults written to {output}")
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
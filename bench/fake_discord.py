@@ -0,0 +1,143 @@
+"""
+Synthetic members, channels and interactions, just enough of discord.py's
+interface for the commands and buttons of the bot.
+
+Responses, followups and DMs wait for an injected latency like the discord
+REST calls they replace.
+"""
+from __future__ import annotations
+
+import asyncio
+import itertools
+from types import SimpleNamespace
+from typing import List, Optional
+
+_ids = itertools.count(10**17)
+
+
+class FakeMember:
+    def __init__(self, latency: float = 0.0):
+        self.id = next(_ids)
+        self.name = f"member{self.id}"
+        self.display_name = self.name
+        self.mention = f"<@{self.id}>"
+        self.display_avatar = SimpleNamespace(url=f"https://cdn.bench/{self.id}.png")
+        self.bot = False
+        self.roles: list = []
+        self.latency = latency
+        self.dms = 0
+
+    def __eq__(self, other):
+        return isinstance(other, FakeMember) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    async def send(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.dms += 1
+
+
+class FakeMessage:
+    def __init__(self, channel: FakeChannel, **kwargs):
+        self.id = next(_ids)
+        self.channel = channel
+        self.jump_url = f"https://discord.bench/channels/{channel.id}/{self.id}"
+        self.view = None
+        self.update(**kwargs)
+
+    def update(self, **kwargs):
+        for key in ("content", "embed", "view"):
+            if key in kwargs:
+                setattr(self, key, kwargs[key])
+
+    async def edit(self, **kwargs):
+        await asyncio.sleep(self.channel.latency)
+        self.update(**kwargs)
+
+
+class FakeChannel:
+    def __init__(self, members: List[FakeMember], latency: float = 0.0):
+        self.id = next(_ids)
+        self.members = members
+        self.guild = SimpleNamespace(
+            id=next(_ids), get_role=lambda id: None, get_member=self.get_member
+        )
+        self.latency = latency
+
+    def get_member(self, member_id: int) -> Optional[FakeMember]:
+        for member in self.members:
+            if member.id == member_id:
+                return member
+
+    def get_partial_message(self, message_id: int) -> FakeMessage:
+        message = FakeMessage(self)
+        message.id = message_id
+        return message
+
+    async def send(self, **kwargs) -> FakeMessage:
+        await asyncio.sleep(self.latency)
+        return FakeMessage(self, **kwargs)
+
+
+class FakeResponse:
+    def __init__(self, interaction: FakeInteraction):
+        self.interaction = interaction
+        self.done = False
+
+    def is_done(self) -> bool:
+        return self.done
+
+    async def _respond(self):
+        if self.done:
+            raise RuntimeError("This interaction has already been responded to")
+        self.done = True
+        await asyncio.sleep(self.interaction.channel.latency)
+
+    async def send_message(self, content: str = None, **kwargs):
+        await self._respond()
+        self.interaction.original = FakeMessage(
+            self.interaction.channel, content=content, **kwargs
+        )
+
+    async def edit_message(self, **kwargs):
+        await self._respond()
+        self.interaction.message.update(**kwargs)
+
+    async def defer(self, **kwargs):
+        await self._respond()
+        self.interaction.original = FakeMessage(self.interaction.channel)
+
+
+class FakeFollowup:
+    def __init__(self, interaction: FakeInteraction):
+        self.interaction = interaction
+
+    async def send(self, content: str = None, **kwargs):
+        await asyncio.sleep(self.interaction.channel.latency)
+        return FakeMessage(self.interaction.channel, content=content, **kwargs)
+
+
+class FakeInteraction:
+    def __init__(
+        self,
+        client,
+        user: FakeMember,
+        channel: FakeChannel,
+        message: Optional[FakeMessage] = None,
+    ):
+        self.client = client
+        self.user = user
+        self.channel = channel
+        self.guild = channel.guild
+        self.guild_id = channel.guild.id
+        # The message a component interaction was triggered on
+        self.message = message
+        self.original: Optional[FakeMessage] = message
+        self.data: dict = {}
+        self.extras: dict = {}
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+    async def original_response(self) -> FakeMessage:
+        return self.original
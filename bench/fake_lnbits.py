@@ -0,0 +1,283 @@
+"""
+In-process stand-in for the parts of LNbits the bot talks to: the core wallet
+and payment endpoints, usermanager, withdraw and the discordbot mappings,
+statistics and netting journal.
+
+Every request waits for an injected latency before it is answered, which is
+what makes the bot's concurrency visible in the benchmarks.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import httpx
+
+LNBITS_URL = "http://lnbits.bench/"
+
+
+class FakeLnbits:
+    def __init__(
+        self,
+        latency: float = 0.02,
+        payment_latency: float = None,
+        jitter: float = 0.0,
+    ):
+        self.latency = latency
+        # Paying an invoice goes through the funding source and is the slowest call
+        self.payment_latency = latency if payment_latency is None else payment_latency
+        self.jitter = jitter
+        self.admin_key = "bench-admin-key"
+        self.users: Dict[str, dict] = {}
+        self.users_by_discord_id: Dict[str, dict] = {}
+        self.wallets_by_key: Dict[str, dict] = {}
+        # wallet id -> balance in msat
+        self.balances: Dict[str, int] = {}
+        # payment request -> (wallet id, amount in msat)
+        self.invoices: Dict[str, Tuple[str, int]] = {}
+        self.withdraw_links: Dict[str, int] = {}
+        # wallet id -> settled payments, oldest first
+        self.payments: Dict[str, List[dict]] = defaultdict(list)
+        self.tip_events = 0
+        # Netted tips: discord id -> pending sats, settled by moving balances
+        self.journal: Dict[str, int] = defaultdict(int)
+        self.journaled = 0
+        self.requests = 0
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
+
+    def http_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=self.transport())
+
+    def add_user(self, discord_id: int, balance: int = 0) -> dict:
+        """Creates a usermanager user with one wallet holding `balance` sats"""
+        user_id = os.urandom(16).hex()
+        wallet = {
+            "id": os.urandom(16).hex(),
+            "admin": self.admin_key,
+            "name": f"{discord_id}-main",
+            "user": user_id,
+            "adminkey": os.urandom(16).hex(),
+            "inkey": os.urandom(16).hex(),
+        }
+        user = {
+            "id": user_id,
+            "name": str(discord_id),
+            "admin": self.admin_key,
+            "extra": {"discord_id": str(discord_id)},
+            "wallets": [wallet],
+        }
+        self.users[user_id] = user
+        self.users_by_discord_id[str(discord_id)] = user
+        self.wallets_by_key[wallet["adminkey"]] = wallet
+        self.wallets_by_key[wallet["inkey"]] = wallet
+        self.balances[wallet["id"]] = balance * 1000
+        return user
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        path = request.url.path
+        latency = self.latency
+        body = json.loads(request.content) if request.content else {}
+        if path == "/api/v1/payments" and body.get("out"):
+            latency = self.payment_latency
+        if latency or self.jitter:
+            await asyncio.sleep(max(latency + random.uniform(-1, 1) * self.jitter, 0))
+
+        key = request.headers.get("X-API-KEY")
+        method = request.method
+        try:
+            extension, _, path = path.partition("/api/v1")
+            if extension in ("/usermanager", "/discordbot"):
+                if key != self.admin_key:
+                    return httpx.Response(401, json={"detail": "Invalid key"})
+                if extension == "/discordbot":
+                    return self.discordbot(method, path, body)
+                return self.usermanager(method, path, request, body)
+            wallet = self.wallets_by_key.get(key)
+            if not wallet:
+                return httpx.Response(401, json={"detail": "Invalid key"})
+            if extension == "/withdraw":
+                return self.withdraw(method, path, wallet, body)
+            return self.core(method, path, request, wallet, body)
+        except KeyError as e:
+            return httpx.Response(404, json={"detail": f"Not found: {e}"})
+
+    def usermanager(
+        self, method: str, path: str, request: httpx.Request, body: dict
+    ) -> httpx.Response:
+        if method == "GET" and path == "/users":
+            discord_id = request.url.params.get("extra.discord_id")
+            user = self.users_by_discord_id.get(discord_id)
+            return httpx.Response(200, json=[user] if user else [])
+        if method == "POST" and path == "/users":
+            user = self.add_user(body["extra"]["discord_id"])
+            return httpx.Response(200, json=user)
+        if method == "PATCH" and path.startswith("/users/"):
+            user = self.users[path.split("/")[-1]]
+            user["extra"].update(body.get("extra", {}))
+            return httpx.Response(200, json=user)
+        if method == "GET" and path.startswith("/wallets/"):
+            user = self.users[path.split("/")[-1]]
+            return httpx.Response(200, json=user["wallets"])
+        if method == "POST" and path == "/extensions":
+            return httpx.Response(200, json={"extension": "updated"})
+        return httpx.Response(404, json={"detail": "Not found"})
+
+    @staticmethod
+    def _mapping(user: dict) -> dict:
+        return {
+            "discord_id": user["extra"]["discord_id"],
+            "user_id": user["id"],
+            "avatar_url": user["extra"].get("discord_avatar_url"),
+            "wallet": user["wallets"][0],
+        }
+
+    def discordbot(self, method: str, path: str, body: dict) -> httpx.Response:
+        # Users are always linked here, there are no users from before mappings
+        if method == "GET" and path.startswith("/users/mapping/"):
+            user = self.users_by_discord_id.get(path.split("/")[-1])
+            if not user:
+                return httpx.Response(404, json={"detail": "Not found"})
+            return httpx.Response(200, json=self._mapping(user))
+        if method == "POST" and path == "/users/mapping/query":
+            ids = body.get("discord_ids")
+            if ids is None:
+                after = body.get("after") or ""
+                ids = sorted(i for i in self.users_by_discord_id if i > after)
+            users = [self.users_by_discord_id.get(i) for i in ids]
+            return httpx.Response(
+                200,
+                json=[
+                    self._mapping(user)
+                    for user in users[: body.get("limit", 500)]
+                    if user
+                ],
+            )
+        if method == "POST" and path == "/users/mapping":
+            return httpx.Response(201, json=None)
+        if method == "POST" and path == "/payments/counterparties":
+            hashes = set(body["payment_hashes"])
+            return httpx.Response(
+                200,
+                json={
+                    payment["payment_hash"]: user["extra"]["discord_id"]
+                    for user in self.users.values()
+                    for wallet in user["wallets"]
+                    if wallet["id"] != body["wallet_id"]
+                    for payment in self.payments[wallet["id"]]
+                    if payment["payment_hash"] in hashes
+                },
+            )
+        if method == "POST" and path == "/journal":
+            sender = self.users_by_discord_id[body["sender_id"]]
+            available = self.balances[sender["wallets"][0]["id"]] // 1000
+            if available + self.journal[body["sender_id"]] < body["amount"]:
+                return httpx.Response(400, json={"detail": "Insufficient balance."})
+            self.journal[body["sender_id"]] -= body["amount"]
+            self.journal[body["receiver_id"]] += body["amount"]
+            self.journaled += 1
+            return httpx.Response(201, content=b"null")
+        if method == "GET" and path.startswith("/journal/balance/"):
+            discord_id = path.split("/")[-1]
+            wallet = self.users_by_discord_id[discord_id]["wallets"][0]
+            pending = self.journal[discord_id]
+            balance = self.balances[wallet["id"]] // 1000 + pending
+            return httpx.Response(200, json={"balance": balance, "pending": pending})
+        if method == "POST" and path == "/journal/settle":
+            for discord_id, pending in self.journal.items():
+                wallet = self.users_by_discord_id[discord_id]["wallets"][0]
+                self.balances[wallet["id"]] += pending * 1000
+            transfers = sum(1 for pending in self.journal.values() if pending > 0)
+            self.journal.clear()
+            return httpx.Response(
+                200, json={"transfers": transfers, "failed": 0, "unsettled": 0}
+            )
+        if method == "POST" and path == "/stats/events":
+            self.tip_events += len(body["events"])
+            # What FastAPI answers for endpoints without a return value
+            return httpx.Response(200, content=b"null")
+        return httpx.Response(404, json={"detail": "Not found"})
+
+    def withdraw(
+        self, method: str, path: str, wallet: dict, body: dict
+    ) -> httpx.Response:
+        if method == "POST" and path == "/links":
+            lnurl = "lnurl" + os.urandom(16).hex()
+            self.withdraw_links[lnurl] = body["max_withdrawable"]
+            return httpx.Response(200, json={"lnurl": lnurl})
+        return httpx.Response(404, json={"detail": "Not found"})
+
+    def core(
+        self, method: str, path: str, request: httpx.Request, wallet: dict, body: dict
+    ) -> httpx.Response:
+        if method == "GET" and path == "/wallet":
+            return httpx.Response(
+                200,
+                json={
+                    "id": wallet["id"],
+                    "name": wallet["name"],
+                    "balance": self.balances[wallet["id"]],
+                },
+            )
+        if method == "GET" and path.startswith("/lnurlscan/"):
+            lnurl = path.split("/")[-1]
+            return httpx.Response(
+                200,
+                json={
+                    "callback": f"{LNBITS_URL}withdraw/api/v1/lnurl/cb/{lnurl}",
+                    "maxWithdrawable": self.withdraw_links[lnurl] * 1000,
+                    "defaultDescription": "bench",
+                },
+            )
+        if method == "POST" and path == "/payments":
+            return self.payment(wallet, body)
+        if method == "GET" and path == "/payments":
+            offset = int(request.url.params.get("offset", 0))
+            limit = int(request.url.params.get("limit", 0)) or None
+            payments = self.payments[wallet["id"]][::-1][offset:]
+            return httpx.Response(200, json=payments[:limit])
+        return httpx.Response(404, json={"detail": "Not found"})
+
+    def payment(self, wallet: dict, body: dict) -> httpx.Response:
+        if body.get("lnurl_callback"):
+            lnurl = body["lnurl_callback"].split("/")[-1]
+            amount = self.withdraw_links.pop(lnurl) * 1000
+            self.balances[wallet["id"]] += amount
+            return httpx.Response(200, json={"payment_hash": os.urandom(32).hex()})
+
+        if not body.get("out"):
+            payment_hash = os.urandom(32).hex()
+            # Not a valid bolt11, the bot treats it as an invoice it can't decode
+            payment_request = f"lnbcrt{body['amount']}fake{payment_hash}"
+            self.invoices[payment_request] = (wallet["id"], body["amount"] * 1000)
+            return httpx.Response(
+                201,
+                json={"payment_hash": payment_hash, "payment_request": payment_request},
+            )
+
+        receiver, amount = self.invoices.pop(body["bolt11"])
+        if self.balances[wallet["id"]] < amount:
+            self.invoices[body["bolt11"]] = (receiver, amount)
+            return httpx.Response(400, json={"detail": "Insufficient balance."})
+        self.balances[wallet["id"]] -= amount
+        self.balances[receiver] += amount
+        payment_hash = body["bolt11"][-64:]
+        for wallet_id, sign in ((wallet["id"], -1), (receiver, 1)):
+            self.payments[wallet_id].append(
+                {
+                    "payment_hash": payment_hash,
+                    "amount": sign * amount,
+                    "memo": "bench",
+                    "time": int(time.time()),
+                    "pending": False,
+                    "wallet_id": wallet_id,
+                }
+            )
+        return httpx.Response(201, json={"payment_hash": payment_hash})
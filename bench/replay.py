@@ -0,0 +1,292 @@
+"""
+Replays traffic recorded with TRAFFIC_RECORD_FILE against the fake LNbits, at
+the recorded pace or faster:
+
+    python -m bench.replay traffic.jsonl --speed 10
+
+Every recorded bot gets its own client, every guild a channel with as many
+synthetic members as it had (up to --max-members) and every user a funded
+member. The recording doesn't know which message a button was pressed on, so
+buttons are pressed on the latest message of the matching command in the guild.
+
+If the dispatch lag keeps growing, the process can't keep up with the traffic.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from .fake_discord import FakeChannel, FakeMember, FakeMessage
+from .fake_lnbits import FakeLnbits
+from .report import git_revision, latency_stats, percentile, write_results
+from .scenarios import Bench
+
+# Buttons and the command which sent the message they are on
+BUTTON_COMMANDS = {
+    "tip": "tip",
+    "pay": "payme",
+    "claim": "donate",
+    "coinflip_join": "coinflip",
+    "coinflip_flip": "coinflip",
+}
+
+# A message and the view it was sent with, buttons may remove the view later
+Sent = Tuple[FakeMessage, object]
+
+
+def load(path: Path) -> Tuple[List[dict], List[dict]]:
+    interactions, requests = [], []
+    with open(path) as f:
+        for line in f:
+            event = json.loads(line)
+            if event["type"] == "interaction":
+                interactions.append(event)
+            elif event["type"] == "request":
+                requests.append(event)
+    interactions.sort(key=lambda event: event["t"])
+    return interactions, requests
+
+
+class BotReplay:
+    def __init__(self, bench: Bench, max_members: int):
+        self.bench = bench
+        self.max_members = max_members
+        self.channels: Dict[str, FakeChannel] = {}
+        self.users: Dict[str, FakeMember] = {}
+        # guild -> command -> latest message sent by it, with its view
+        self.latest: Dict[str, Dict[str, Sent]] = defaultdict(dict)
+        self.messages: Dict[str, Sent] = {}
+
+    def channel(self, event: dict) -> FakeChannel:
+        channel = self.channels.get(event["guild"])
+        if not channel:
+            size = min(event.get("guild_size") or 2, self.max_members)
+            members = [self.bench.add_member() for _ in range(size)]
+            channel = self.channels[event["guild"]] = FakeChannel(
+                members, self.bench.discord_latency
+            )
+        return channel
+
+    def user(self, event: dict, channel: FakeChannel) -> FakeMember:
+        user = self.users.get(event["user"])
+        if not user:
+            user = self.users[event["user"]] = self.bench.add_member()
+            channel.members.append(user)
+        return user
+
+    def options(self, event: dict, user: FakeMember, channel: FakeChannel) -> dict:
+        options = {}
+        for name, shape in event["args"].items():
+            if name == "roles":
+                # Role mentions can't be reproduced from their length
+                continue
+            if isinstance(shape, str) and shape.startswith("str:"):
+                options[name] = "x" * int(shape[4:])
+            elif shape in ("user", "mentionable"):
+                others = [member for member in channel.members if member != user]
+                options[name] = random.choice(others)
+            elif isinstance(shape, (int, float, bool)):
+                options[name] = shape
+        return options
+
+    async def run(self, event: dict) -> bool:
+        """Replays one interaction, returns False if it had to be skipped"""
+        channel = self.channel(event)
+        user = self.user(event, channel)
+        name = event["name"]
+
+        if not event.get("message"):
+            if not self.bench.client.tree.get_command(name):
+                return False
+            interaction = await self.bench.command(
+                name, user, channel, **self.options(event, user, channel)
+            )
+            message = interaction.original
+            if message and message.view:
+                self.latest[event["guild"]][name] = (message, message.view)
+            return True
+
+        sent = self.messages.get(event["message"])
+        if not sent:
+            sent = self.latest[event["guild"]].get(BUTTON_COMMANDS.get(name))
+            if not sent:
+                return False
+            self.messages[event["message"]] = sent
+        message, view = sent
+        for button in view.children:
+            if getattr(button, "interaction_name", None) == name:
+                await self.bench.press(button, user, message)
+                return True
+        return False
+
+
+async def replay(args: argparse.Namespace) -> dict:
+    interactions, requests = load(args.file)
+    durations = [request["duration"] for request in requests]
+    payments = [
+        request["duration"]
+        for request in requests
+        if request["method"] == "POST" and request["endpoint"] == "core:/payments"
+    ]
+    latency = args.latency
+    if latency is None:
+        latency = percentile(durations, 0.5) if durations else 0.02
+    payment_latency = args.payment_latency
+    if payment_latency is None and payments:
+        payment_latency = percentile(payments, 0.5)
+
+    lnbits: List[FakeLnbits] = []
+    bots: Dict[str, BotReplay] = {}
+    for bot in {event["bot"] for event in interactions}:
+        fake = FakeLnbits(latency=latency, payment_latency=payment_latency)
+        lnbits.append(fake)
+        bench = Bench(
+            fake,
+            members=0,
+            balance=args.balance,
+            discord_latency=args.discord_latency,
+        )
+        bots[bot] = BotReplay(bench, args.max_members)
+
+    replayed: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    skipped: Dict[str, int] = defaultdict(int)
+    lags: List[float] = []
+
+    async def run(event: dict, lag: float):
+        start = time.perf_counter()
+        try:
+            ran = await bots[event["bot"]].run(event)
+        except Exception:
+            errors[event["name"]] += 1
+            return
+        if ran:
+            replayed[event["name"]].append(time.perf_counter() - start)
+            lags.append(lag)
+        else:
+            skipped[event["name"]] += 1
+
+    tasks = []
+    start = time.perf_counter()
+    first = interactions[0]["t"] if interactions else 0
+    try:
+        for event in interactions:
+            due = start + (event["t"] - first) / args.speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            lag = max(time.perf_counter() - due, 0)
+            tasks.append(asyncio.create_task(run(event, lag)))
+        await asyncio.gather(*tasks)
+    finally:
+        for bot in bots.values():
+            await bot.bench.close()
+    elapsed = time.perf_counter() - start
+
+    recorded: Dict[str, List[float]] = defaultdict(list)
+    for event in interactions:
+        recorded[event["name"]].append(event["duration"])
+
+    return {
+        "revision": git_revision(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "recording": str(args.file),
+        "config": {
+            "speed": args.speed,
+            "latency": latency,
+            "payment_latency": payment_latency,
+            "discord_latency": args.discord_latency,
+            "max_members": args.max_members,
+        },
+        "bots": len(bots),
+        "guilds": sum(len(bot.channels) for bot in bots.values()),
+        "users": sum(len(bot.users) for bot in bots.values()),
+        "interactions": len(interactions),
+        "elapsed": round(elapsed, 2),
+        "recorded_span": round(interactions[-1]["t"] - first, 2) if interactions else 0,
+        "dispatch_lag": latency_stats(lags),
+        "lnbits_requests": {
+            "recorded": len(requests),
+            "replayed": sum(fake.requests for fake in lnbits),
+        },
+        "names": {
+            name: {
+                "replayed": len(replayed[name]),
+                "errors": errors[name],
+                "skipped": skipped[name],
+                "latency": latency_stats(replayed[name]),
+                "recorded_latency": latency_stats(recorded[name]),
+            }
+            for name in recorded
+        },
+    }
+
+
+def print_results(results: dict):
+    print(
+        f"Replayed {results['interactions']} interactions of {results['bots']} bots "
+        f"in {results['guilds']} guilds, {results['elapsed']}s for "
+        f"{results['recorded_span']}s of traffic at {results['config']['speed']}x"
+    )
+    lag = results["dispatch_lag"]
+    print(f"Dispatch lag p50 {lag['p50'] * 1000:.1f}ms, p99 {lag['p99'] * 1000:.1f}ms")
+    requests = results["lnbits_requests"]
+    print(f"LNbits requests: {requests['replayed']} (recorded {requests['recorded']})")
+    print(
+        f"\n{'interaction':<16}{'count':>8}{'errors':>8}{'skipped':>8}"
+        f"{'p50':>10}{'p99':>10}{'rec. p50':>10}"
+    )
+    for name, stats in results["names"].items():
+        print(
+            f"{name:<16}{stats['replayed']:>8}{stats['errors']:>8}"
+            f"{stats['skipped']:>8}"
+            f"{stats['latency']['p50'] * 1000:>8.1f}ms"
+            f"{stats['latency']['p99'] * 1000:>8.1f}ms"
+            f"{stats['recorded_latency']['p50'] * 1000:>8.1f}ms"
+        )
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m bench.replay",
+        description="Replays recorded traffic against a fake LNbits",
+    )
+    parser.add_argument("file", type=Path, help="Recording (TRAFFIC_RECORD_FILE)")
+    parser.add_argument("--speed", type=float, default=1, help="Acceleration factor")
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=None,
+        help="LNbits latency in seconds (default: recorded median)",
+    )
+    parser.add_argument(
+        "--payment-latency",
+        type=float,
+        default=None,
+        help="Latency of payments (default: recorded median)",
+    )
+    parser.add_argument("--discord-latency", type=float, default=0.0)
+    parser.add_argument("--max-members", type=int, default=500)
+    parser.add_argument("--balance", type=int, default=10**9)
+    parser.add_argument("--output", type=Path, default=None)
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None):
+    args = parse_args(argv)
+    logging.getLogger("discord").setLevel(logging.CRITICAL)
+    results = asyncio.run(replay(args))
+    output = write_results(results, args.output, prefix="replay-")
+    print_results(results)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+import json
+import subprocess
+import time
+from pathlib import Path
+from typing import List, Optional
+
+RESULTS_FOLDER = Path(__file__).parent / "results"
+
+
+def percentile(samples: List[float], p: float) -> float:
+    if not samples:
+        return 0
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+
+def latency_stats(durations: List[float]) -> dict:
+    return {
+        "mean": round(sum(durations) / len(durations), 4) if durations else 0,
+        "p50": round(percentile(durations, 0.5), 4),
+        "p95": round(percentile(durations, 0.95), 4),
+        "p99": round(percentile(durations, 0.99), 4),
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(results: dict, output: Path = None, prefix: str = "") -> Path:
+    output = output or RESULTS_FOLDER / f"{prefix}{time.strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2, default=str))
+    return output
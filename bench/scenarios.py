@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import functools
+import random
+import tempfile
+from typing import Awaitable, Callable, Dict
+
+from bot.client import LnbitsClient, create_client
+from bot.models import AdmissionLimits
+
+from .fake_discord import FakeChannel, FakeInteraction, FakeMember, FakeMessage
+from .fake_lnbits import LNBITS_URL, FakeLnbits
+
+# The benchmarks measure the bot, not how quickly admission control rejects it
+UNLIMITED = AdmissionLimits(user_rate=0, guild_rate=0, global_rate=0, concurrency={})
+
+
+class InteractionFailed(Exception):
+    pass
+
+
+class Bench:
+    """A client wired to a fake LNbits, with a channel full of funded members"""
+
+    def __init__(
+        self,
+        lnbits: FakeLnbits,
+        members: int = 50,
+        balance: int = 1_000_000,
+        discord_latency: float = 0.0,
+    ):
+        self.lnbits = lnbits
+        self.http = lnbits.http_client()
+        self.data_folder = tempfile.TemporaryDirectory()
+        self.client: LnbitsClient = create_client(
+            lnbits.admin_key,
+            self.http,
+            LNBITS_URL,
+            self.data_folder.name,
+            limits=UNLIMITED,
+        )
+        self.balance = balance
+        self.discord_latency = discord_latency
+        self.members = [self.add_member() for _ in range(members)]
+        self.channel = FakeChannel(self.members, discord_latency)
+
+    def add_member(self) -> FakeMember:
+        member = FakeMember(self.discord_latency)
+        self.lnbits.add_user(member.id, self.balance)
+        return member
+
+    async def close(self):
+        self.client.timers.close()
+        await self.client.api.stats.close()
+        await self.http.aclose()
+        self.data_folder.cleanup()
+
+    def pick(self, count: int = 1):
+        return random.sample(self.members, count)
+
+    async def _run(self, name: str, interaction: FakeInteraction, func):
+        await self.client.run_interaction(name, interaction, func)
+        if interaction.extras.get("failed"):
+            raise InteractionFailed(name)
+        return interaction
+
+    async def command(
+        self, name: str, user: FakeMember, channel: FakeChannel = None, **options
+    ):
+        interaction = FakeInteraction(self.client, user, channel or self.channel)
+        callback = self.client.tree.get_command(name).callback
+        return await self._run(
+            name, interaction, functools.partial(callback, interaction, **options)
+        )
+
+    async def press(self, button, user: FakeMember, message: FakeMessage):
+        interaction = FakeInteraction(self.client, user, message.channel, message)
+        return await self._run(
+            button.interaction_name,
+            interaction,
+            functools.partial(button.callback, interaction),
+        )
+
+
+Scenario = Callable[[Bench, int], Awaitable[None]]
+
+
+async def balance(bench: Bench, size: int):
+    (user,) = bench.pick()
+    await bench.command("balance", user)
+
+
+async def tip(bench: Bench, size: int):
+    sender, receiver = bench.pick(2)
+    await bench.command("tip", sender, member=receiver, amount=1, memo="bench")
+
+
+async def rain(bench: Bench, size: int):
+    (sender,) = bench.pick()
+    await bench.command("rain", sender, amount=1, description="bench", users=size)
+
+
+async def multitip(bench: Bench, size: int):
+    sender, *receivers = bench.pick(size + 1)
+    await bench.command(
+        "multitip",
+        sender,
+        amount=size,
+        members=" ".join(receiver.mention for receiver in receivers),
+        split=True,
+        memo="bench",
+    )
+
+
+async def coinflip(bench: Bench, size: int):
+    initiator, *players = bench.pick(size)
+    interaction = await bench.command(
+        "coinflip", initiator, entry=1, description="bench"
+    )
+    message = interaction.original
+    join, flip = message.view.children
+    for player in players:
+        await bench.press(join, player, message)
+    await bench.press(flip, initiator, message)
+
+
+async def history(bench: Bench, size: int):
+    (user,) = bench.pick()
+    interaction = await bench.command("history", user)
+    message = interaction.original
+    newer, older = message.view.children
+    if not older.disabled:
+        await bench.press(older, user, message)
+        await bench.press(newer, user, message)
+
+
+async def payme(bench: Bench, size: int):
+    (user,) = bench.pick()
+    await bench.command("payme", user, amount=10, description="bench")
+
+
+SCENARIOS: Dict[str, Scenario] = {
+    "balance": balance,
+    "tip": tip,
+    "rain": rain,
+    "multitip": multitip,
+    "coinflip": coinflip,
+    "payme": payme,
+    "history": history,
+}
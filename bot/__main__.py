@@ -1,16 +1,59 @@
 import asyncio
+import signal
+from typing import Optional
 
 import discord.utils
-from bot.client import create_client
-from httpx import AsyncClient
+from bot.api import create_http_client
+from bot.client import LnbitsClient, create_client
+from bot.metrics import serve_metrics
+from bot.models import AdmissionLimits
+from bot.profiler import ProfileMode, profile_to_file
+from bot.recorder import recorder
+from bot.tracing import tracer
 
 from .settings import StandaloneSettings
 
 settings = StandaloneSettings()
 
+PROFILE_SIGNALS = {
+    "SIGUSR1": ProfileMode.SAMPLING,
+    "SIGUSR2": ProfileMode.DETERMINISTIC,
+}
+
+
+def install_profile_signals():
+    loop = asyncio.get_running_loop()
+    for name, mode in PROFILE_SIGNALS.items():
+        # Not available on windows
+        if hasattr(signal, name):
+            loop.add_signal_handler(
+                getattr(signal, name),
+                lambda mode=mode: asyncio.create_task(
+                    profile_to_file(
+                        str(settings.data_folder), settings.profile_duration, mode
+                    )
+                ),
+            )
+
+
+def install_shutdown_signal(client: LnbitsClient):
+    shutdown: Optional[asyncio.Task] = None
+
+    def on_sigterm():
+        nonlocal shutdown
+        # Repeated signals don't start another shutdown while one is draining
+        if shutdown is None and not client.draining:
+            shutdown = asyncio.create_task(client.shutdown())
+
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, on_sigterm)
+    except NotImplementedError:
+        # Windows, where the bot is stopped without draining
+        pass
+
 
 async def run():
-    async with AsyncClient() as http:
+    async with create_http_client(settings) as http:
         if not settings.data_folder.is_dir():
             settings.data_folder.mkdir()
         client = create_client(
@@ -19,16 +62,27 @@ async def run():
             settings.lnbits_url,
             str(settings.data_folder),
         )
+        bot = await client.api.request(
+            "GET", "/bot", key=settings.lnbits_admin_key, extension="discordbot"
+        )
         if not settings.discord_bot_token:
-            bot = await client.api.request(
-                "GET", "/bot", key=settings.lnbits_admin_key, extension="discordbot"
-            )
             settings.discord_bot_token = bot["token"]
+        if bot.get("limits"):
+            client.admission.update(AdmissionLimits(**bot["limits"]))
 
         discord.utils.setup_logging()
+        install_profile_signals()
+        install_shutdown_signal(client)
+
+        if settings.metrics_port:
+            await serve_metrics(settings.metrics_host, settings.metrics_port)
 
-        async with client:
-            await client.start(settings.discord_bot_token)
+        try:
+            async with client:
+                await client.start(settings.discord_bot_token)
+        finally:
+            await tracer.close()
+            recorder.close()
 
 
 def start_bot():
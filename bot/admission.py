@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import math
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Optional
+
+from .models import AdmissionLimits, BotQuotas
+from .quotas import VIEW_INTERACTIONS, pending_views
+
+if TYPE_CHECKING:
+    from .client import LnbitsInteraction
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self) -> float:
+        """Seconds until a token is available, 0 if there is one right now"""
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class BucketGroup:
+    """Token buckets per key (user, guild), only the most recently used are kept"""
+
+    def __init__(self, rate: float, burst: int, max_size: int = 10_000):
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+        self.buckets: OrderedDict[int, TokenBucket] = OrderedDict()
+
+    def get(self, key: int) -> Optional[TokenBucket]:
+        if self.rate <= 0:
+            return None
+        bucket = self.buckets.get(key)
+        if bucket:
+            self.buckets.move_to_end(key)
+        else:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+            if len(self.buckets) > self.max_size:
+                self.buckets.popitem(last=False)
+        return bucket
+
+
+class AdmissionController:
+    """
+    Rate limits interactions per user, per guild and globally and caps how many
+    executions of a single command or button can run at the same time.
+
+    Rejections are immediate, nothing is queued.
+    """
+
+    # Seconds over which the interaction rate is measured
+    RATE_WINDOW = 10
+
+    def __init__(self, limits: AdmissionLimits = None, quotas: BotQuotas = None):
+        self.active: defaultdict[str, int] = defaultdict(int)
+        self.admitted: deque[float] = deque()
+        self.quota_rejected = 0
+        self.update(limits or AdmissionLimits())
+        self.update_quotas(quotas or BotQuotas())
+
+    def update(self, limits: AdmissionLimits):
+        self.limits = limits
+        self.users = BucketGroup(limits.user_rate, limits.user_burst)
+        self.guilds = BucketGroup(limits.guild_rate, limits.guild_burst)
+        self.bot = BucketGroup(limits.global_rate, limits.global_burst)
+
+    def update_quotas(self, quotas: BotQuotas):
+        self.quotas = quotas
+        rate = quotas.interactions_per_second
+        self.quota_bucket = TokenBucket(rate, max(1, math.ceil(rate))) if rate else None
+
+    def _prune_admitted(self, now: float):
+        cutoff = now - self.RATE_WINDOW
+        while self.admitted and self.admitted[0] < cutoff:
+            self.admitted.popleft()
+
+    def interaction_rate(self) -> float:
+        self._prune_admitted(time.monotonic())
+        return len(self.admitted) / self.RATE_WINDOW
+
+    def check_quotas(self, name: str, interaction: LnbitsInteraction):
+        if self.quota_bucket and self.quota_bucket.retry_after():
+            self.quota_rejected += 1
+            raise AdmissionRejected("The bot is busy right now, please try again soon")
+        limit = self.quotas.pending_views
+        if (
+            limit is not None
+            and name in VIEW_INTERACTIONS
+            and pending_views(interaction.client) >= limit
+        ):
+            self.quota_rejected += 1
+            raise AdmissionRejected(
+                "This bot has too many open payments and games, please try again later"
+            )
+
+    def check(self, name: str, interaction: LnbitsInteraction):
+        self.check_quotas(name, interaction)
+        checks = [
+            (self.users.get(interaction.user.id), "You are doing this too often"),
+            (self.bot.get(0), "The bot is busy right now"),
+        ]
+        if interaction.guild_id:
+            checks.append(
+                (self.guilds.get(interaction.guild_id), "This server is too busy")
+            )
+
+        # Check every bucket first, so a rejection doesn't cost tokens elsewhere
+        for bucket, message in checks:
+            if bucket:
+                retry_after = bucket.retry_after()
+                if retry_after:
+                    raise AdmissionRejected(
+                        f"{message}, please try again in {int(retry_after) + 1}s"
+                    )
+
+        limit = self.limits.concurrency.get(name)
+        if limit is not None and self.active[name] >= limit:
+            raise AdmissionRejected(
+                f"Too many {name} requests are running, please try again later"
+            )
+
+        for bucket, _ in checks:
+            if bucket:
+                bucket.consume()
+        if self.quota_bucket:
+            self.quota_bucket.consume()
+        # Pruned here as well, the rate is only read when someone asks for it
+        now = time.monotonic()
+        self._prune_admitted(now)
+        self.admitted.append(now)
+
+    @asynccontextmanager
+    async def admit(self, name: str, interaction: LnbitsInteraction):
+        self.check(name, interaction)
+        self.active[name] += 1
+        try:
+            yield
+        finally:
+            self.active[name] -= 1
@@ -1,13 +1,41 @@
 from __future__ import annotations
 
-from typing import Optional, Union
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Union
 
 import discord
 import discord.utils
-from httpx import AsyncClient, HTTPStatusError
+from httpx import AsyncClient, HTTPStatusError, Limits, Timeout, TransportError
 
-from .models import Wallet
-from .settings import discord_settings
+from .metrics import (
+    CACHE_REQUESTS,
+    LNBITS_REQUEST_DURATION,
+    LNBITS_REQUESTS,
+    endpoint_label,
+)
+from .models import (
+    HistoryEntry,
+    HistoryPage,
+    LeaderboardEntry,
+    PoolStats,
+    StatsKind,
+    StatsPeriod,
+    TipStats,
+    Wallet,
+)
+from .netting import NettingJournal
+from .policy import CircuitBreaker, LnbitsUnavailable, RetryPolicy, is_transient
+from .recorder import recorder
+from .scheduler import InteractionScheduler, WorkClass, work_class
+from .tracing import tracer
+from .settings import DiscordSettings, discord_settings
+from .stats import TipStatsRecorder
+
+_log = logging.getLogger(__name__)
 
 # discord.utils.setup_logging()
 
@@ -20,6 +48,82 @@ else:
 
 DiscordUser = Union[discord.Member, discord.User]
 
+# Discord ids per bulk mapping request while prewarming the wallet cache
+PREWARM_BATCH = 500
+
+# Users whose recently viewed /history pages are kept
+HISTORY_CACHE_USERS = 1000
+
+# Users whose wallets are kept, room for the prewarmed ones with the default limit
+WALLET_CACHE_USERS = 10_000
+
+
+def create_http_client(settings: DiscordSettings = discord_settings) -> AsyncClient:
+    http2 = settings.lnbits_http2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            _log.warning("HTTP/2 requested but h2 is not installed, using HTTP/1.1")
+            http2 = False
+
+    return AsyncClient(
+        http2=http2,
+        limits=Limits(
+            max_connections=settings.lnbits_max_connections,
+            max_keepalive_connections=settings.lnbits_max_keepalive_connections,
+            keepalive_expiry=settings.lnbits_keepalive_expiry,
+        ),
+        timeout=Timeout(
+            settings.lnbits_timeout,
+            connect=settings.lnbits_connect_timeout,
+            pool=settings.lnbits_pool_timeout,
+        ),
+    )
+
+
+def get_pool_stats(http: AsyncClient) -> Optional[PoolStats]:
+    # httpx doesn't expose its pool publicly, so this might break on upgrades
+    pool = getattr(getattr(http, "_transport", None), "_pool", None)
+    if pool is None:
+        return None
+    try:
+        connections = list(pool.connections)
+        requests = list(getattr(pool, "_requests", []))
+        idle = sum(1 for connection in connections if connection.is_idle())
+        return PoolStats(
+            max_connections=pool._max_connections,
+            connections=len(connections),
+            active=len(connections) - idle,
+            idle=idle,
+            queued=sum(1 for request in requests if request.connection is None),
+            http2=getattr(pool, "_http2", False),
+        )
+    except (AttributeError, TypeError):
+        return None
+
+
+def get_endpoint_timeout(
+    method: str, path: str, settings: DiscordSettings = discord_settings
+) -> Optional[Timeout]:
+    timeouts = settings.lnbits_endpoint_timeouts
+    if not timeouts:
+        return None
+    method = method.upper()
+    # /users/123 -> /users/123, /users
+    candidates = path.split("/")
+    while len(candidates) > 1:
+        prefix = "/".join(candidates)
+        for key in (f"{method} {prefix}", prefix):
+            if key in timeouts:
+                return Timeout(
+                    settings.lnbits_timeout,
+                    read=timeouts[key],
+                    connect=settings.lnbits_connect_timeout,
+                    pool=settings.lnbits_pool_timeout,
+                )
+        candidates.pop()
+
 
 class LnbitsAPI:
     def __init__(
@@ -27,9 +131,48 @@ class LnbitsAPI:
     ):
         super().__init__(**options)
         self.admin_key = admin_key
+        # Stable, non secret identifier of the bot for file names and metrics
+        self.bot_id = hashlib.sha256(admin_key.encode()).hexdigest()[:12]
         self.lnbits_http = http
         self.lnbits_url = lnbits_url
-        self.wallet_cache: dict[DiscordUser, Wallet] = {}
+        # discord id -> wallet, least recently used first
+        self.wallet_cache: OrderedDict[int, Wallet] = OrderedDict()
+        # wallet id -> (fetched at, balance in sats)
+        self.balance_cache: dict[str, tuple[float, int]] = {}
+        # wallet id -> (offset, limit) -> (fetched at, page), least recent user first
+        self.history_cache: OrderedDict[
+            str, dict[tuple[int, int], tuple[float, HistoryPage]]
+        ] = OrderedDict()
+        self.retry_policy = RetryPolicy(
+            attempts=discord_settings.lnbits_retry_attempts,
+            base_delay=discord_settings.lnbits_retry_base_delay,
+            max_delay=discord_settings.lnbits_retry_max_delay,
+        )
+        self.breaker = CircuitBreaker(
+            failure_threshold=discord_settings.lnbits_breaker_threshold,
+            reset_timeout=discord_settings.lnbits_breaker_reset_timeout,
+        )
+        self.scheduler = InteractionScheduler(
+            pools=discord_settings.lnbits_request_pools,
+            shared=discord_settings.lnbits_request_shared_pool,
+        )
+        self.stats = TipStatsRecorder(
+            self,
+            interval=discord_settings.tip_stats_flush_interval,
+            enabled=discord_settings.tip_stats,
+        )
+        self.journal = NettingJournal(
+            self,
+            max_amount=discord_settings.netting_max_amount,
+            interval=discord_settings.netting_settle_interval,
+        )
+
+    def reconfigure(self, *, admin_key: str = None, lnbits_url: str = None):
+        # bot_id stays, metrics and data files of the running bot keep their names
+        if admin_key:
+            self.admin_key = admin_key
+        if lnbits_url:
+            self.lnbits_url = lnbits_url
 
     async def get_lnbits_user(self, discord_user: DiscordUser):
         users = await self.request(
@@ -41,29 +184,74 @@ class LnbitsAPI:
         )
         if users:
             user = users[0]
-            if (
-                user["extra"].get("discord_avatar_url")
-                != discord_user.display_avatar.url
-            ):
-                try:
-                    await self.request(
-                        "PATCH",
-                        f'/users/{user["id"]}',
-                        self.admin_key,
-                        extension="usermanager",
-                        json={
-                            "extra": {
-                                "discord_avatar_url": discord_user.display_avatar.url,
-                            }
-                        },
-                    )
-                except HTTPStatusError:
-                    pass
+            await self.sync_avatar(
+                discord_user, user["id"], user["extra"].get("discord_avatar_url")
+            )
             return user
 
+    async def sync_avatar(
+        self, discord_user: DiscordUser, user_id: str, avatar_url: Optional[str]
+    ):
+        if avatar_url != discord_user.display_avatar.url:
+            try:
+                await self.request(
+                    "PATCH",
+                    f"/users/{user_id}",
+                    self.admin_key,
+                    extension="usermanager",
+                    json={
+                        "extra": {
+                            "discord_avatar_url": discord_user.display_avatar.url,
+                        }
+                    },
+                )
+            except HTTPStatusError:
+                pass
+
+    async def get_mapped_wallet(self, discord_user: DiscordUser) -> Optional[Wallet]:
+        """Indexed lookup through the discordbot extension"""
+        try:
+            mapping = await self.request(
+                "GET",
+                f"/users/mapping/{discord_user.id}",
+                self.admin_key,
+                extension="discordbot",
+            )
+        except HTTPStatusError as e:
+            # Not linked yet, or an extension version without mappings
+            if e.response.status_code == 404:
+                return None
+            raise
+        await self.sync_avatar(
+            discord_user, mapping["user_id"], mapping.get("avatar_url")
+        )
+        return Wallet(**mapping["wallet"])
+
+    async def save_mapping(self, discord_user: DiscordUser, wallet: Wallet):
+        try:
+            await self.request(
+                "POST",
+                "/users/mapping",
+                self.admin_key,
+                extension="discordbot",
+                json={
+                    "discord_id": str(discord_user.id),
+                    "user_id": wallet.user,
+                    "wallet_id": wallet.id,
+                },
+            )
+        except HTTPStatusError as e:
+            _log.warning("Could not save mapping of %s: %s", discord_user.id, e)
+
     async def get_user_wallet(self, discord_user: DiscordUser) -> Optional[Wallet]:
-        wallet = self.wallet_cache.get(discord_user)
+        wallet = self.wallet_cache.get(discord_user.id)
+        CACHE_REQUESTS.inc(self.bot_id, "wallet", "hit" if wallet else "miss")
+        if wallet:
+            self.wallet_cache.move_to_end(discord_user.id)
+        else:
+            wallet = await self.get_mapped_wallet(discord_user)
         if not wallet:
+            # Users created before the mapping table existed, link them now
             user = await self.get_lnbits_user(discord_user)
             if user:
                 wallets = await self.request(
@@ -74,27 +262,238 @@ class LnbitsAPI:
                 )
 
                 wallet = Wallet(**wallets[0])
-                self.wallet_cache[discord_user] = wallet
+                await self.save_mapping(discord_user, wallet)
+        if wallet:
+            self.cache_wallet(discord_user.id, wallet)
         return wallet
 
+    def cache_wallet(self, discord_id: int, wallet: Wallet):
+        self.wallet_cache[discord_id] = wallet
+        self.wallet_cache.move_to_end(discord_id)
+        while len(self.wallet_cache) > WALLET_CACHE_USERS:
+            self.wallet_cache.popitem(last=False)
+
+    def recent_users(self, limit: int) -> List[int]:
+        """Discord ids of the cached wallets, most recently used first"""
+        ids = []
+        for discord_id in reversed(self.wallet_cache):
+            if len(ids) >= limit:
+                break
+            ids.append(discord_id)
+        return ids
+
+    async def prewarm_wallets(self, recent: List[int], limit: int) -> int:
+        """
+        Bulk loads the wallets of up to ``limit`` users into the cache, the
+        given recently active users first, then any other user of the bot.
+        Returns how many wallets were loaded.
+        """
+        loaded = 0
+        with work_class(WorkClass.NOTIFICATION):
+            recent = recent[:limit]
+            for i in range(0, len(recent), PREWARM_BATCH):
+                batch = [str(user) for user in recent[i : i + PREWARM_BATCH]]
+                mappings = await self._query_mappings(discord_ids=batch)
+                # The query doesn't keep the order of the ids
+                by_id = {mapping["discord_id"]: mapping for mapping in mappings}
+                loaded += self._prewarm(
+                    [by_id[discord_id] for discord_id in batch if discord_id in by_id]
+                )
+
+            after = None
+            while loaded < limit and len(self.wallet_cache) < WALLET_CACHE_USERS:
+                size = min(limit - loaded, PREWARM_BATCH)
+                mappings = await self._query_mappings(after=after, limit=size)
+                loaded += self._prewarm(mappings)
+                if len(mappings) < size:
+                    break
+                after = mappings[-1]["discord_id"]
+        return loaded
+
+    async def _query_mappings(self, **query) -> List[dict]:
+        return await self.request(
+            "POST",
+            "/users/mapping/query",
+            self.admin_key,
+            extension="discordbot",
+            json=query,
+        )
+
+    def _prewarm(self, mappings: List[dict]) -> int:
+        """Adds wallets, ordered by recency, behind everything already cached"""
+        loaded = 0
+        for mapping in mappings:
+            if len(self.wallet_cache) >= WALLET_CACHE_USERS:
+                break
+            discord_id = int(mapping["discord_id"])
+            # Users who interacted in the meantime are cached with fresher data
+            if discord_id not in self.wallet_cache:
+                self.wallet_cache[discord_id] = Wallet(**mapping["wallet"])
+                self.wallet_cache.move_to_end(discord_id, last=False)
+                loaded += 1
+        return loaded
+
+    async def get_wallets(
+        self, discord_users: List[DiscordUser], create: bool = False
+    ) -> Dict[int, Wallet]:
+        """
+        Wallets of many users by discord id, with one bulk lookup for everyone
+        who isn't cached. Users without a wallet get one if ``create`` is set.
+        """
+        wallets = {}
+        missing = []
+        for discord_user in discord_users:
+            wallet = self.wallet_cache.get(discord_user.id)
+            CACHE_REQUESTS.inc(self.bot_id, "wallet", "hit" if wallet else "miss")
+            if wallet:
+                self.wallet_cache.move_to_end(discord_user.id)
+                wallets[discord_user.id] = wallet
+            else:
+                missing.append(discord_user)
+
+        for i in range(0, len(missing), PREWARM_BATCH):
+            batch = [str(user.id) for user in missing[i : i + PREWARM_BATCH]]
+            try:
+                mappings = await self._query_mappings(discord_ids=batch)
+            except HTTPStatusError as e:
+                # An extension version without bulk lookups
+                if e.response.status_code != 404:
+                    raise
+                break
+            for mapping in mappings:
+                discord_id = int(mapping["discord_id"])
+                wallets[discord_id] = Wallet(**mapping["wallet"])
+                self.cache_wallet(discord_id, wallets[discord_id])
+
+        # Users linked before the mapping table existed, or without a wallet yet
+        rest = [user for user in missing if user.id not in wallets]
+        lookup = self.get_or_create_wallet if create else self.get_user_wallet
+        for user, wallet in zip(rest, await asyncio.gather(*map(lookup, rest))):
+            if wallet:
+                wallets[user.id] = wallet
+        return wallets
+
     async def get_user_balance(self, discord_user: DiscordUser) -> Optional[int]:
         wallet = await self.get_user_wallet(discord_user)
+        if wallet and self.journal.enabled:
+            # Netted tips which aren't paid out yet count as well
+            balance = await self.journal.balance(discord_user)
+            if balance is not None:
+                self.balance_cache[wallet.id] = (time.monotonic(), balance)
+                return balance
         try:
-            wallet = await self.request("GET", "/wallet", wallet.adminkey)
-            if wallet:
-                return int(wallet["balance"] / 1000)
-        except HTTPStatusError:
-            # Try again after clearing cache
-            if discord_user in self.wallet_cache:
-                self.wallet_cache.pop(discord_user)
-                return await self.get_user_balance(discord_user)
-            else:
+            return await self.fetch_balance(wallet)
+        except HTTPStatusError as e:
+            # The cached wallet might be gone, try once more after clearing the cache
+            if is_transient(e) or self.wallet_cache.pop(discord_user.id, None) is None:
                 raise
+        wallet = await self.get_user_wallet(discord_user)
+        return await self.fetch_balance(wallet)
+
+    async def fetch_balance(self, wallet: Wallet) -> Optional[int]:
+        data = await self.request("GET", "/wallet", wallet.adminkey)
+        if data:
+            balance = int(data["balance"] / 1000)
+            self.balance_cache[wallet.id] = (time.monotonic(), balance)
+            return balance
+
+    def get_pool_stats(self) -> Optional[PoolStats]:
+        return get_pool_stats(self.lnbits_http)
+
+    def get_cached_balance(self, discord_user: DiscordUser) -> Optional[int]:
+        """Last known balance of the user, if it is recent enough"""
+        wallet = self.wallet_cache.get(discord_user.id)
+        if wallet and wallet.id in self.balance_cache:
+            fetched_at, balance = self.balance_cache[wallet.id]
+            if time.monotonic() - fetched_at < discord_settings.balance_cache_ttl:
+                CACHE_REQUESTS.inc(self.bot_id, "balance", "hit")
+                return balance
+        CACHE_REQUESTS.inc(self.bot_id, "balance", "miss")
+
+    def invalidate_balance(self, *wallets: Wallet):
+        for wallet in wallets:
+            self.balance_cache.pop(wallet.id, None)
+            # A new payment shifts every page of the history
+            self.history_cache.pop(wallet.id, None)
+
+    async def get_history(
+        self, discord_user: DiscordUser, offset: int, limit: int
+    ) -> Optional[HistoryPage]:
+        """
+        One page of the payments of the user, newest first. Only the page is
+        fetched, and recently viewed pages are reused for a while.
+        """
+        wallet = await self.get_user_wallet(discord_user)
+        if not wallet:
+            return None
+        pages = self.history_cache.get(wallet.id)
+        if pages and (offset, limit) in pages:
+            fetched_at, page = pages[(offset, limit)]
+            if time.monotonic() - fetched_at < discord_settings.history_cache_ttl:
+                CACHE_REQUESTS.inc(self.bot_id, "history", "hit")
+                self.history_cache.move_to_end(wallet.id)
+                return page
+        CACHE_REQUESTS.inc(self.bot_id, "history", "miss")
+
+        # One more than needed tells whether there is a next page
+        payments = await self.request(
+            "GET",
+            "/payments",
+            wallet.inkey,
+            params={"limit": limit + 1, "offset": offset},
+        )
+        has_next = len(payments) > limit
+        payments = payments[:limit]
+        counterparties = await self.get_counterparties(
+            wallet, [payment["payment_hash"] for payment in payments]
+        )
+        page = HistoryPage(
+            entries=[
+                HistoryEntry(
+                    payment_hash=payment["payment_hash"],
+                    amount=int(payment["amount"] / 1000),
+                    memo=payment.get("memo"),
+                    time=payment["time"],
+                    pending=payment.get("pending", False),
+                    counterparty=counterparties.get(payment["payment_hash"]),
+                )
+                for payment in payments
+            ],
+            offset=offset,
+            has_next=has_next,
+        )
+
+        pages = self.history_cache.setdefault(wallet.id, {})
+        self.history_cache.move_to_end(wallet.id)
+        pages[(offset, limit)] = (time.monotonic(), page)
+        while len(self.history_cache) > HISTORY_CACHE_USERS:
+            self.history_cache.popitem(last=False)
+        return page
+
+    async def get_counterparties(
+        self, wallet: Wallet, payment_hashes: List[str]
+    ) -> Dict[str, str]:
+        """Discord ids of the linked users on the other end of the payments"""
+        if not payment_hashes:
+            return {}
+        try:
+            return await self.request(
+                "POST",
+                "/payments/counterparties",
+                self.admin_key,
+                extension="discordbot",
+                json={"wallet_id": wallet.id, "payment_hashes": payment_hashes},
+            )
+        except HTTPStatusError as e:
+            # An extension version without counterparties, show the plain memos
+            if e.response.status_code == 404:
+                return {}
+            raise
 
     async def get_or_create_wallet(self, user: DiscordUser) -> Wallet:
         wallet = await self.get_user_wallet(user)
         if not wallet:
-            user = await self.request(
+            created = await self.request(
                 "POST",
                 "/users",
                 self.admin_key,
@@ -108,35 +507,163 @@ class LnbitsAPI:
                     },
                 ),
             )
-            wallet = Wallet(**user["wallets"][0])
+            wallet = Wallet(**created["wallets"][0])
+            await self.save_mapping(user, wallet)
+            self.cache_wallet(user.id, wallet)
         return wallet
 
     async def request(
         self, method: str, path: str, key: str = None, extension: str = None, **kwargs
     ) -> dict:
         if key:
-            self.lnbits_http.headers["X-API-KEY"] = key
+            # The http client is shared, so the key has to be set per request
+            kwargs["headers"] = {**kwargs.get("headers", {}), "X-API-KEY": key}
 
-        response = await self.lnbits_http.request(
-            method,
-            url=self.lnbits_url
-            + (extension + "/" if extension else "")
-            + "api/v1"
-            + path,
-            **kwargs,
-        )
+        if "timeout" not in kwargs:
+            timeout = get_endpoint_timeout(method, path)
+            if timeout:
+                kwargs["timeout"] = timeout
 
-        response.raise_for_status()
+        url = self.lnbits_url + (extension + "/" if extension else "") + "api/v1" + path
+        endpoint = endpoint_label(path, extension)
+        method = method.upper()
 
-        return response.json()
+        attempt = 0
+        while True:
+            self.breaker.before_request()
+            start = time.perf_counter()
+            status = "error"
+            span = tracer.span(f"lnbits {method} {endpoint}", attempt=attempt)
+            try:
+                with span:
+                    async with self.scheduler.slot():
+                        response = await self.lnbits_http.request(
+                            method, url=url, **kwargs
+                        )
+                    status = str(response.status_code)
+                    response.raise_for_status()
+            except (HTTPStatusError, TransportError) as e:
+                error = e
+            except BaseException:
+                self.breaker.record_cancelled()
+                raise
+            else:
+                error = None
+            finally:
+                duration = time.perf_counter() - start
+                LNBITS_REQUESTS.inc(self.bot_id, method, endpoint, status)
+                LNBITS_REQUEST_DURATION.observe(
+                    self.bot_id, method, endpoint, value=duration
+                )
+                recorder.request(self.bot_id, method, endpoint, status, duration)
+
+            if not error:
+                self.breaker.record_success()
+                return response.json()
+
+            if is_transient(error):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            if not self.retry_policy.should_retry(method, error, attempt):
+                raise error
+            await asyncio.sleep(self.retry_policy.get_delay(attempt))
+            attempt += 1
 
     async def send_payment(
-        self, sender: discord.Member, receiver: discord.Member, amount: int, memo: str
+        self,
+        sender: discord.Member,
+        receiver: discord.Member,
+        amount: int,
+        memo: str,
+        source: StatsKind = StatsKind.tip,
+    ):
+        with tracer.span("send_payment", amount=amount):
+            return await self._send_payment(sender, receiver, amount, memo, source)
+
+    async def _send_payment(
+        self,
+        sender: discord.Member,
+        receiver: discord.Member,
+        amount: int,
+        memo: str,
+        source: StatsKind,
     ):
         sender_wallet = await self.get_user_wallet(sender)
 
         receiver_wallet = await self.get_or_create_wallet(receiver)
 
+        await self.transfer(
+            sender, receiver, sender_wallet, receiver_wallet, amount, memo
+        )
+        self.stats.record(source, sender, receiver, amount)
+
+        return receiver_wallet
+
+    async def send_payments(
+        self,
+        sender: discord.Member,
+        amounts: Dict[discord.Member, int],
+        memo: str,
+        concurrency: int,
+        source: StatsKind = StatsKind.multitip,
+    ) -> Dict[discord.Member, Optional[Exception]]:
+        """
+        Pays every member their amount, ``concurrency`` payments at a time.
+        Returns the error of every member, None if they were paid.
+        """
+        with tracer.span("send_payments", recipients=len(amounts)):
+            sender_wallet = await self.get_user_wallet(sender)
+            wallets = await self.get_wallets(list(amounts), create=True)
+            # Once for all payments, instead of before every direct one
+            await self.journal.settle_user(sender)
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def pay(member: discord.Member, amount: int):
+                async with semaphore:
+                    try:
+                        await self.transfer(
+                            sender,
+                            member,
+                            sender_wallet,
+                            wallets[member.id],
+                            amount,
+                            memo,
+                            settle=False,
+                        )
+                        self.stats.record(source, sender, member, amount)
+                    except (HTTPStatusError, TransportError, LnbitsUnavailable) as e:
+                        return e
+
+            errors = await asyncio.gather(*(pay(*item) for item in amounts.items()))
+            return dict(zip(amounts, errors))
+
+    async def transfer(
+        self,
+        sender: DiscordUser,
+        receiver: DiscordUser,
+        sender_wallet: Wallet,
+        receiver_wallet: Wallet,
+        amount: int,
+        memo: str,
+        settle: bool = True,
+    ):
+        """
+        Pays a tip, micro-tips are journaled and netted if netting is enabled.
+        Balances include the netted tips, a direct payment settles the sender's
+        first unless ``settle`` is False because that already happened.
+        """
+        if self.journal.accepts(amount):
+            if await self.journal.record(sender, receiver, amount, memo):
+                self.invalidate_balance(sender_wallet, receiver_wallet)
+                return
+        if settle:
+            await self.journal.settle_user(sender)
+        await self.pay_wallet(sender_wallet, receiver_wallet, amount, memo)
+
+    async def pay_wallet(
+        self, sender_wallet: Wallet, receiver_wallet: Wallet, amount: int, memo: str
+    ):
         invoice = await self.request(
             "POST",
             "/payments",
@@ -150,5 +677,33 @@ class LnbitsAPI:
             sender_wallet.adminkey,
             json={"out": True, "bolt11": invoice["payment_request"]},
         )
+        self.invalidate_balance(sender_wallet, receiver_wallet)
 
-        return receiver_wallet
+    async def get_leaderboard(
+        self, guild_id: int, kind: StatsKind, period: StatsPeriod, limit: int = 10
+    ) -> List[LeaderboardEntry]:
+        entries = await self.request(
+            "GET",
+            "/stats/leaderboard",
+            self.admin_key,
+            extension="discordbot",
+            params={
+                "guild_id": str(guild_id),
+                "kind": kind.value,
+                "period": period.value,
+                "limit": limit,
+            },
+        )
+        return [LeaderboardEntry(**entry) for entry in entries]
+
+    async def get_tip_stats(
+        self, guild_id: int, period: StatsPeriod, member: DiscordUser = None
+    ) -> TipStats:
+        params = {"guild_id": str(guild_id), "period": period.value}
+        if member:
+            params["discord_id"] = str(member.id)
+        return TipStats(
+            **await self.request(
+                "GET", "/stats", self.admin_key, extension="discordbot", params=params
+            )
+        )
@@ -0,0 +1,158 @@
+"""
+Minimal BOLT11 decoder, just enough to validate invoices before paying them.
+
+Signatures are not verified and the payee is only known if the invoice contains
+an explicit ``n`` field, recovering it from the signature requires secp256k1.
+"""
+from __future__ import annotations
+
+import time
+from decimal import Decimal
+from typing import Optional
+
+from pydantic import BaseModel
+
+CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+
+DEFAULT_EXPIRY = 3600
+
+# Multipliers to convert the hrp amount into millisatoshis
+MULTIPLIERS = {
+    "m": Decimal(10**8),
+    "u": Decimal(10**5),
+    "n": Decimal(10**2),
+    "p": Decimal("0.1"),
+}
+
+TAG_PAYMENT_HASH = 1
+TAG_EXPIRY = 6
+TAG_DESCRIPTION = 13
+TAG_PAYEE = 19
+
+
+class Invoice(BaseModel):
+    currency: str
+    amount_msat: Optional[int]
+    timestamp: int
+    expiry: int = DEFAULT_EXPIRY
+    payment_hash: Optional[str]
+    description: Optional[str]
+    payee: Optional[str]
+
+    @property
+    def amount_sat(self) -> Optional[int]:
+        if self.amount_msat is not None:
+            return self.amount_msat // 1000
+
+    @property
+    def expires_at(self) -> int:
+        return self.timestamp + self.expiry
+
+    def is_expired(self, now: float = None) -> bool:
+        return (now or time.time()) >= self.expires_at
+
+
+def _polymod(values: list[int]) -> int:
+    generator = [0x3B6A57B2, 0x26508E6D, 0x1EA119FA, 0x3D4233DD, 0x2A1462B3]
+    chk = 1
+    for value in values:
+        top = chk >> 25
+        chk = (chk & 0x1FFFFFF) << 5 ^ value
+        for i in range(5):
+            chk ^= generator[i] if ((top >> i) & 1) else 0
+    return chk
+
+
+def _hrp_expand(hrp: str) -> list[int]:
+    return [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
+
+
+def _bech32_decode(bech: str) -> tuple[str, list[int]]:
+    bech = bech.lower()
+    pos = bech.rfind("1")
+    if pos < 1 or pos + 7 > len(bech):
+        raise ValueError("Invalid bech32 string")
+    hrp = bech[:pos]
+    try:
+        data = [CHARSET.index(c) for c in bech[pos + 1 :]]
+    except ValueError:
+        raise ValueError("Invalid bech32 character")
+    if _polymod(_hrp_expand(hrp) + data) != 1:
+        raise ValueError("Invalid bech32 checksum")
+    return hrp, data[:-6]
+
+
+def _to_int(words: list[int]) -> int:
+    result = 0
+    for word in words:
+        result = result << 5 | word
+    return result
+
+
+def _to_bytes(words: list[int]) -> bytes:
+    acc = bits = 0
+    result = bytearray()
+    for word in words:
+        acc = acc << 5 | word
+        bits += 5
+        while bits >= 8:
+            bits -= 8
+            result.append((acc >> bits) & 0xFF)
+    return bytes(result)
+
+
+def _parse_amount(amount: str) -> Optional[int]:
+    if not amount:
+        return None
+    multiplier = MULTIPLIERS.get(amount[-1])
+    if multiplier:
+        amount = amount[:-1]
+    else:
+        multiplier = Decimal(10**11)
+    if not amount.isdigit():
+        raise ValueError("Invalid invoice amount")
+    return int(Decimal(amount) * multiplier)
+
+
+def decode(payment_request: str) -> Invoice:
+    if payment_request.lower().startswith("lightning:"):
+        payment_request = payment_request[10:]
+
+    hrp, data = _bech32_decode(payment_request)
+    if not hrp.startswith("ln"):
+        raise ValueError("Not a lightning invoice")
+
+    # The currency prefix (bc, tb, bcrt, ...) is followed by an optional amount
+    prefix = hrp[2:]
+    split = len(prefix)
+    while split > 0 and (
+        prefix[split - 1].isdigit() or prefix[split - 1] in MULTIPLIERS
+    ):
+        split -= 1
+    currency, amount = prefix[:split], prefix[split:]
+
+    # The last 104 words are the signature
+    data = data[:-104]
+    fields = dict(
+        currency=currency,
+        amount_msat=_parse_amount(amount),
+        timestamp=_to_int(data[:7]),
+    )
+
+    pos = 7
+    while pos + 3 <= len(data):
+        tag = data[pos]
+        length = _to_int(data[pos + 1 : pos + 3])
+        words = data[pos + 3 : pos + 3 + length]
+        pos += 3 + length
+
+        if tag == TAG_PAYMENT_HASH and length == 52:
+            fields["payment_hash"] = _to_bytes(words).hex()
+        elif tag == TAG_EXPIRY:
+            fields["expiry"] = _to_int(words)
+        elif tag == TAG_DESCRIPTION:
+            fields["description"] = _to_bytes(words).decode(errors="replace")
+        elif tag == TAG_PAYEE and length == 53:
+            fields["payee"] = _to_bytes(words).hex()
+
+    return Invoice(**fields)
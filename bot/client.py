@@ -1,28 +1,89 @@
 from __future__ import annotations
 
+import asyncio
+import functools
+import io
+import ipaddress
+import json
+import logging
+import math
 import os.path
 import random
-from typing import TYPE_CHECKING, Union
+import re
+import time
+from typing import (
+    TYPE_CHECKING,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+from urllib.parse import urlsplit
 
 import discord
 import discord.utils
 import pyqrcode
 from discord import app_commands
-from httpx import AsyncClient
+from httpx import AsyncClient, HTTPError, HTTPStatusError, TransportError
 
+from . import bolt11
+from .admission import AdmissionController, AdmissionRejected
 from .api import LnbitsAPI
+from .idempotency import IdempotencyRegistry
+from .metrics import (
+    GATEWAY_LATENCY,
+    INTERACTION_DURATION,
+    INTERACTIONS,
+    install_rate_limit_counter,
+)
+from .models import (
+    AdmissionLimits,
+    BotQuotas,
+    QuotaUsage,
+    StatsKind,
+    StatsPeriod,
+    StatTotal,
+)
+from .policy import LnbitsUnavailable
+from .quotas import (
+    cached_members,
+    evict_members,
+    install_member_quota,
+    pending_views,
+)
+from .recorder import recorder
+from .scheduler import INTERACTION_CLASSES, WorkClass, work_class
+from .session import (
+    GatewaySession,
+    install_resume,
+    persist_session,
+    rebuild_guilds,
+)
 from .settings import discord_settings
+from .timers import DeadlineScheduler
+from .tracing import instrument_discord, tracer
 from .ui import (
+    HISTORY_PAGE_SIZE,
     ClaimButton,
     CoinFlipView,
+    HistoryView,
+    LnbitsView,
     PayButton,
     TipButton,
     WalletButton,
     get_amount_str,
+    send_error,
 )
+from .watchdog import start_watchdog
 
 discord.utils.setup_logging()
 
+_log = logging.getLogger(__name__)
+
 if discord_settings.discord_dev_guild:
     DEV_GUILD = discord.Object(id=discord_settings.discord_dev_guild)
 else:
@@ -31,6 +92,123 @@ else:
 DiscordUser = Union[discord.Member, discord.User]
 
 
+# Discord doesn't take larger avatars
+AVATAR_MAX_BYTES = 10 * 1024 * 1024
+
+# A member mention, optionally followed by an amount: "<@123> 50", "<@!123>:50"
+TIP_TARGET = re.compile(r"<@!?(\d+)>(?:\s*:?\s*(\d+)\b)?")
+
+
+def parse_tip_targets(text: str) -> List[Tuple[int, Optional[int]]]:
+    return [
+        (int(member_id), int(amount) if amount else None)
+        for member_id, amount in TIP_TARGET.findall(text)
+    ]
+
+
+async def resolve_members(
+    guild: discord.Guild, member_ids: Iterable[int]
+) -> Dict[int, discord.Member]:
+    """Members by id, those missing from the member cache are fetched"""
+    members = {}
+    missing = []
+    for member_id in member_ids:
+        member = guild.get_member(member_id)
+        if member:
+            members[member_id] = member
+        else:
+            missing.append(member_id)
+
+    async def fetch(member_id: int):
+        try:
+            members[member_id] = await guild.fetch_member(member_id)
+        except discord.HTTPException:
+            pass
+
+    await asyncio.gather(*(fetch(member_id) for member_id in missing))
+    return members
+
+
+def describe_not_found(member_ids: List[int]) -> str:
+    if not member_ids:
+        return ""
+    return ", could not find " + " ".join(f"<@{member_id}>" for member_id in member_ids)
+
+
+SENT_RECEIVED = [StatsKind.sent, StatsKind.received]
+
+
+def period_label(period: StatsPeriod) -> str:
+    return "all time" if period == StatsPeriod.all else f"this {period.value}"
+
+
+def render_qr(data: str) -> io.BytesIO:
+    buffer = io.BytesIO()
+    pyqrcode.create(data).png(buffer, scale=5)
+    buffer.seek(0)
+    return buffer
+
+
+class ProfileUpdateFailed(Exception):
+    pass
+
+
+async def download_avatar(http: AsyncClient, url: str) -> bytes:
+    """
+    Downloads an avatar from a public http(s) url. The url comes from the bot's
+    owner and is fetched by the server, so it must not reach internal hosts.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ProfileUpdateFailed("The avatar has to be an http(s) url")
+    try:
+        addresses = await asyncio.get_running_loop().getaddrinfo(
+            parts.hostname, parts.port or 443
+        )
+    except OSError as e:
+        raise ProfileUpdateFailed(f"Could not resolve the avatar's host: {e}")
+    for *_, sockaddr in addresses:
+        if not ipaddress.ip_address(sockaddr[0].split("%")[0]).is_global:
+            raise ProfileUpdateFailed("The avatar has to be on a public host")
+
+    try:
+        async with http.stream("GET", url, follow_redirects=False) as response:
+            response.raise_for_status()
+            if int(response.headers.get("content-length") or 0) > AVATAR_MAX_BYTES:
+                raise ProfileUpdateFailed("The avatar is too large")
+            content = bytearray()
+            async for chunk in response.aiter_bytes():
+                content += chunk
+                if len(content) > AVATAR_MAX_BYTES:
+                    raise ProfileUpdateFailed("The avatar is too large")
+    except HTTPError as e:
+        raise ProfileUpdateFailed(f"Could not download the avatar: {e}")
+    return bytes(content)
+
+
+class LnbitsCommandTree(app_commands.CommandTree):
+    client: LnbitsClient
+
+    async def _call(self, interaction: LnbitsInteraction):
+        # Every application command passes through here (private in discord.py),
+        # hook it into the client's interaction pipeline
+        name = interaction.data.get("name", "unknown")
+        await self.client.run_interaction(
+            name, interaction, functools.partial(super()._call, interaction)
+        )
+
+    async def on_error(
+        self, interaction: LnbitsInteraction, error: app_commands.AppCommandError
+    ):
+        interaction.extras["failed"] = True
+        if isinstance(error, app_commands.CommandInvokeError) and isinstance(
+            error.original, LnbitsUnavailable
+        ):
+            await send_error(interaction, str(error.original))
+        else:
+            await super().on_error(interaction, error)
+
+
 class LnbitsClient(discord.Client):
     def __init__(
         self,
@@ -39,19 +217,244 @@ class LnbitsClient(discord.Client):
         http: AsyncClient,
         lnbits_url: str,
         data_folder: str,
+        limits: AdmissionLimits = None,
+        quotas: BotQuotas = None,
         **options,
     ):
         super().__init__(**options)
         self.admin_key = admin_key
-        self.tree = app_commands.CommandTree(self)
+        self.tree = LnbitsCommandTree(self)
         self.lnbits_url = lnbits_url
         self.data_folder = data_folder
         self.api = LnbitsAPI(admin_key=admin_key, http=http, lnbits_url=lnbits_url)
+        self.idempotency = IdempotencyRegistry(
+            max_size=discord_settings.idempotency_cache_size,
+            path=self.data_file("idempotency.jsonl")
+            if discord_settings.idempotency_persist
+            else None,
+        )
+        self.timers = DeadlineScheduler()
+        self.admission = AdmissionController(limits)
+        self.apply_quotas(quotas or BotQuotas())
+        install_member_quota(self)
+        self.recent_users = self.load_recent_users()
+        self.prewarm_task: Optional[asyncio.Task] = None
+        self.resume_session: Optional[GatewaySession] = None
+        # Tasks running an interaction, shutting down waits for them
+        self.in_flight: set[asyncio.Task] = set()
+        self.draining = False
+
+    async def run_interaction(
+        self,
+        name: str,
+        interaction: LnbitsInteraction,
+        func: Callable[[], Awaitable[None]],
+    ):
+        start = time.perf_counter()
+        task = asyncio.current_task()
+        self.in_flight.add(task)
+        with recorder.interaction(self.api.bot_id, name, interaction) as record:
+            try:
+                if self.draining:
+                    raise AdmissionRejected("The bot is restarting, try again soon")
+                with tracer.start_trace(
+                    f"interaction {name}",
+                    bot=self.api.bot_id,
+                    user=interaction.user.id,
+                    guild=interaction.guild_id,
+                ):
+                    async with self.admission.admit(name, interaction):
+                        cls = INTERACTION_CLASSES.get(name, WorkClass.READ)
+                        with work_class(cls):
+                            await func()
+            except AdmissionRejected as e:
+                outcome = "rejected"
+                await send_error(interaction, str(e))
+            else:
+                # Errors are handled by discord.py, its error handlers flag them
+                outcome = "error" if interaction.extras.get("failed") else "ok"
+                INTERACTION_DURATION.observe(
+                    self.api.bot_id, name, value=time.perf_counter() - start
+                )
+            finally:
+                self.in_flight.discard(task)
+            INTERACTIONS.inc(self.api.bot_id, name, outcome)
+            if record:
+                record["outcome"] = outcome
+
+    async def reconfigure(
+        self,
+        *,
+        name: str = None,
+        avatar_url: str = None,
+        limits: AdmissionLimits = None,
+        quotas: BotQuotas = None,
+        admin_key: str = None,
+        lnbits_url: str = None,
+    ):
+        """Applies changed settings in place, without reconnecting to the gateway"""
+        if limits:
+            self.admission.update(limits)
+        if quotas:
+            self.apply_quotas(quotas)
+        if admin_key:
+            self.admin_key = admin_key
+        if lnbits_url:
+            self.lnbits_url = lnbits_url
+        self.api.reconfigure(admin_key=admin_key, lnbits_url=lnbits_url)
+        if self.user:
+            await self.update_profile(name, avatar_url)
+
+    def apply_quotas(self, quotas: BotQuotas):
+        self.admission.update_quotas(quotas)
+        self.api.scheduler.set_limit(quotas.lnbits_requests)
+        if quotas.member_cache is not None:
+            evict_members(self, quotas.member_cache, None)
+
+    def quota_usage(self) -> QuotaUsage:
+        return QuotaUsage(
+            lnbits_requests=self.api.scheduler.in_use(),
+            interactions_per_second=self.admission.interaction_rate(),
+            member_cache=cached_members(self),
+            pending_views=pending_views(self),
+            rejected=self.admission.quota_rejected,
+        )
+
+    async def update_profile(self, name: str = None, avatar_url: str = None):
+        changes = {}
+        if name and name != self.user.name:
+            changes["username"] = name
+        if avatar_url and avatar_url != self.user.display_avatar.url:
+            changes["avatar"] = await download_avatar(self.api.lnbits_http, avatar_url)
+        if changes:
+            try:
+                await self.user.edit(**changes)
+            except (discord.HTTPException, ValueError) as e:
+                # Discord limits how often the name can change and validates avatars
+                raise ProfileUpdateFailed(f"Discord rejected the profile: {e}")
+
+    async def connect(self, *, reconnect: bool = True):
+        if discord_settings.gateway_resume:
+            self.resume_session = GatewaySession.load(
+                self.data_file("gateway-session.json"),
+                self.http.token,
+                discord_settings.gateway_resume_max_age,
+            )
+        await super().connect(reconnect=reconnect)
+
+    async def on_resumed(self):
+        if not self.is_ready():
+            # Resumed the session of an earlier process, its caches are gone
+            await rebuild_guilds(self)
+
+    async def drain(self, timeout: float) -> int:
+        """
+        Stops taking interactions and waits up to ``timeout`` seconds for the
+        running ones. Returns how many are still running.
+        """
+        self.draining = True
+        # Deadlines which fired, like an auto flip, can be paying out as well
+        running = (self.in_flight | self.timers.running) - {asyncio.current_task()}
+        if running:
+            _, running = await asyncio.wait(running, timeout=timeout)
+        return len(running)
+
+    async def shutdown(self, timeout: float = None):
+        if timeout is None:
+            timeout = discord_settings.shutdown_drain_timeout
+        running = await self.drain(timeout)
+        if running:
+            _log.warning("Closing with %d interactions still running", running)
+        await self.close()
+
+    async def close(self):
+        if discord_settings.gateway_resume and not self.is_closed():
+            persist_session(self, self.data_file("gateway-session.json"))
+        self.timers.close()
+        if self.prewarm_task:
+            self.prewarm_task.cancel()
+        if discord_settings.wallet_prewarm_limit:
+            self.save_recent_users()
+        await self.api.stats.close()
+        self.api.journal.close()
+        GATEWAY_LATENCY.remove_collector(self)
+        await super().close()
+
+    def data_file(self, name: str) -> str:
+        # Multiple bots can share one data folder when running on an instance
+        return os.path.join(self.data_folder, f"discordbot-{self.api.bot_id}-{name}")
+
+    def load_recent_users(self) -> List[int]:
+        if not discord_settings.wallet_prewarm_limit:
+            return []
+        try:
+            with open(self.data_file("recent-users.json")) as f:
+                return [int(discord_id) for discord_id in json.load(f)]
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError, TypeError):
+            _log.warning("Could not load the recently active users")
+            return []
+
+    def save_recent_users(self):
+        """Remembers whose wallets to prewarm first, only ids, no keys"""
+        limit = discord_settings.wallet_prewarm_limit
+        recent = self.api.recent_users(limit)
+        # Users of the last run which weren't loaded (yet) keep their place after them
+        cached = set(recent)
+        recent += [user for user in self.recent_users if user not in cached]
+        path = self.data_file("recent-users.json")
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump(recent[:limit], f)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            _log.warning("Could not save the recently active users to %s", path)
+
+    async def prewarm_wallets(self):
+        start = time.perf_counter()
+        timeout = discord_settings.wallet_prewarm_timeout
+        try:
+            loaded = await asyncio.wait_for(
+                self.api.prewarm_wallets(
+                    self.recent_users, discord_settings.wallet_prewarm_limit
+                ),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            _log.info(
+                "Stopped prewarming wallets after %ss, %d cached",
+                timeout,
+                len(self.api.wallet_cache),
+            )
+        except (HTTPStatusError, TransportError, LnbitsUnavailable) as e:
+            _log.warning("Could not prewarm wallets: %s", e)
+        else:
+            _log.info(
+                "Prewarmed %d wallets in %.1fs", loaded, time.perf_counter() - start
+            )
+
+    def collect_gateway_latency(self):
+        if not math.isinf(self.latency) and not math.isnan(self.latency):
+            yield (self.api.bot_id,), self.latency
 
     # In this basic example, we just synchronize the app commands to one guild.
     # Instead of specifying a guild to every command, we copy over our global commands instead.
     # By doing so, we don't have to wait up to an hour until they are shown to the end-user.
     async def setup_hook(self):
+        install_rate_limit_counter()
+        start_watchdog(self.data_folder)
+        if discord_settings.gateway_resume:
+            install_resume()
+        if discord_settings.wallet_prewarm_limit:
+            # In the background, commands fall back to looking up wallets one by one
+            self.prewarm_task = asyncio.create_task(self.prewarm_wallets())
+        # Settles what an earlier run journaled
+        self.api.journal.start()
+        if tracer.enabled:
+            instrument_discord()
+        GATEWAY_LATENCY.add_collector(self, self.collect_gateway_latency)
+
         # This copies the global commands over to your guild.
         if DEV_GUILD:
             self.tree.copy_global_to(guild=DEV_GUILD)
@@ -64,28 +467,52 @@ class LnbitsClient(discord.Client):
         receiver: Union[discord.Member, discord.User],
         amount: int,
         memo: str = None,
+        jump_url: str = None,
     ):
-        receiver_wallet = await self.api.get_user_wallet(receiver)
-        new_balance = await self.api.get_user_balance(receiver)
+        with work_class(WorkClass.NOTIFICATION), tracer.span("payment_notification"):
+            receiver_wallet = await self.api.get_user_wallet(receiver)
+            new_balance = await self.api.get_user_balance(receiver)
+            if not jump_url:
+                jump_url = (await interaction.original_response()).jump_url
 
-        embed = discord.Embed(
-            title="New Payment",
-            color=discord.Color.yellow(),
-            description=f"You received **{get_amount_str(amount)}** from {sender.mention}\n\n"
-            f"The payment happened [here]({(await interaction.original_response()).jump_url})",
-        ).add_field(name="New Balance", value=get_amount_str(new_balance))
+            embed = discord.Embed(
+                title="New Payment",
+                color=discord.Color.yellow(),
+                description=f"You received **{get_amount_str(amount)}** from {sender.mention}\n\n"
+                f"The payment happened [here]({jump_url})",
+            ).add_field(name="New Balance", value=get_amount_str(new_balance))
 
-        if memo:
-            embed.add_field(name="Memo", value=f"_{memo}_")
-        try:
-            await receiver.send(
-                embed=embed,
-                view=discord.ui.View().add_item(
-                    WalletButton(self.lnbits_url, wallet=receiver_wallet)
-                ),
-            )
-        except discord.HTTPException:
-            return
+            if memo:
+                embed.add_field(name="Memo", value=f"_{memo}_")
+            try:
+                await receiver.send(
+                    embed=embed,
+                    view=LnbitsView().add_item(
+                        WalletButton(self.lnbits_url, wallet=receiver_wallet)
+                    ),
+                )
+            except discord.HTTPException:
+                return
+
+    async def notify_payments(
+        self,
+        interaction: LnbitsInteraction,
+        sender: discord.Member,
+        amounts: Dict[discord.Member, int],
+        memo: str = None,
+        concurrency: int = 5,
+    ):
+        """Notifies many receivers of one interaction, a few at a time"""
+        jump_url = (await interaction.original_response()).jump_url
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def notify(receiver: discord.Member, amount: int):
+            async with semaphore:
+                await self.try_send_payment_notification(
+                    interaction, sender, receiver, amount, memo, jump_url
+                )
+
+        await asyncio.gather(*(notify(*item) for item in amounts.items()))
 
 
 class LnbitsInteraction(discord.Interaction):
@@ -114,13 +541,22 @@ intents = discord.Intents.default()
 intents.members = True
 
 
-def create_client(admin_key: str, http: AsyncClient, lnbits_url: str, data_folder: str):
+def create_client(
+    admin_key: str,
+    http: AsyncClient,
+    lnbits_url: str,
+    data_folder: str,
+    limits: AdmissionLimits = None,
+    quotas: BotQuotas = None,
+):
     client = LnbitsClient(
         intents=intents,
         admin_key=admin_key,
         http=http,
         lnbits_url=lnbits_url,
         data_folder=data_folder,
+        limits=limits,
+        quotas=quotas,
     )
 
     @client.event
@@ -144,7 +580,7 @@ def create_client(admin_key: str, http: AsyncClient, lnbits_url: str, data_folde
 
         await interaction.response.send_message(
             content="You have a wallet!",
-            view=discord.ui.View().add_item(
+            view=LnbitsView().add_item(
                 WalletButton(interaction.client.lnbits_url, wallet=wallet)
             ),
             ephemeral=True,
@@ -157,15 +593,30 @@ def create_client(admin_key: str, http: AsyncClient, lnbits_url: str, data_folde
         wallet = await client.api.get_user_wallet(interaction.user)
 
         balance = await client.api.get_user_balance(interaction.user)
+        if client.api.journal.enabled:
+            # Pays out the netted tips of the user, the balance includes them already
+            asyncio.create_task(client.api.journal.settle_user(interaction.user))
 
         await interaction.response.send_message(
             ephemeral=True,
             content=f"Your balance: **{get_amount_str(balance)}**",
-            view=discord.ui.View().add_item(
+            view=LnbitsView().add_item(
                 WalletButton(interaction.client.lnbits_url, wallet=wallet)
             ),
         )
 
+    @client.tree.command(description="Page through the payments of your wallet")
+    async def history(interaction: LnbitsInteraction):
+        page = await client.api.get_history(interaction.user, 0, HISTORY_PAGE_SIZE)
+        if not page:
+            return await send_error(
+                interaction, "You do not have a wallet yet, use /create"
+            )
+        view = HistoryView(page)
+        await interaction.response.send_message(
+            embed=view.get_embed(), view=view, ephemeral=True
+        )
+
     @client.tree.command(name="tip", description="Send some sats to another user")
     @app_commands.describe(
         member="Who do you want to tip?",
@@ -178,6 +629,121 @@ def create_client(admin_key: str, http: AsyncClient, lnbits_url: str, data_folde
     ):
         await TipButton.execute(interaction, member, amount, memo)
 
+    @client.tree.command(name="multitip", description="Tip several people at once")
+    @app_commands.describe(
+        amount="Sats for everyone without their own amount, or in total with split",
+        members="Members to tip, each optionally followed by their own amount",
+        role="Tip everyone in this channel with this role",
+        split="Split the amount evenly instead of sending it to everyone",
+        memo="Memo to append",
+    )
+    @app_commands.guild_only()
+    async def multitip(
+        interaction: LnbitsInteraction,
+        amount: int,
+        members: str = None,
+        role: discord.Role = None,
+        split: bool = False,
+        memo: str = None,
+    ):
+        targets = parse_tip_targets(members or "")
+        mentioned = {member_id for member_id, _ in targets}
+        if len(mentioned) > discord_settings.multitip_max_recipients:
+            return await send_error(
+                interaction,
+                f"You can tip at most {discord_settings.multitip_max_recipients} "
+                "members at once",
+            )
+        resolved = await resolve_members(interaction.guild, mentioned)
+        not_found = [member_id for member_id in mentioned if member_id not in resolved]
+
+        # Mentioning someone twice adds up their amounts
+        recipients: Dict[discord.Member, Optional[int]] = {}
+        for member_id, own_amount in targets:
+            member = resolved.get(member_id)
+            if not member or member.bot or member == interaction.user:
+                continue
+            if own_amount is None:
+                recipients.setdefault(member, None)
+            else:
+                recipients[member] = (recipients.get(member) or 0) + own_amount
+        if role:
+            for member in interaction.channel.members:
+                if role in member.roles and not member.bot:
+                    if member != interaction.user:
+                        recipients.setdefault(member, None)
+
+        if not recipients:
+            return await send_error(
+                interaction, "Nobody to tip" + describe_not_found(not_found)
+            )
+        if len(recipients) > discord_settings.multitip_max_recipients:
+            return await send_error(
+                interaction,
+                f"You can tip at most {discord_settings.multitip_max_recipients} "
+                "members at once",
+            )
+
+        share = amount
+        if split:
+            without_amount = [m for m, own in recipients.items() if own is None]
+            share = amount // max(len(without_amount), 1)
+        amounts = {
+            member: share if own is None else own for member, own in recipients.items()
+        }
+        if min(amounts.values()) < 1:
+            return await send_error(interaction, "Every tip has to be at least 1 sat")
+
+        total = sum(amounts.values())
+        balance = await client.api.get_user_balance(interaction.user)
+        if balance < total:
+            return await send_error(
+                interaction,
+                f"You do not have enough balance for {get_amount_str(total)}",
+            )
+
+        await interaction.response.defer()
+        errors = await client.api.send_payments(
+            interaction.user,
+            amounts,
+            memo,
+            concurrency=discord_settings.multitip_concurrency,
+        )
+        paid = {
+            member: amounts[member] for member, error in errors.items() if not error
+        }
+
+        embed = discord.Embed(
+            color=discord.Color.yellow(),
+            title=f"💸 Tips by {interaction.user.display_name} 💸",
+            description=f"Sent **{get_amount_str(sum(paid.values()))}** to\n"
+            + "\n".join(
+                f"{member.mention} {get_amount_str(amount)}"
+                for member, amount in paid.items()
+            ),
+        )
+        failed = [member for member, error in errors.items() if error]
+        if failed:
+            embed.add_field(
+                name="Failed", value=" ".join(member.mention for member in failed)
+            )
+        if not_found:
+            embed.add_field(
+                name="Not found",
+                value=" ".join(f"<@{member_id}>" for member_id in not_found),
+            )
+        if memo:
+            embed.add_field(name="Memo", value=memo)
+        await interaction.followup.send(embed=embed)
+
+        await client.notify_payments(
+            interaction,
+            interaction.user,
+            paid,
+            memo,
+            concurrency=discord_settings.multitip_concurrency,
+        )
+
     @client.tree.command(
         name="donate", description="Create an open invoice for anyone to claim."
     )
@@ -188,10 +754,13 @@ def create_client(admin_key: str, http: AsyncClient, lnbits_url: str, data_folde
     @app_commands.guild_only()
     async def donate(interaction: LnbitsInteraction, amount: int, description: str):
         wallet = await client.api.get_user_wallet(interaction.user)
+        # The withdraw link pays from the wallet, netted tips have to be in there
+        await client.api.journal.settle_user(interaction.user)
 
         await client.api.request(
             "POST",
             "/extensions",
+            client.admin_key,
             extension="usermanager",
             params={"userid": wallet.user, "extension": "withdraw", "active": True},
         )
@@ -210,6 +779,7 @@ def create_client(admin_key: str, http: AsyncClient, lnbits_url: str, data_folde
                 "is_unique": True,
             },
         )
+        button = ClaimButton(lnurl=resp["lnurl"], link_id=resp.get("id"), wallet=wallet)
 
         await interaction.response.send_message(
             embed=discord.Embed(
@@ -219,9 +789,17 @@ def create_client(admin_key: str, http: AsyncClient, lnbits_url: str, data_folde
             )
             .add_field(name="Description", value=description)
             .add_field(name="LNURL", value=resp["lnurl"], inline=False),
-            view=discord.ui.View().add_item(ClaimButton(lnurl=resp["lnurl"])),
+            view=LnbitsView(timeout=None).add_item(button),
         )
 
+        if discord_settings.donate_expiry:
+            message = await interaction.original_response()
+            button.schedule_retirement(
+                client,
+                interaction.channel.get_partial_message(message.id),
+                time.time() + discord_settings.donate_expiry,
+            )
+
     @client.tree.command(description="Creates an invoice for the users wallet")
     @app_commands.describe(
         amount="The amount of satoshis payable in the invoice",
@@ -229,6 +807,11 @@ def create_client(admin_key: str, http: AsyncClient, lnbits_url: str, data_folde
     )
     @app_commands.guild_only()
     async def payme(interaction: LnbitsInteraction, amount: int, description: str):
+        if amount <= 0:
+            return await interaction.response.send_message(
+                content="The amount has to be positive", ephemeral=True
+            )
+
         wallet = await client.api.get_user_wallet(interaction.user)
 
         # invoice = await api_payments_create_invoice(
@@ -247,10 +830,24 @@ def create_client(admin_key: str, http: AsyncClient, lnbits_url: str, data_folde
             json={"out": False, "amount": amount, "memo": description, "unit": "sat"},
         )
 
-        qr_code = pyqrcode.create(invoice["payment_request"])
+        try:
+            decoded = bolt11.decode(invoice["payment_request"])
+        except ValueError:
+            decoded = None
 
-        temp_path = os.path.join(client.data_folder, "temp.png")
-        qr_code.png(file=temp_path, scale=5)
+        # Encoding the png takes a while and would block every other interaction
+        qr_png = await asyncio.get_running_loop().run_in_executor(
+            None, render_qr, invoice["payment_request"]
+        )
+
+        button = PayButton(
+            payment_request=invoice["payment_request"],
+            receiver=interaction.user,
+            receiver_wallet=wallet,
+            amount=amount,
+            description=description,
+            invoice=decoded,
+        )
 
         await interaction.response.send_message(
             embed=discord.Embed(title="Pay Me!", color=discord.Color.yellow())
@@ -260,16 +857,13 @@ def create_client(admin_key: str, http: AsyncClient, lnbits_url: str, data_folde
             .add_field(
                 name="Payment Request", value=invoice["payment_request"], inline=False
             ),
-            file=discord.File(temp_path, "qr.png"),
-            view=discord.ui.View().add_item(
-                PayButton(
-                    payment_request=invoice["payment_request"],
-                    receiver=interaction.user,
-                    receiver_wallet=wallet,
-                    amount=amount,
-                    description=description,
-                )
-            ),
+            file=discord.File(qr_png, "qr.png"),
+            view=LnbitsView(timeout=None).add_item(button),
+        )
+
+        message = await interaction.original_response()
+        button.schedule_expiry(
+            client.timers, interaction.channel.get_partial_message(message.id)
         )
 
     @client.tree.command(description="Creates an invoice for the users wallet")
@@ -336,7 +930,11 @@ def create_client(admin_key: str, http: AsyncClient, lnbits_url: str, data_folde
             member = validMembers.pop(idx)
             if member:
                 wallet = await client.api.send_payment(
-                    interaction.user, member, amount, description
+                    interaction.user,
+                    member,
+                    amount,
+                    description,
+                    source=StatsKind.rain,
                 )
 
                 membersSent.append(member)
@@ -356,6 +954,72 @@ def create_client(admin_key: str, http: AsyncClient, lnbits_url: str, data_folde
                 interaction, interaction.user, member, amount, description
             )
 
+    @client.tree.command(description="Top tippers and receivers of this server")
+    @app_commands.describe(
+        kind="Rank by sats sent, received or sent with one command",
+        period="The current day, week, month or all time",
+    )
+    @app_commands.guild_only()
+    async def leaderboard(
+        interaction: LnbitsInteraction,
+        kind: StatsKind = StatsKind.sent,
+        period: StatsPeriod = StatsPeriod.week,
+    ):
+        entries = await client.api.get_leaderboard(interaction.guild_id, kind, period)
+        lines = []
+        for rank, entry in enumerate(entries, 1):
+            member = interaction.guild.get_member(int(entry.discord_id))
+            name = member.mention if member else f"<@{entry.discord_id}>"
+            lines.append(f"**{rank}.** {name} {get_amount_str(entry.total)}")
+
+        await interaction.response.send_message(
+            embed=discord.Embed(
+                title=f"🏆 Leaderboard: {kind.value}, {period_label(period)}",
+                color=discord.Color.yellow(),
+                description="\n".join(lines) or "Nobody yet",
+            ),
+            allowed_mentions=discord.AllowedMentions.none(),
+        )
+
+    @client.tree.command(description="Tipping statistics of this server or a member")
+    @app_commands.describe(
+        member="Whose statistics to show, yours by default",
+        period="The current day, week, month or all time",
+    )
+    @app_commands.guild_only()
+    async def stats(
+        interaction: LnbitsInteraction,
+        member: discord.Member = None,
+        period: StatsPeriod = StatsPeriod.week,
+    ):
+        member = member or interaction.user
+        tip_stats = await client.api.get_tip_stats(interaction.guild_id, period, member)
+
+        def describe(totals: Dict[StatsKind, StatTotal], kinds) -> str:
+            return "\n".join(
+                f"{kind.value}: {get_amount_str(totals[kind].total)} "
+                f"({totals[kind].count}x)"
+                for kind in kinds
+                if kind in totals
+            )
+
+        sources = [kind for kind in StatsKind if kind not in SENT_RECEIVED]
+        embed = discord.Embed(
+            title=f"📊 Statistics, {period_label(period)}",
+            color=discord.Color.yellow(),
+        )
+        embed.add_field(
+            name=interaction.guild.name,
+            value=describe(tip_stats.guild, sources) or "Nothing yet",
+            inline=False,
+        )
+        embed.add_field(
+            name=member.display_name,
+            value=describe(tip_stats.member, SENT_RECEIVED + sources) or "Nothing yet",
+            inline=False,
+        )
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
     @client.tree.command(description="Creates an coinflip everyone can join")
     @app_commands.describe(
         entry="The entry price",
@@ -371,4 +1035,12 @@ def create_client(admin_key: str, http: AsyncClient, lnbits_url: str, data_folde
             embed=view.get_current_embed(), view=view
         )
 
+        if discord_settings.coinflip_auto_flip:
+            message = await interaction.original_response()
+            view.schedule_auto_flip(
+                client,
+                interaction.channel.get_partial_message(message.id),
+                time.time() + discord_settings.coinflip_auto_flip,
+            )
+
     return client
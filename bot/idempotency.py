@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import json
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, TypeVar, Union
+
+T = TypeVar("T")
+
+_log = logging.getLogger(__name__)
+
+
+class DuplicateOperation(Exception):
+    def __init__(self, key: str, pending: bool):
+        self.key = key
+        self.pending = pending
+        super().__init__(
+            "This is already being processed"
+            if pending
+            else "This has already been processed"
+        )
+
+
+class IdempotencyRegistry:
+    """
+    Collapses duplicate operations (double clicks, discord retries, racing users)
+    into a single execution.
+
+    While an operation is in flight, every other caller using the same key is
+    rejected with :class:`DuplicateOperation`. Keys marked as done stay
+    registered, so one-shot resources (invoices, lnurls) can only ever be
+    processed once. The set of remembered keys is bounded and can optionally be
+    persisted to a file to survive restarts.
+    """
+
+    def __init__(self, max_size: int = 10_000, path: Union[str, Path] = None):
+        self.max_size = max_size
+        self.path = Path(path) if path else None
+        self.in_flight: set[str] = set()
+        self.completed: OrderedDict[str, None] = OrderedDict()
+        if self.path:
+            self._load()
+
+    def is_done(self, key: str) -> bool:
+        return key in self.completed
+
+    def is_pending(self, key: str) -> bool:
+        return key in self.in_flight
+
+    async def run(self, key: str, func: Callable[[], Awaitable[T]]) -> T:
+        if key in self.completed:
+            raise DuplicateOperation(key, pending=False)
+        if key in self.in_flight:
+            raise DuplicateOperation(key, pending=True)
+
+        self.in_flight.add(key)
+        try:
+            result = await func()
+        finally:
+            self.in_flight.discard(key)
+        return result
+
+    def mark_done(self, key: str):
+        # Call this as soon as the side effect happened, the interaction might still fail
+        self.completed[key] = None
+        self.completed.move_to_end(key)
+        while len(self.completed) > self.max_size:
+            self.completed.popitem(last=False)
+        if self.path:
+            self._append(key)
+
+    def _load(self):
+        if not self.path.is_file():
+            return
+        try:
+            with self.path.open() as f:
+                keys = [json.loads(line) for line in f if line.strip()]
+        except (OSError, ValueError):
+            _log.warning("Could not load idempotency keys from %s", self.path)
+            return
+        for key in keys[-self.max_size :]:
+            self.completed[key] = None
+        # Compact the file so it doesn't grow without bounds
+        self._rewrite()
+
+    def _rewrite(self):
+        try:
+            with self.path.open("w") as f:
+                f.writelines(json.dumps(key) + "\n" for key in self.completed)
+        except OSError:
+            _log.warning("Could not persist idempotency keys to %s", self.path)
+
+    def _append(self, key: str):
+        try:
+            with self.path.open("a") as f:
+                f.write(json.dumps(key) + "\n")
+        except OSError:
+            _log.warning("Could not persist idempotency keys to %s", self.path)
@@ -0,0 +1,280 @@
+"""
+Minimal metrics in the prometheus text exposition format.
+
+Metrics are process wide, every sample of a bot carries a ``bot`` label so
+multiple bots hosted in the same process can be told apart.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+import re
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, Optional, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+Sample = Tuple[LabelValues, float]
+
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    type: str
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _matches(self, values: LabelValues, match: Dict[str, str]) -> bool:
+        for name, value in match.items():
+            if name in self.labelnames:
+                if values[self.labelnames.index(name)] != value:
+                    return False
+        return True
+
+    def render(self, match: Dict[str, str]) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: defaultdict[LabelValues, float] = defaultdict(float)
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] += amount
+
+    def render(self, match: Dict[str, str]) -> Iterable[str]:
+        yield from super().render(match)
+        for labels, value in list(self.values.items()):
+            if self._matches(labels, match):
+                yield (
+                    f"{self.name}{_format_labels(self.labelnames, labels)} "
+                    f"{_format_value(value)}"
+                )
+
+
+class Gauge(Metric):
+    """Gauge whose samples are collected lazily when rendering"""
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+        self.collectors: Dict[object, Callable[[], Iterable[Sample]]] = {}
+
+    def set(self, *labels: str, value: float):
+        self.values[labels] = value
+
+    def remove(self, *labels: str):
+        self.values.pop(labels, None)
+
+    def add_collector(self, key: object, collector: Callable[[], Iterable[Sample]]):
+        self.collectors[key] = collector
+
+    def remove_collector(self, key: object):
+        self.collectors.pop(key, None)
+
+    def render(self, match: Dict[str, str]) -> Iterable[str]:
+        yield from super().render(match)
+        samples = list(self.values.items())
+        for collector in list(self.collectors.values()):
+            samples.extend(collector())
+        for labels, value in samples:
+            if self._matches(labels, match):
+                yield (
+                    f"{self.name}{_format_labels(self.labelnames, labels)} "
+                    f"{_format_value(value)}"
+                )
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.counts: Dict[LabelValues, list[int]] = {}
+        self.sums: defaultdict[LabelValues, float] = defaultdict(float)
+
+    def observe(self, *labels: str, value: float):
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.sums[labels] += value
+
+    def render(self, match: Dict[str, str]) -> Iterable[str]:
+        yield from super().render(match)
+        names = self.labelnames + ("le",)
+        for labels, counts in list(self.counts.items()):
+            if not self._matches(labels, match):
+                continue
+            for bound, count in zip(self.buckets, counts):
+                label_str = _format_labels(names, labels + (_format_value(bound),))
+                yield f"{self.name}_bucket{label_str} {count}"
+            label_str = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{label_str} {_format_value(self.sums[labels])}"
+            yield f"{self.name}_count{label_str} {counts[-1]}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def _register(self, metric: Metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self, match: Dict[str, str] = None) -> str:
+        """Renders all metrics, optionally only samples with matching labels"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render(match or {}))
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+INTERACTIONS = registry.counter(
+    "discordbot_interactions_total",
+    "Slash commands and component interactions handled",
+    ("bot", "name", "outcome"),
+)
+INTERACTION_DURATION = registry.histogram(
+    "discordbot_interaction_duration_seconds",
+    "Time the bot took to handle an interaction",
+    ("bot", "name"),
+)
+LNBITS_REQUESTS = registry.counter(
+    "discordbot_lnbits_requests_total",
+    "Requests made to LNbits",
+    ("bot", "method", "endpoint", "status"),
+)
+LNBITS_REQUEST_DURATION = registry.histogram(
+    "discordbot_lnbits_request_duration_seconds",
+    "Duration of requests made to LNbits, including waiting for a slot",
+    ("bot", "method", "endpoint"),
+)
+CACHE_REQUESTS = registry.counter(
+    "discordbot_cache_requests_total",
+    "Lookups of the bot's caches",
+    ("bot", "cache", "result"),
+)
+DISCORD_RATE_LIMITS = registry.counter(
+    "discordbot_discord_rate_limits_total",
+    "Requests to discord which were answered with 429 (all bots in this process)",
+)
+GATEWAY_LATENCY = registry.gauge(
+    "discordbot_gateway_latency_seconds",
+    "Latency between a gateway heartbeat and its acknowledgement",
+    ("bot",),
+)
+EVENT_LOOP_LAG = registry.gauge(
+    "discordbot_event_loop_lag_seconds",
+    "How late the event loop woke up the watchdog's heartbeat",
+)
+
+_ID_SEGMENT = re.compile(r"^([0-9a-fA-F]{16,}|\d+|lnurl[0-9a-z]+)$", re.IGNORECASE)
+
+
+def endpoint_label(path: str, extension: str = None) -> str:
+    """Replaces ids in the path, otherwise every user would get their own series"""
+    segments = ["{id}" if _ID_SEGMENT.match(s) else s for s in path.split("/")]
+    return (extension or "core") + ":" + "/".join(segments)
+
+
+class RateLimitCounter(logging.Filter):
+    """Counts the 429 warnings discord.py logs, it doesn't expose them otherwise"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if "rate limited" in str(record.msg):
+            DISCORD_RATE_LIMITS.inc()
+        return True
+
+
+_rate_limit_counter: Optional[RateLimitCounter] = None
+
+
+def install_rate_limit_counter():
+    global _rate_limit_counter
+    if not _rate_limit_counter:
+        _rate_limit_counter = RateLimitCounter()
+        logging.getLogger("discord.http").addFilter(_rate_limit_counter)
+
+
+async def serve_metrics(host: str, port: int) -> asyncio.AbstractServer:
+    """Serves /metrics over plain http, enough for a local prometheus scraper"""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Drain the headers
+            while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+                pass
+            parts = request_line.decode(errors="replace").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1] == "/metrics":
+                status, body = "200 OK", registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -1,4 +1,7 @@
-from pydantic import BaseModel
+from enum import Enum
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, Field
 
 
 class Wallet(BaseModel):
@@ -8,3 +11,124 @@ class Wallet(BaseModel):
     user: str
     adminkey: str
     inkey: str
+
+
+class HistoryEntry(BaseModel):
+    payment_hash: str
+    amount: int  # sats, negative if sent
+    memo: Optional[str]
+    time: int
+    pending: bool
+    # Discord id of the user on the other end, if they are linked to the bot
+    counterparty: Optional[str]
+
+
+class HistoryPage(BaseModel):
+    entries: List[HistoryEntry]
+    offset: int
+    has_next: bool
+
+
+class PoolStats(BaseModel):
+    max_connections: Optional[int]
+    connections: int
+    active: int
+    idle: int
+    queued: int
+    http2: bool
+
+
+class AdmissionLimits(BaseModel):
+    # Token buckets: refill rate per second and burst size, a rate of 0 disables them
+    user_rate: float = 0.5
+    user_burst: int = 5
+    guild_rate: float = 10
+    guild_burst: int = 30
+    global_rate: float = 30
+    global_burst: int = 100
+    # Max concurrent executions per command or button
+    concurrency: Dict[str, int] = {
+        "rain": 2,
+        "multitip": 2,
+        "coinflip": 10,
+        "payme": 10,
+        "donate": 5,
+        "tip": 20,
+    }
+
+
+class BotQuotas(BaseModel):
+    # Caps the super user puts on a bot hosted on the instance, None is unlimited
+    lnbits_requests: Optional[int] = None  # concurrent LNbits requests
+    interactions_per_second: Optional[float] = None
+    member_cache: Optional[int] = None  # guild members kept in memory
+    pending_views: Optional[int] = None  # messages with live buttons
+
+
+class QuotaUsage(BaseModel):
+    lnbits_requests: int
+    interactions_per_second: float
+    member_cache: int
+    pending_views: int
+    # Interactions rejected because of a quota since the bot started
+    rejected: int
+
+
+class LoopLagStats(BaseModel):
+    p50: float
+    p95: float
+    p99: float
+    max: float
+    slow_callbacks: int
+    last_slow_stack: Optional[str]
+
+
+class StatsPeriod(str, Enum):
+    # Calendar buckets in UTC, weeks start on monday
+    day = "day"
+    week = "week"
+    month = "month"
+    all = "all"
+
+
+class StatsKind(str, Enum):
+    # Per member, over all payments
+    sent = "sent"
+    received = "received"
+    # Per sender and per guild, by what the payment was for
+    tip = "tip"
+    multitip = "multitip"
+    rain = "rain"
+    coinflip = "coinflip"
+    payme = "payme"
+
+
+class TipEvent(BaseModel):
+    guild_id: Optional[str]
+    source: StatsKind
+    sender_id: str
+    receiver_id: str
+    amount: int = Field(..., gt=0)
+    time: int
+
+
+class TipEvents(BaseModel):
+    events: List[TipEvent] = Field(..., max_items=1000)
+
+
+class StatTotal(BaseModel):
+    total: int
+    count: int
+
+
+class LeaderboardEntry(StatTotal):
+    discord_id: str
+
+
+class TipStats(BaseModel):
+    period: StatsPeriod
+    bucket: str
+    # Sats and payments of the guild by source
+    guild: Dict[StatsKind, StatTotal]
+    # Sent, received and sent by source of the member, if one was asked for
+    member: Dict[StatsKind, StatTotal]
@@ -0,0 +1,137 @@
+"""
+Client of the netting journal of the discordbot extension.
+
+Micro-tips are journaled instead of paid, the extension nets them per user and
+settles the net positions with a few payments. Settlements run periodically
+while anything is journaled, and for a single user before they spend real
+funds.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import TYPE_CHECKING, Optional, Union
+
+import discord
+from httpx import HTTPStatusError, TransportError
+
+from .policy import LnbitsUnavailable
+from .scheduler import WorkClass, work_class
+from .tracing import tracer
+
+if TYPE_CHECKING:
+    from .api import LnbitsAPI
+
+_log = logging.getLogger(__name__)
+
+DiscordUser = Union[discord.Member, discord.User]
+
+
+class NettingJournal:
+    def __init__(self, api: LnbitsAPI, max_amount: int, interval: float):
+        self.api = api
+        # Tips up to this many sats are journaled, 0 disables netting
+        self.max_amount = max_amount
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_amount > 0
+
+    def accepts(self, amount: int) -> bool:
+        return self.enabled and amount <= self.max_amount
+
+    async def record(
+        self,
+        sender: DiscordUser,
+        receiver: DiscordUser,
+        amount: int,
+        memo: Optional[str],
+    ) -> bool:
+        """Journals a tip, False if the extension can't net tips"""
+        try:
+            await self.api.request(
+                "POST",
+                "/journal",
+                self.api.admin_key,
+                extension="discordbot",
+                json={
+                    "sender_id": str(sender.id),
+                    "receiver_id": str(receiver.id),
+                    "amount": amount,
+                    "memo": memo,
+                },
+            )
+        except HTTPStatusError as e:
+            # An extension version without the journal
+            if e.response.status_code == 404:
+                _log.warning("The extension can't net tips, paying them directly")
+                self.max_amount = 0
+                return False
+            raise
+        self.start()
+        return True
+
+    async def balance(self, discord_user: DiscordUser) -> Optional[int]:
+        """Wallet balance including the pending netted tips"""
+        try:
+            data = await self.api.request(
+                "GET",
+                f"/journal/balance/{discord_user.id}",
+                self.api.admin_key,
+                extension="discordbot",
+            )
+        except HTTPStatusError as e:
+            if e.response.status_code == 404:
+                return None
+            raise
+        return data["balance"]
+
+    async def settle(self, discord_user: DiscordUser = None) -> dict:
+        """Settles everyone, or only the user, returns the extension's summary"""
+        params = {"discord_id": str(discord_user.id)} if discord_user else {}
+        with tracer.span("settle_journal"):
+            result = await self.api.request(
+                "POST",
+                "/journal/settle",
+                self.api.admin_key,
+                extension="discordbot",
+                params=params,
+            )
+        if result["failed"]:
+            _log.warning("%d netting settlements failed", result["failed"])
+        return result
+
+    async def settle_user(self, discord_user: DiscordUser):
+        """Before the user spends real funds, their wallet has to be up to date"""
+        if not self.enabled:
+            return
+        try:
+            await self.settle(discord_user)
+        except (HTTPStatusError, TransportError, LnbitsUnavailable) as e:
+            _log.warning("Could not settle the tips of %s: %s", discord_user.id, e)
+
+    def start(self):
+        """
+        Settles periodically until nothing is left, also what an earlier run left.
+        Positions which can't be paid out wait for the next journaled tip.
+        """
+        if self.enabled and (not self._task or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        with work_class(WorkClass.NOTIFICATION):
+            while True:
+                await asyncio.sleep(self.interval)
+                try:
+                    result = await self.settle()
+                    if not result["unsettled"] or not result["transfers"]:
+                        return
+                except (HTTPStatusError, TransportError, LnbitsUnavailable) as e:
+                    _log.warning("Could not settle netted tips: %s", e)
+
+    def close(self):
+        # Journaled tips are stored by the extension, the next run settles them
+        if self._task:
+            self._task.cancel()
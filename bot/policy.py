@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import random
+import time
+from enum import Enum
+from typing import Optional
+
+from httpx import HTTPStatusError, TransportError
+
+# Status codes which usually mean LNbits (or a proxy in front of it) is struggling
+TRANSIENT_STATUS_CODES = {408, 429, 502, 503, 504}
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+class LnbitsUnavailable(Exception):
+    def __init__(self, retry_in: float):
+        self.retry_in = retry_in
+        super().__init__(
+            f"LNbits is currently unavailable, please try again in {int(retry_in) + 1}s"
+        )
+
+
+def is_transient(error: Exception) -> bool:
+    if isinstance(error, TransportError):
+        return True
+    if isinstance(error, HTTPStatusError):
+        return error.response.status_code in TRANSIENT_STATUS_CODES
+    return False
+
+
+class RetryPolicy:
+    def __init__(
+        self, attempts: int = 3, base_delay: float = 0.2, max_delay: float = 2
+    ):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, method: str, error: Exception, attempt: int) -> bool:
+        # Retrying payments could pay twice, so only idempotent requests are retried
+        return (
+            attempt < self.attempts
+            and method.upper() in IDEMPOTENT_METHODS
+            and is_transient(error)
+        )
+
+    def get_delay(self, attempt: int) -> float:
+        # "Full jitter" backoff, spreads out retries of concurrent requests
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+class CircuitState(str, Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Fails fast after too many consecutive transient failures.
+
+    Once opened, requests are rejected until ``reset_timeout`` passed.
+    Then a single trial request is let through, which closes the circuit again
+    on success or reopens it on failure.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_running = False
+
+    @property
+    def state(self) -> CircuitState:
+        if self.opened_at is None:
+            return CircuitState.CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return CircuitState.HALF_OPEN
+        return CircuitState.OPEN
+
+    def before_request(self):
+        state = self.state
+        if state == CircuitState.OPEN or (
+            state == CircuitState.HALF_OPEN and self.trial_running
+        ):
+            raise LnbitsUnavailable(
+                max(self.reset_timeout - (time.monotonic() - self.opened_at), 0)
+            )
+        if state == CircuitState.HALF_OPEN:
+            self.trial_running = True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_cancelled(self):
+        # The request never finished, so it doesn't tell anything about LNbits
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial_running or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.trial_running = False
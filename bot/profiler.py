@@ -0,0 +1,128 @@
+"""
+Profiles the running bot for a fixed window, without restarting it.
+
+The sampling profiler reads the stack of the event loop thread from a separate
+thread and aggregates it into collapsed stacks, which flamegraph.pl and
+speedscope understand. The deterministic profiler is cProfile, it gets exact
+call counts but slows the bot down noticeably while it runs.
+"""
+from __future__ import annotations
+
+import asyncio
+import cProfile
+import logging
+import marshal
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from enum import Enum
+
+_log = logging.getLogger(__name__)
+
+
+class ProfileMode(str, Enum):
+    SAMPLING = "sampling"
+    DETERMINISTIC = "deterministic"
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+class Profile:
+    def __init__(self, mode: ProfileMode, data: bytes, started: float):
+        self.mode = mode
+        self.data = data
+        self.started = started
+
+    @property
+    def filename(self) -> str:
+        timestamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))
+        extension = "txt" if self.mode == ProfileMode.SAMPLING else "pstats"
+        return f"discordbot-{self.mode.value}-{timestamp}.{extension}"
+
+    @property
+    def media_type(self) -> str:
+        if self.mode == ProfileMode.SAMPLING:
+            return "text/plain"
+        return "application/octet-stream"
+
+
+class Profiler:
+    def __init__(self, sample_interval: float = 0.01):
+        self.sample_interval = sample_interval
+        self.running = False
+
+    async def profile(self, duration: float, mode: ProfileMode) -> Profile:
+        """Profiles the event loop for `duration` seconds, one profile at a time"""
+        if self.running:
+            raise ProfilerBusy()
+        self.running = True
+        started = time.time()
+        try:
+            if mode == ProfileMode.SAMPLING:
+                data = await self._sample(duration)
+            else:
+                data = await self._trace(duration)
+        finally:
+            self.running = False
+        return Profile(mode, data, started)
+
+    async def _trace(self, duration: float) -> bytes:
+        # Only hooks the calling thread, which is the event loop thread
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            profile.disable()
+        profile.create_stats()
+        # Same format as Profile.dump_stats, readable with pstats.Stats(path)
+        return marshal.dumps(profile.stats)
+
+    async def _sample(self, duration: float) -> bytes:
+        stacks: Counter[str] = Counter()
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self._sampler,
+            args=(threading.get_ident(), stop, stacks),
+            name="discordbot-profiler",
+            daemon=True,
+        )
+        sampler.start()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            stop.set()
+            await asyncio.get_running_loop().run_in_executor(None, sampler.join)
+        lines = [f"{stack} {count}" for stack, count in stacks.most_common()]
+        return "\n".join(lines).encode() + b"\n"
+
+    def _sampler(self, thread_id: int, stop: threading.Event, stacks: Counter[str]):
+        while not stop.wait(self.sample_interval):
+            frame = sys._current_frames().get(thread_id)
+            names = []
+            while frame:
+                code = frame.f_code
+                filename = os.path.basename(code.co_filename)
+                names.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                stacks[";".join(reversed(names))] += 1
+
+
+profiler = Profiler()
+
+
+async def profile_to_file(folder: str, duration: float, mode: ProfileMode):
+    try:
+        profile = await profiler.profile(duration, mode)
+    except ProfilerBusy:
+        _log.warning("A profile is already being taken")
+        return
+    path = os.path.join(folder, profile.filename)
+    with open(path, "wb") as f:
+        f.write(profile.data)
+    _log.info("Wrote %s profile to %s", mode.value, path)
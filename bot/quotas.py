@@ -0,0 +1,108 @@
+"""
+Usage of the resources the quotas of a bot cap, which discord.py doesn't
+expose publicly, and the member cache quota. Guilds which would exceed it
+aren't chunked, and members cached beyond it by gateway events are evicted.
+"""
+from __future__ import annotations
+
+import logging
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+if TYPE_CHECKING:
+    from .client import LnbitsClient
+
+_log = logging.getLogger(__name__)
+
+# Commands which send a message with buttons that stay live for a while
+VIEW_INTERACTIONS = {"tip", "payme", "donate", "coinflip"}
+
+# Gateway events which add members to the cache, and where their guild id is
+MEMBER_EVENTS = {
+    "GUILD_CREATE": "id",
+    "GUILD_MEMBER_ADD": "guild_id",
+    "GUILD_MEMBER_UPDATE": "guild_id",
+    "GUILD_MEMBERS_CHUNK": "guild_id",
+    "VOICE_STATE_UPDATE": "guild_id",
+}
+
+
+def cached_members(client: LnbitsClient) -> int:
+    return sum(len(guild._members) for guild in client.guilds)
+
+
+def pending_views(client: LnbitsClient) -> int:
+    store = client._connection._view_store
+    return len(
+        {
+            id(item.view)
+            for items in store._views.values()
+            for item in items.values()
+            if item.view
+        }
+    )
+
+
+def evict_members(client: LnbitsClient, limit: int, guild_id: Optional[int]):
+    """
+    Evicts the longest cached members until the cache fits the quota, those of
+    the guild which grew first. Evicted members are fetched when needed.
+    """
+    excess = cached_members(client) - limit
+    if excess <= 0:
+        return
+    guilds = sorted(client.guilds, key=lambda guild: guild.id != guild_id)
+    for guild in guilds:
+        for member in list(guild._members.values()):
+            if excess <= 0:
+                return
+            if member.id != client._connection.self_id:
+                guild._remove_member(member)
+                excess -= 1
+
+
+def install_member_quota(client: LnbitsClient):
+    """
+    Skips chunking guilds whose members would exceed the member cache quota,
+    and evicts members cached beyond it by other events
+    """
+    state = client._connection
+    needs_chunking = state._guild_needs_chunking
+    # Guilds allowed to be chunked, counted with their full size right away
+    # because startup requests the chunks of all guilds before any arrive
+    approved: set[int] = set()
+
+    def guild_needs_chunking(guild) -> bool:
+        if not needs_chunking(guild):
+            return False
+        limit = client.admission.quotas.member_cache
+        if limit is None or guild.id in approved:
+            return True
+        used = sum(
+            (other.member_count or 0) if other.id in approved else len(other._members)
+            for other in client.guilds
+            if other.id != guild.id
+        )
+        if used + (guild.member_count or 0) > limit:
+            _log.warning(
+                "Not chunking guild %s of bot %s, it exceeds the member cache quota",
+                guild.id,
+                client.api.bot_id,
+            )
+            return False
+        approved.add(guild.id)
+        return True
+
+    state._guild_needs_chunking = guild_needs_chunking
+
+    def evicting(event: str, parse: Callable[[Any], None]) -> Callable[[Any], None]:
+        def parse_and_evict(data):
+            parse(data)
+            limit = client.admission.quotas.member_cache
+            if limit is not None:
+                guild_id = data.get(MEMBER_EVENTS[event])
+                evict_members(client, limit, int(guild_id) if guild_id else None)
+
+        return parse_and_evict
+
+    for event in MEMBER_EVENTS:
+        state.parsers[event] = evicting(event, state.parsers[event])
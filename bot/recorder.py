@@ -0,0 +1,130 @@
+"""
+Records the shape of the bot's traffic, to be replayed by ``python -m bench.replay``.
+
+Every handled interaction and every LNbits request becomes one JSON line.
+User, guild and message ids are hashed with a salt which is never written,
+string options are reduced to their length. Amounts and counts are kept, they
+decide how much work an interaction causes.
+"""
+from __future__ import annotations
+
+import hashlib
+import itertools
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+from .settings import discord_settings
+
+_log = logging.getLogger(__name__)
+
+# Option types of application commands whose values are kept
+_VALUE_TYPES = {4, 5, 10}
+_OPTION_TYPES = {3: "str", 6: "user", 7: "channel", 8: "role", 9: "mentionable"}
+
+current_interaction: ContextVar[Optional[int]] = ContextVar(
+    "current_interaction", default=None
+)
+
+
+def args_shape(data: dict) -> dict:
+    shape = {}
+    for option in data.get("options", []):
+        kind = option.get("type")
+        value = option.get("value")
+        if kind in _VALUE_TYPES:
+            shape[option["name"]] = value
+        elif kind == 3:
+            shape[option["name"]] = f"str:{len(value or '')}"
+        else:
+            shape[option["name"]] = _OPTION_TYPES.get(kind, "other")
+    return shape
+
+
+class TrafficRecorder:
+    def __init__(self, path: str = None):
+        self.path = path
+        self.file = None
+        self.started = time.time()
+        self._salt = os.urandom(16)
+        self._ids = itertools.count()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def anonymise(self, value) -> Optional[str]:
+        if value is None:
+            return None
+        return hashlib.sha256(self._salt + str(value).encode()).hexdigest()[:12]
+
+    def _offset(self) -> float:
+        return round(time.time() - self.started, 4)
+
+    def write(self, event: dict):
+        try:
+            if not self.file:
+                self.file = open(self.path, "a", buffering=1)
+                self.write({"type": "start", "at": self.started})
+            self.file.write(json.dumps(event, separators=(",", ":")) + "\n")
+        except OSError:
+            _log.warning("Could not record traffic to %s", self.path)
+
+    @contextmanager
+    def interaction(self, bot: str, name: str, interaction) -> Iterator[Optional[dict]]:
+        """Records the interaction once it is done, fill in its outcome"""
+        if not self.enabled:
+            yield None
+            return
+        guild = interaction.guild
+        message = getattr(interaction, "message", None)
+        event = {
+            "type": "interaction",
+            "id": next(self._ids),
+            "t": self._offset(),
+            "bot": bot,
+            "name": name,
+            "user": self.anonymise(interaction.user.id),
+            "guild": self.anonymise(interaction.guild_id),
+            "guild_size": getattr(guild, "member_count", None),
+            "message": self.anonymise(message.id) if message else None,
+            "args": args_shape(interaction.data or {}),
+            "outcome": "error",
+        }
+        token = current_interaction.set(event["id"])
+        start = time.perf_counter()
+        try:
+            yield event
+        finally:
+            current_interaction.reset(token)
+            event["duration"] = round(time.perf_counter() - start, 4)
+            self.write(event)
+
+    def request(
+        self, bot: str, method: str, endpoint: str, status: str, duration: float
+    ):
+        if self.enabled:
+            self.write(
+                {
+                    "type": "request",
+                    "t": self._offset(),
+                    "bot": bot,
+                    "interaction": current_interaction.get(),
+                    "method": method,
+                    "endpoint": endpoint,
+                    "status": status,
+                    "duration": round(duration, 4),
+                }
+            )
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+recorder = TrafficRecorder(discord_settings.traffic_record_file)
@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Dict, Optional
+
+
+class WorkClass(IntEnum):
+    """Kinds of work an interaction does, lower values are served first"""
+
+    # Responding to discord without touching LNbits, never waits for a slot
+    ACK = 0
+    PAYMENT = 1
+    INVOICE = 2
+    READ = 3
+    NOTIFICATION = 4
+
+
+# Which work the commands and buttons of the bot mainly do
+INTERACTION_CLASSES: Dict[str, WorkClass] = {
+    "tip": WorkClass.PAYMENT,
+    "rain": WorkClass.PAYMENT,
+    "multitip": WorkClass.PAYMENT,
+    "pay": WorkClass.PAYMENT,
+    "claim": WorkClass.PAYMENT,
+    "coinflip_flip": WorkClass.PAYMENT,
+    "payme": WorkClass.INVOICE,
+    "donate": WorkClass.INVOICE,
+    "create": WorkClass.INVOICE,
+    "balance": WorkClass.READ,
+    "history": WorkClass.READ,
+    "leaderboard": WorkClass.READ,
+    "stats": WorkClass.READ,
+    "coinflip_join": WorkClass.READ,
+    "coinflip": WorkClass.ACK,
+}
+
+current_work_class: ContextVar[WorkClass] = ContextVar(
+    "current_work_class", default=WorkClass.READ
+)
+
+
+@contextmanager
+def work_class(cls: WorkClass):
+    token = current_work_class.set(cls)
+    try:
+        yield
+    finally:
+        current_work_class.reset(token)
+
+
+class InteractionScheduler:
+    """
+    Hands out slots for LNbits requests based on the work class of the
+    interaction they are made for.
+
+    Every class has its own pool of slots, sized by its weight. When a pool
+    is exhausted the class can borrow from a shared overflow pool, which is
+    always granted to the most important waiting class first. This way a flood
+    of balance checks can never take the connections payments need.
+    """
+
+    def __init__(self, pools: Dict[str, int], shared: int, limit: int = None):
+        self.pools = {cls: pools.get(cls.name.lower(), 1) for cls in WorkClass}
+        self.shared = shared
+        # Cap on the slots of all pools together, set by the bot's quota
+        self.limit = limit
+        self.active = {cls: 0 for cls in WorkClass}
+        self.shared_active = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    def _try_acquire(self, cls: WorkClass):
+        """Returns whether a shared slot was taken, or None if nothing is free"""
+        if self.limit is not None and self.in_use() >= self.limit:
+            return None
+        if self.active[cls] < self.pools[cls]:
+            self.active[cls] += 1
+            return False
+        if self.shared_active < self.shared:
+            self.shared_active += 1
+            return True
+        return None
+
+    def _wake_waiters(self):
+        waiting = []
+        # Own pool slots can be handed to anyone, shared slots go by priority
+        for waiter in sorted(self._waiters):
+            cls, _, future = waiter
+            if future.done():
+                continue
+            shared = self._try_acquire(WorkClass(cls))
+            if shared is None:
+                waiting.append(waiter)
+            else:
+                future.set_result(shared)
+        # A sorted list is a valid heap
+        self._waiters = waiting
+
+    @asynccontextmanager
+    async def slot(self, cls: WorkClass = None):
+        cls = current_work_class.get() if cls is None else cls
+        if cls == WorkClass.ACK:
+            yield
+            return
+
+        shared = self._try_acquire(cls) if not self._waiters else None
+        if shared is None:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (cls, next(self._counter), future))
+            self._wake_waiters()
+            try:
+                shared = await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # Got a slot just before being cancelled, give it back
+                    self._release(cls, future.result())
+                raise
+        try:
+            yield
+        finally:
+            self._release(cls, shared)
+
+    def _release(self, cls: WorkClass, shared: bool):
+        if shared:
+            self.shared_active -= 1
+        else:
+            self.active[cls] -= 1
+        self._wake_waiters()
+
+    def in_use(self) -> int:
+        return sum(self.active.values()) + self.shared_active
+
+    def set_limit(self, limit: Optional[int]):
+        self.limit = limit
+        self._wake_waiters()
+
+    def stats(self) -> Dict[str, int]:
+        stats = {cls.name.lower(): self.active[cls] for cls in WorkClass}
+        stats["shared"] = self.shared_active
+        stats["waiting"] = len(self._waiters)
+        return stats
@@ -0,0 +1,131 @@
+"""
+Keeps the gateway session of a bot across restarts, so the next process can
+RESUME it instead of sending a full IDENTIFY.
+
+On shutdown the session id, sequence and resume url are written to the data
+folder and the websocket is closed with a non 1000 code, which keeps the
+session alive on discord's side for a while. If discord refuses the RESUME,
+discord.py falls back to a normal IDENTIFY by itself.
+
+A resumed session doesn't replay READY and the guilds, so the guild cache is
+rebuilt over REST and the members are chunked before the client is ready.
+discord.py has no public API for any of this, the hooks rely on its internals.
+"""
+from __future__ import annotations
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import TYPE_CHECKING, Optional
+
+import yarl
+from discord.gateway import DiscordWebSocket
+
+if TYPE_CHECKING:
+    import discord
+
+_log = logging.getLogger(__name__)
+
+_installed = False
+
+
+def _fingerprint(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()[:12]
+
+
+class GatewaySession:
+    def __init__(self, session_id: str, sequence: int, gateway: str, token: str):
+        self.session_id = session_id
+        self.sequence = sequence
+        self.gateway = gateway
+        # A fingerprint of the token, the session is useless to any other bot
+        self.token = token
+
+    def save(self, path: str):
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump({**vars(self), "saved_at": time.time()}, f)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            _log.warning("Could not save the gateway session to %s", path)
+
+    @classmethod
+    def from_client(cls, client: discord.Client) -> Optional[GatewaySession]:
+        ws = client.ws
+        if not ws or not ws.open or not ws.session_id or ws.sequence is None:
+            return None
+        token = _fingerprint(client.http.token)
+        return cls(ws.session_id, ws.sequence, str(ws.gateway), token)
+
+    @classmethod
+    def load(cls, path: str, token: str, max_age: float) -> Optional[GatewaySession]:
+        """Loads and removes the session, it can only be resumed once"""
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            os.remove(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            _log.warning("Could not load the gateway session from %s", path)
+            return None
+        if time.time() - data.pop("saved_at", 0) > max_age:
+            return None
+        session = cls(**data)
+        if session.token != _fingerprint(token):
+            return None
+        return session
+
+
+def persist_session(client: discord.Client, path: str):
+    """Saves the session and keeps it resumable when the client closes next"""
+    session = GatewaySession.from_client(client)
+    if not session:
+        return
+    session.save(path)
+    ws = client.ws
+    close = ws.close
+    # Client.close closes with 1000 which ends the session, any other code keeps it
+    ws.close = lambda code=4000: close(code=4000)
+
+
+def install_resume():
+    """Makes the first connection of a client resume its ``resume_session``"""
+    global _installed
+    if _installed:
+        return
+    from_client = DiscordWebSocket.from_client.__func__
+
+    @functools.wraps(from_client)
+    async def resuming_from_client(cls, client, **kwargs):
+        session: Optional[GatewaySession] = getattr(client, "resume_session", None)
+        if session and kwargs.get("initial"):
+            client.resume_session = None
+            kwargs.update(
+                resume=True,
+                session=session.session_id,
+                sequence=session.sequence,
+                gateway=yarl.URL(session.gateway),
+            )
+            _log.info("Resuming gateway session %s", session.session_id)
+        return await from_client(cls, client, **kwargs)
+
+    DiscordWebSocket.from_client = classmethod(resuming_from_client)
+    _installed = True
+
+
+async def rebuild_guilds(client: discord.Client):
+    """Fills the cache READY would have filled, then marks the client ready"""
+    state = client._connection
+    async for partial in client.fetch_guilds(limit=None):
+        data = await client.http.get_guild(partial.id, with_counts=True)
+        data["channels"] = await client.http.get_all_guild_channels(partial.id)
+        data["member_count"] = data.get("approximate_member_count")
+        guild = state._add_guild_from_data(data)
+        if state._guild_needs_chunking(guild):
+            await guild.chunk()
+    state.call_handlers("ready")
+    client.dispatch("ready")
@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional
 
 from pydantic import BaseSettings, Extra, HttpUrl
 
@@ -7,6 +7,89 @@ from pydantic import BaseSettings, Extra, HttpUrl
 class DiscordSettings(BaseSettings):
     discord_dev_guild: Optional[int] = None
 
+    # Remembered keys of processed one-shot operations (paid invoices, claimed lnurls)
+    idempotency_cache_size: int = 10_000
+    idempotency_persist: bool = False
+
+    # Seconds a fetched wallet balance can be used for pre-checking payments
+    balance_cache_ttl: float = 15
+
+    # Seconds a viewed /history page is reused when paging back and forth
+    history_cache_ttl: float = 60
+
+    # Recipients of a single /multitip and how many of them are paid at a time
+    multitip_max_recipients: int = 50
+    multitip_concurrency: int = 5
+
+    # Feed settled payments into the leaderboards of the extension, in batches
+    # sent every this many seconds
+    tip_stats: bool = True
+    tip_stats_flush_interval: float = 10
+
+    # Tips up to this many sats are journaled by the extension and paid out netted,
+    # every this many seconds or when a user spends real funds. 0 disables netting
+    netting_max_amount: int = 0
+    netting_settle_interval: float = 60
+
+    # Seconds until an open coinflip is flipped and a /donate link is retired,
+    # 0 keeps them open. Invoices of /payme are retired when they expire
+    coinflip_auto_flip: float = 600
+    donate_expiry: float = 86400
+
+    # Wallets bulk loaded into the cache after startup, the users active before the
+    # restart first. 0 disables prewarming and remembering the active users
+    wallet_prewarm_limit: int = 5000
+    wallet_prewarm_timeout: float = 60
+
+    # Connection pool and timeouts of the LNbits http client
+    lnbits_max_connections: int = 100
+    lnbits_max_keepalive_connections: int = 20
+    lnbits_keepalive_expiry: float = 5.0
+    lnbits_http2: bool = False
+    lnbits_timeout: float = 10.0
+    lnbits_connect_timeout: float = 5.0
+    lnbits_pool_timeout: float = 5.0
+    # Read timeouts per endpoint, keyed by "METHOD /path" or "/path" (prefix match)
+    lnbits_endpoint_timeouts: Dict[str, float] = {"POST /payments": 60.0}
+
+    # Retries of idempotent requests and the circuit breaker in front of LNbits
+    lnbits_retry_attempts: int = 3
+    lnbits_retry_base_delay: float = 0.2
+    lnbits_retry_max_delay: float = 2.0
+    lnbits_breaker_threshold: int = 5
+    lnbits_breaker_reset_timeout: float = 30.0
+
+    # Concurrent LNbits requests of a bot per work class, plus a shared overflow pool
+    lnbits_request_pools: Dict[str, int] = {
+        "payment": 8,
+        "invoice": 4,
+        "read": 4,
+        "notification": 2,
+    }
+    lnbits_request_shared_pool: int = 4
+
+    # Share of interactions which are traced, exported to a JSON lines file and/or
+    # an OTLP/HTTP collector, e.g. http://localhost:4318/v1/traces
+    tracing_sample_rate: float = 0
+    tracing_file: Optional[str] = None
+    tracing_otlp_endpoint: Optional[str] = None
+
+    # Seconds running interactions (payments) get to finish when the bot shuts down
+    shutdown_drain_timeout: float = 20
+
+    # Resume the gateway session after a restart instead of identifying again,
+    # if the restart took at most this many seconds
+    gateway_resume: bool = False
+    gateway_resume_max_age: float = 120
+
+    # Record anonymised interactions and LNbits requests for bench/replay.py
+    traffic_record_file: Optional[str] = None
+
+    # Seconds the event loop may be blocked before it is reported / dumped
+    watchdog_slow_threshold: float = 0.1
+    watchdog_critical_threshold: float = 1.0
+    watchdog_dump_interval: float = 300
+
     class Config:
         env_file = ".env"
         case_sensitive = False
@@ -18,6 +101,11 @@ class StandaloneSettings(DiscordSettings):
     lnbits_admin_key: str
     discord_bot_token: Optional[str] = None
     data_folder: Optional[Path] = "/data"
+    # Serve prometheus metrics on http://<metrics_host>:<metrics_port>/metrics
+    metrics_port: Optional[int] = None
+    metrics_host: str = "127.0.0.1"
+    # SIGUSR1 writes a sampling, SIGUSR2 a cProfile profile into the data folder
+    profile_duration: float = 30
 
 
 discord_settings = DiscordSettings()
@@ -0,0 +1,101 @@
+"""
+Feeds settled payments into the tipping statistics of the discordbot extension.
+
+Payments are buffered and sent in batches by one background task, so settling
+a payment never waits for the statistics.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING, List, Optional, Union
+
+import discord
+from httpx import HTTPStatusError, TransportError
+
+from .models import StatsKind, TipEvent
+from .policy import LnbitsUnavailable
+from .scheduler import WorkClass, work_class
+
+if TYPE_CHECKING:
+    from .api import LnbitsAPI
+
+_log = logging.getLogger(__name__)
+
+DiscordUser = Union[discord.Member, discord.User]
+
+# Events per request, and how many are kept while the extension is unreachable
+BATCH_SIZE = 1000
+MAX_BUFFERED = 50_000
+
+
+class TipStatsRecorder:
+    def __init__(self, api: LnbitsAPI, interval: float, enabled: bool = True):
+        self.api = api
+        self.interval = interval
+        self.enabled = enabled
+        self.events: List[TipEvent] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def record(
+        self,
+        source: StatsKind,
+        sender: DiscordUser,
+        receiver: DiscordUser,
+        amount: int,
+    ):
+        if not self.enabled or amount <= 0:
+            return
+        guild = getattr(sender, "guild", None)
+        self.events.append(
+            TipEvent(
+                guild_id=str(guild.id) if guild else None,
+                source=source,
+                sender_id=str(sender.id),
+                receiver_id=str(receiver.id),
+                amount=amount,
+                time=int(time.time()),
+            )
+        )
+        if len(self.events) > MAX_BUFFERED:
+            del self.events[: len(self.events) - MAX_BUFFERED]
+        if not self._task or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def flush(self):
+        with work_class(WorkClass.NOTIFICATION):
+            while self.events and self.enabled:
+                batch = self.events[:BATCH_SIZE]
+                try:
+                    await self.api.request(
+                        "POST",
+                        "/stats/events",
+                        self.api.admin_key,
+                        extension="discordbot",
+                        json={"events": [event.dict() for event in batch]},
+                    )
+                except HTTPStatusError as e:
+                    if e.response.status_code == 404:
+                        # An extension version without statistics
+                        self.enabled = False
+                        self.events.clear()
+                        return
+                    raise
+                del self.events[: len(batch)]
+
+    async def _run(self):
+        while self.events and self.enabled:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except (HTTPStatusError, TransportError, LnbitsUnavailable) as e:
+                _log.warning("Could not send tipping statistics: %s", e)
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        try:
+            await self.flush()
+        except (HTTPStatusError, TransportError, LnbitsUnavailable) as e:
+            _log.warning("Dropped %d tipping statistics: %s", len(self.events), e)
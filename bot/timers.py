@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+_log = logging.getLogger(__name__)
+
+TimerCallback = Callable[[], Awaitable[None]]
+
+
+class Deadline:
+    __slots__ = ("when", "callback", "cancelled", "_scheduler")
+
+    def __init__(
+        self, when: float, callback: TimerCallback, scheduler: DeadlineScheduler
+    ):
+        self.when = when
+        self.callback: Optional[TimerCallback] = callback
+        self.cancelled = False
+        # Unset once the deadline left the scheduler's heap
+        self._scheduler: Optional[DeadlineScheduler] = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        # The callback holds on to views and messages, they don't have to wait
+        # in the heap until the deadline would have come
+        self.callback = None
+        if self._scheduler:
+            self._scheduler._cancelled()
+
+
+class DeadlineScheduler:
+    """
+    Runs callbacks at wall clock deadlines (unix timestamps).
+
+    All deadlines are kept in a single heap and served by one task,
+    so pending deadlines don't cost a sleeping coroutine each. Due callbacks
+    run in their own task, a slow one doesn't hold up the others.
+
+    Cancelled deadlines are dropped when they come up, or all at once when they
+    make up most of the heap.
+    """
+
+    # Smaller heaps aren't compacted, popping their cancelled deadlines is cheap
+    COMPACT_MIN_SIZE = 64
+
+    def __init__(self):
+        self._heap: list[tuple[float, int, Deadline]] = []
+        self._counter = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._cancelled_count = 0
+        # Callbacks which are running right now
+        self.running: set[asyncio.Task] = set()
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled_count
+
+    def schedule(self, when: float, callback: TimerCallback) -> Deadline:
+        deadline = Deadline(when, callback, self)
+        heapq.heappush(self._heap, (when, next(self._counter), deadline))
+        if not self._task or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        elif self._heap[0][2] is deadline:
+            # New earliest deadline, the runner has to re-evaluate its sleep
+            self._wakeup.set()
+        return deadline
+
+    def _cancelled(self):
+        self._cancelled_count += 1
+        size = len(self._heap)
+        if size >= self.COMPACT_MIN_SIZE and self._cancelled_count * 2 > size:
+            self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled_count = 0
+            # The earliest deadline might be gone
+            if self._wakeup:
+                self._wakeup.set()
+
+    def _pop(self) -> Deadline:
+        deadline = heapq.heappop(self._heap)[2]
+        deadline._scheduler = None
+        if deadline.cancelled:
+            self._cancelled_count -= 1
+        return deadline
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+        for _, _, deadline in self._heap:
+            deadline._scheduler = None
+        self._heap.clear()
+        self._cancelled_count = 0
+
+    async def _run(self):
+        while self._heap:
+            when, _, deadline = self._heap[0]
+            delay = when - time.time()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._pop()
+            if deadline.cancelled:
+                continue
+            task = asyncio.create_task(self._fire(deadline))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    @staticmethod
+    async def _fire(deadline: Deadline):
+        callback, deadline.callback = deadline.callback, None
+        try:
+            await callback()
+        except Exception:
+            _log.exception("Error in scheduled callback")
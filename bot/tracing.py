@@ -0,0 +1,264 @@
+"""
+Lightweight tracing: one span tree per interaction, with a child span for every
+LNbits request and discord REST call made while handling it.
+
+Finished spans are exported as JSON lines to a local file and/or as OTLP/HTTP
+JSON to a local collector. Sampling is decided once per trace.
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, List, Optional
+
+import httpx
+
+from .settings import discord_settings
+
+_log = logging.getLogger(__name__)
+
+
+class Span:
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "name",
+        "start_ns",
+        "end_ns",
+        "attributes",
+        "error",
+    )
+
+    def __init__(
+        self, name: str, trace_id: str, parent_id: Optional[str], attributes: dict
+    ):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start_ns / 1e9,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [
+                {"key": key, "value": {"stringValue": str(value)}}
+                for key, value in self.attributes.items()
+            ],
+            "status": {"code": 2, "message": self.error} if self.error else {},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class JsonLinesExporter:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+
+    def export(self, span: Span):
+        try:
+            if not self.file:
+                self.file = open(self.path, "a", buffering=1)
+            self.file.write(json.dumps(span.to_dict(), default=str) + "\n")
+        except OSError:
+            _log.warning("Could not write span to %s", self.path)
+
+    async def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class OtlpExporter:
+    """Sends spans in batches to an OTLP/HTTP collector (JSON encoding)"""
+
+    def __init__(self, endpoint: str, batch_size: int = 100, interval: float = 2):
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue: List[Span] = []
+        self.http: Optional[httpx.AsyncClient] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def export(self, span: Span):
+        # Spans pile up while the collector is unreachable, drop the oldest ones
+        if len(self.queue) >= self.batch_size * 10:
+            self.queue.pop(0)
+        self.queue.append(span)
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self.queue:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        while self.queue:
+            batch = self.queue[: self.batch_size]
+            del self.queue[: self.batch_size]
+            if not self.http:
+                self.http = httpx.AsyncClient(timeout=5)
+            body = {
+                "resourceSpans": [
+                    {
+                        "resource": {
+                            "attributes": [
+                                {
+                                    "key": "service.name",
+                                    "value": {"stringValue": "discordbot"},
+                                }
+                            ]
+                        },
+                        "scopeSpans": [
+                            {
+                                "scope": {"name": "discordbot"},
+                                "spans": [span.to_otlp() for span in batch],
+                            }
+                        ],
+                    }
+                ]
+            }
+            try:
+                response = await self.http.post(self.endpoint, json=body)
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                _log.warning("Could not export %s spans: %s", len(batch), e)
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        await self.flush()
+        if self.http:
+            await self.http.aclose()
+
+
+class Tracer:
+    def __init__(self, sample_rate: float = 0, exporters: list = None):
+        self.sample_rate = sample_rate
+        self.exporters = exporters or []
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.exporters) and self.sample_rate > 0
+
+    @contextmanager
+    def start_trace(self, name: str, **attributes) -> Iterator[Optional[Span]]:
+        """Starts a new trace, which is sampled (or not) as a whole"""
+        if not self.enabled or random.random() >= self.sample_rate:
+            token = current_span.set(None)
+            try:
+                yield None
+            finally:
+                current_span.reset(token)
+            return
+        with self._span(name, os.urandom(16).hex(), None, attributes) as span:
+            yield span
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Optional[Span]]:
+        """Starts a child span of the current span, if the current trace is sampled"""
+        parent = current_span.get()
+        if not parent:
+            yield None
+            return
+        with self._span(name, parent.trace_id, parent.span_id, attributes) as span:
+            yield span
+
+    @contextmanager
+    def _span(self, name: str, trace_id: str, parent_id: Optional[str], attributes):
+        span = Span(name, trace_id, parent_id, attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            current_span.reset(token)
+            for exporter in self.exporters:
+                exporter.export(span)
+
+    async def close(self):
+        for exporter in self.exporters:
+            await exporter.close()
+
+
+def create_tracer() -> Tracer:
+    exporters = []
+    if discord_settings.tracing_file:
+        exporters.append(JsonLinesExporter(discord_settings.tracing_file))
+    if discord_settings.tracing_otlp_endpoint:
+        exporters.append(OtlpExporter(discord_settings.tracing_otlp_endpoint))
+    return Tracer(discord_settings.tracing_sample_rate, exporters)
+
+
+tracer = create_tracer()
+
+
+def _traced_discord_request(func):
+    @functools.wraps(func)
+    async def wrapper(self, route, *args, **kwargs):
+        if not current_span.get():
+            return await func(self, route, *args, **kwargs)
+        with tracer.span(f"discord {route.method} {route.path}"):
+            return await func(self, route, *args, **kwargs)
+
+    return wrapper
+
+
+_instrumented = False
+
+
+def instrument_discord():
+    """
+    Wraps the REST clients of discord.py, so their calls show up as spans.
+    Interaction responses go through the webhook adapter, everything else
+    (DMs, message edits) through the client's http.
+    """
+    global _instrumented
+    if _instrumented:
+        return
+    from discord.http import HTTPClient
+    from discord.webhook.async_ import AsyncWebhookAdapter
+
+    HTTPClient.request = _traced_discord_request(HTTPClient.request)
+    AsyncWebhookAdapter.request = _traced_discord_request(AsyncWebhookAdapter.request)
+    _instrumented = True
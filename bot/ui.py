@@ -1,15 +1,34 @@
 from __future__ import annotations
 
+import functools
+import logging
 import random
-from typing import TYPE_CHECKING, Optional
+import time
+from typing import TYPE_CHECKING, Awaitable, Callable, Optional
 
 import discord
-from httpx import HTTPStatusError
+from httpx import HTTPStatusError, TransportError
 
 if TYPE_CHECKING:
-    from .client import LnbitsInteraction
+    from .client import LnbitsClient, LnbitsInteraction
 
-from .models import Wallet
+from .bolt11 import Invoice
+from .idempotency import DuplicateOperation
+from .models import HistoryEntry, HistoryPage, StatsKind, Wallet
+from .policy import LnbitsUnavailable
+from .scheduler import WorkClass, work_class
+from .timers import Deadline, DeadlineScheduler, TimerCallback
+
+_log = logging.getLogger(__name__)
+
+HISTORY_PAGE_SIZE = 10
+
+# Expiry of invoices which can't be decoded, LNbits' default
+DEFAULT_INVOICE_EXPIRY = 3600
+
+# Seconds between attempts to delete an expired donation link, and how often
+RETIRE_RETRY = 300
+RETIRE_ATTEMPTS = 12
 
 
 def get_amount_str(sats: int):
@@ -17,6 +36,70 @@ def get_amount_str(sats: int):
     return f"{sats} Satoshis / ฿{btc}"
 
 
+async def send_error(interaction: LnbitsInteraction, content: str):
+    if interaction.response.is_done():
+        await interaction.followup.send(content=content, ephemeral=True)
+    else:
+        await interaction.response.send_message(content=content, ephemeral=True)
+
+
+class LnbitsView(discord.ui.View):
+    deadline: Optional[Deadline] = None
+
+    def schedule(
+        self,
+        timers: DeadlineScheduler,
+        when: float,
+        callback: TimerCallback,
+        stop: bool = True,
+    ):
+        """
+        Runs ``callback`` at ``when`` and stops the view, unless ``stop`` is False
+        and the callback does that itself. Views which do this are created without
+        a timeout, their deadlines share the scheduler's single task instead of
+        one timeout task per view.
+        """
+
+        async def run():
+            if self.is_finished():
+                return
+            if stop:
+                self.stop()
+            await callback()
+
+        self.deadline = timers.schedule(when, run)
+
+    def finish(self):
+        """Stops the view once it is done, before its deadline"""
+        if self.deadline:
+            self.deadline.cancel()
+        self.stop()
+
+    async def _scheduled_task(
+        self, item: discord.ui.Item, interaction: LnbitsInteraction
+    ):
+        # Every component interaction passes through here (private in discord.py),
+        # hook it into the client's interaction pipeline
+        name = getattr(item, "interaction_name", type(item).__name__)
+        await interaction.client.run_interaction(
+            name,
+            interaction,
+            functools.partial(super()._scheduled_task, item, interaction),
+        )
+
+    async def on_error(
+        self,
+        interaction: LnbitsInteraction,
+        error: Exception,
+        item: discord.ui.Item,
+    ):
+        interaction.extras["failed"] = True
+        if isinstance(error, LnbitsUnavailable):
+            await send_error(interaction, str(error))
+        else:
+            await super().on_error(interaction, error, item)
+
+
 class WalletButton(discord.ui.Button):
     def __init__(self, base_url: str, wallet: Wallet):
         walletURL = base_url + f"wallet?usr={wallet.user}&wal={wallet.id}"
@@ -29,6 +112,8 @@ class WalletButton(discord.ui.Button):
 
 
 class TipButton(discord.ui.Button):
+    interaction_name = "tip"
+
     def __init__(self, amount: int, receiver: discord.Member):
         super().__init__(style=discord.ButtonStyle.primary, label="Repeat", emoji="💸")
         self.receiver = receiver
@@ -59,7 +144,7 @@ class TipButton(discord.ui.Button):
             embed.add_field(name="Memo", value=memo)
 
         await interaction.response.send_message(
-            embed=embed, view=discord.ui.View().add_item(cls(amount, member))
+            embed=embed, view=LnbitsView().add_item(cls(amount, member))
         )
 
         await interaction.client.try_send_payment_notification(
@@ -72,10 +157,19 @@ class TipButton(discord.ui.Button):
                 ephemeral=True, content="You cant pay yourself"
             )
         else:
-            await self.execute(interaction, self.receiver, self.amount)
+            # Repeating is fine, but only one tip per user and message at a time
+            try:
+                await interaction.client.idempotency.run(
+                    f"tip:{interaction.message.id}:{interaction.user.id}",
+                    lambda: self.execute(interaction, self.receiver, self.amount),
+                )
+            except DuplicateOperation as e:
+                await interaction.response.send_message(ephemeral=True, content=str(e))
 
 
 class PayButton(discord.ui.Button):
+    interaction_name = "pay"
+
     def __init__(
         self,
         payment_request: str,
@@ -83,6 +177,7 @@ class PayButton(discord.ui.Button):
         receiver_wallet: Wallet,
         amount: int,
         description: str,
+        invoice: Optional[Invoice] = None,
     ):
         super().__init__(style=discord.ButtonStyle.primary, label="Pay Now", emoji="💸")
         self.payment_request = payment_request
@@ -90,6 +185,45 @@ class PayButton(discord.ui.Button):
         self.receiver_wallet = receiver_wallet
         self.price = amount
         self.description = description
+        self.invoice = invoice
+
+    def schedule_expiry(
+        self, timers: DeadlineScheduler, message: discord.PartialMessage
+    ):
+        if self.invoice:
+            expires_at = self.invoice.expires_at
+        else:
+            expires_at = time.time() + DEFAULT_INVOICE_EXPIRY
+
+        async def expire():
+            await message.edit(embed=self.expired_embed(), view=None, attachments=[])
+
+        self.view.schedule(timers, expires_at, expire)
+
+    def expired_embed(self):
+        return (
+            discord.Embed(
+                title="Pay Me!",
+                description="This invoice has expired",
+                color=discord.Color.light_grey(),
+            )
+            .add_field(name="Amount", value=get_amount_str(self.price))
+            .add_field(name="Description", value=self.description)
+        )
+
+    def validate(self, interaction: LnbitsInteraction) -> Optional[str]:
+        if self.invoice:
+            if self.invoice.is_expired():
+                return "This invoice has expired"
+            if self.invoice.amount_sat not in (None, self.price):
+                return "The invoice amount does not match the requested amount"
+        balance = interaction.client.api.get_cached_balance(interaction.user)
+        if balance is not None and balance < self.price:
+            return "You do not have enough balance"
+
+    @property
+    def idempotency_key(self):
+        return f"pay:{self.payment_request}"
 
     async def callback(self, interaction: LnbitsInteraction):
         if interaction.user == self.receiver:
@@ -98,8 +232,34 @@ class PayButton(discord.ui.Button):
             )
             return
 
+        if self.invoice and self.invoice.is_expired():
+            self.view.finish()
+            await interaction.response.edit_message(
+                embed=self.expired_embed(), view=None, attachments=[]
+            )
+            return
+
+        error = self.validate(interaction)
+        if error:
+            await interaction.response.send_message(ephemeral=True, content=error)
+            return
+
+        try:
+            await interaction.client.idempotency.run(
+                self.idempotency_key, lambda: self.pay(interaction)
+            )
+        except DuplicateOperation as e:
+            await interaction.response.send_message(ephemeral=True, content=str(e))
+
+    async def pay(self, interaction: LnbitsInteraction):
         wallet = await interaction.client.api.get_user_wallet(interaction.user)
+        if not wallet:
+            await interaction.response.send_message(
+                ephemeral=True, content="You do not have a wallet yet, use /create"
+            )
+            return
 
+        await interaction.client.api.journal.settle_user(interaction.user)
         # await api_payments_pay_invoice(self.payment_request, wallet)
         await interaction.client.api.request(
             "POST",
@@ -110,6 +270,12 @@ class PayButton(discord.ui.Button):
                 "bolt11": self.payment_request,
             },
         )
+        interaction.client.idempotency.mark_done(self.idempotency_key)
+        interaction.client.api.invalidate_balance(wallet, self.receiver_wallet)
+        interaction.client.api.stats.record(
+            StatsKind.payme, interaction.user, self.receiver, self.price
+        )
+        self.view.finish()
 
         await interaction.response.edit_message(
             embed=discord.Embed(
@@ -129,11 +295,83 @@ class PayButton(discord.ui.Button):
 
 
 class ClaimButton(discord.ui.Button):
-    def __init__(self, lnurl: str):
+    interaction_name = "claim"
+
+    def __init__(self, lnurl: str, link_id: str = None, wallet: Wallet = None):
         super().__init__(style=discord.ButtonStyle.primary, label="Claim", emoji="💸")
         self.lnurl = lnurl
+        # The withdraw link and the wallet it pays from, to delete it once retired
+        self.link_id = link_id
+        self.wallet = wallet
+
+    def schedule_retirement(
+        self,
+        client: LnbitsClient,
+        message: discord.PartialMessage,
+        when: float,
+    ):
+        attempts = 0
+
+        async def retire():
+            nonlocal attempts
+            attempts += 1
+            if self.link_id and self.wallet:
+                try:
+                    await client.api.request(
+                        "DELETE",
+                        f"/links/{self.link_id}",
+                        self.wallet.adminkey,
+                        extension="withdraw",
+                    )
+                except HTTPStatusError as e:
+                    # Already claimed or deleted otherwise
+                    if e.response.status_code != 404:
+                        retry(e)
+                        return
+                except (TransportError, LnbitsUnavailable) as e:
+                    retry(e)
+                    return
+            self.view.stop()
+            await message.edit(
+                view=LnbitsView().add_item(
+                    discord.ui.Button(
+                        style=discord.ButtonStyle.secondary,
+                        label="Expired",
+                        emoji="⌛",
+                        disabled=True,
+                    )
+                )
+            )
+
+        def retry(error: Exception):
+            # The link can still be claimed, the button keeps working until it's gone
+            if attempts < RETIRE_ATTEMPTS:
+                _log.warning(
+                    "Could not delete donation link %s, retrying: %s",
+                    self.link_id,
+                    error,
+                )
+                self.view.schedule(
+                    client.timers, time.time() + RETIRE_RETRY, retire, stop=False
+                )
+            else:
+                _log.error("Gave up deleting donation link %s: %s", self.link_id, error)
+
+        self.view.schedule(client.timers, when, retire, stop=False)
+
+    @property
+    def idempotency_key(self):
+        return f"claim:{self.lnurl}"
 
     async def callback(self, interaction: LnbitsInteraction):
+        try:
+            await interaction.client.idempotency.run(
+                self.idempotency_key, lambda: self.claim(interaction)
+            )
+        except DuplicateOperation as e:
+            await interaction.response.send_message(ephemeral=True, content=str(e))
+
+    async def claim(self, interaction: LnbitsInteraction):
         wallet = await interaction.client.api.get_user_wallet(interaction.user)
 
         lnurl_parts = await interaction.client.api.request(
@@ -143,6 +381,7 @@ class ClaimButton(discord.ui.Button):
         await interaction.client.api.request(
             method="post",
             path="/payments",
+            key=wallet.adminkey,
             json={
                 "lnurl_callback": lnurl_parts["callback"],
                 "amount": (lnurl_parts["maxWithdrawable"]) / 1000,
@@ -151,9 +390,11 @@ class ClaimButton(discord.ui.Button):
                 "unit": "sat",
             },
         )
+        interaction.client.idempotency.mark_done(self.idempotency_key)
+        self.view.finish()
 
         await interaction.response.edit_message(
-            view=discord.ui.View().add_item(
+            view=LnbitsView().add_item(
                 discord.ui.Button(
                     style=discord.ButtonStyle.primary,
                     label=f"Claimed by {interaction.user.display_name}",
@@ -167,6 +408,7 @@ class ClaimButton(discord.ui.Button):
 
 class CoinFlipJoinButton(discord.ui.Button):
     view: CoinFlipView
+    interaction_name = "coinflip_join"
 
     def __init__(self):
         super().__init__(style=discord.ButtonStyle.primary, label="Join", emoji="💸")
@@ -185,6 +427,7 @@ class CoinFlipJoinButton(discord.ui.Button):
 
 class CoinFlipFinishButton(discord.ui.Button):
     view: CoinFlipView
+    interaction_name = "coinflip_flip"
 
     def __init__(self):
         super().__init__(style=discord.ButtonStyle.secondary, label="Flip", emoji="🪙")
@@ -196,64 +439,31 @@ class CoinFlipFinishButton(discord.ui.Button):
             )
             return
 
-        winner = self.view.winner = random.choice(self.view.entries)
-        entries_unique = set(self.view.entries)
-
-        if len(entries_unique) > 1:
-            await interaction.response.edit_message(view=None)
-
-            sent = 0
-            for entry in entries_unique:
-                if entry != winner:
-                    try:
-                        amount = self.view.stake(entry)
-                        winner_wallet = await interaction.client.api.send_payment(
-                            entry, winner, amount, self.view.description
-                        )
-                        sent += amount
-                    except HTTPStatusError:
-                        continue
-
-            await interaction.followup.send(
-                embed=discord.Embed(
-                    title=f"And the winner is {winner.display_name}!",
-                    color=discord.Color.yellow(),
+        if len(set(self.view.entries)) > 1:
+            if self.view.is_finished():
+                await interaction.response.send_message(
+                    "The coin was flipped already", ephemeral=True
                 )
+                return
+            self.view.finish()
+            await interaction.response.edit_message(view=None)
+            message = await interaction.original_response()
+            await self.view.flip(
+                interaction.client, message.jump_url, interaction.followup.send
             )
 
-            winner_wallet = await interaction.client.api.get_user_wallet(winner)
-            winner_balance = await interaction.client.api.get_user_balance(winner)
-
-            embed = discord.Embed(
-                title="New Payment",
-                color=discord.Color.yellow(),
-                description=f"You won **{get_amount_str(sent)}** from a coinflip!\n\n"
-                f"The flip happened [here]({(await interaction.original_response()).jump_url})",
-            ).add_field(name="New Balance", value=get_amount_str(winner_balance))
-
-            try:
-                await winner.send(
-                    embed=embed,
-                    view=discord.ui.View().add_item(
-                        WalletButton(
-                            interaction.client.lnbits_url, wallet=winner_wallet
-                        )
-                    ),
-                )
-            except discord.HTTPException:
-                pass
-
         else:
             await interaction.response.send_message(
                 "You are the only participant", ephemeral=True
             )
 
 
-class CoinFlipView(discord.ui.View):
+class CoinFlipView(LnbitsView):
     def __init__(
         self, initiator: discord.Member | discord.User, entry: int, description: str
     ):
-        super().__init__()
+        # Flipped automatically instead of timing out, see schedule_auto_flip
+        super().__init__(timeout=None)
         self.add_item(CoinFlipJoinButton())
         self.add_item(CoinFlipFinishButton())
         self.price = entry
@@ -265,6 +475,75 @@ class CoinFlipView(discord.ui.View):
     def stake(self, member: discord.Member):
         return self.entries.count(member) * self.price
 
+    def schedule_auto_flip(
+        self, client: LnbitsClient, message: discord.PartialMessage, when: float
+    ):
+        async def auto_flip():
+            if len(set(self.entries)) > 1:
+                await message.edit(view=None)
+                with work_class(WorkClass.PAYMENT):
+                    await self.flip(client, message.jump_url, message.channel.send)
+            else:
+                await message.edit(
+                    embed=self.get_current_embed().set_footer(text="Nobody joined"),
+                    view=None,
+                )
+
+        self.schedule(client.timers, when, auto_flip)
+
+    async def flip(
+        self,
+        client: LnbitsClient,
+        jump_url: str,
+        send: Callable[..., Awaitable[object]],
+    ):
+        """Pays the stakes to a random winner, the view has to be finished"""
+        winner = self.winner = random.choice(self.entries)
+
+        sent = 0
+        for entry in set(self.entries):
+            if entry != winner:
+                try:
+                    amount = self.stake(entry)
+                    winner_wallet = await client.api.send_payment(
+                        entry,
+                        winner,
+                        amount,
+                        self.description,
+                        source=StatsKind.coinflip,
+                    )
+                    sent += amount
+                except HTTPStatusError:
+                    continue
+
+        await send(
+            embed=discord.Embed(
+                title=f"And the winner is {winner.display_name}!",
+                color=discord.Color.yellow(),
+            )
+        )
+
+        with work_class(WorkClass.NOTIFICATION):
+            winner_wallet = await client.api.get_user_wallet(winner)
+            winner_balance = await client.api.get_user_balance(winner)
+
+        embed = discord.Embed(
+            title="New Payment",
+            color=discord.Color.yellow(),
+            description=f"You won **{get_amount_str(sent)}** from a coinflip!\n\n"
+            f"The flip happened [here]({jump_url})",
+        ).add_field(name="New Balance", value=get_amount_str(winner_balance))
+
+        try:
+            await winner.send(
+                embed=embed,
+                view=LnbitsView().add_item(
+                    WalletButton(client.lnbits_url, wallet=winner_wallet)
+                ),
+            )
+        except discord.HTTPException:
+            pass
+
     def get_current_embed(self):
         embed = discord.Embed(
             title="Coinflip :coin:",
@@ -281,3 +560,64 @@ class CoinFlipView(discord.ui.View):
             entries_str += "\n"
         embed.add_field(name="Entries", value=entries_str)
         return embed
+
+
+class HistoryButton(discord.ui.Button):
+    view: HistoryView
+    interaction_name = "history"
+
+    def __init__(self, step: int, label: str, emoji: str):
+        super().__init__(style=discord.ButtonStyle.secondary, label=label, emoji=emoji)
+        self.step = step
+
+    async def callback(self, interaction: LnbitsInteraction):
+        offset = self.view.page.offset + self.step * HISTORY_PAGE_SIZE
+        page = await interaction.client.api.get_history(
+            interaction.user, max(offset, 0), HISTORY_PAGE_SIZE
+        )
+        if not page:
+            await interaction.response.edit_message(
+                content="You do not have a wallet yet, use /create",
+                embed=None,
+                view=None,
+            )
+            return
+        self.view.set_page(page)
+        await interaction.response.edit_message(
+            embed=self.view.get_embed(), view=self.view
+        )
+
+
+class HistoryView(LnbitsView):
+    def __init__(self, page: HistoryPage):
+        super().__init__()
+        self.previous = HistoryButton(-1, label="Newer", emoji="⬅️")
+        self.next = HistoryButton(1, label="Older", emoji="➡️")
+        self.add_item(self.previous)
+        self.add_item(self.next)
+        self.set_page(page)
+
+    def set_page(self, page: HistoryPage):
+        self.page = page
+        self.previous.disabled = page.offset == 0
+        self.next.disabled = not page.has_next
+
+    @staticmethod
+    def describe(entry: HistoryEntry) -> str:
+        line = f"**{entry.amount:+} sats** <t:{entry.time}:R>"
+        if entry.counterparty:
+            direction = "to" if entry.amount < 0 else "from"
+            line += f" {direction} <@{entry.counterparty}>"
+        if entry.memo:
+            line += f"\n_{entry.memo}_"
+        if entry.pending:
+            line = "⏳ " + line
+        return line
+
+    def get_embed(self):
+        return discord.Embed(
+            title="Payment History",
+            color=discord.Color.yellow(),
+            description="\n".join(map(self.describe, self.page.entries))
+            or "No payments yet",
+        ).set_footer(text=f"Page {self.page.offset // HISTORY_PAGE_SIZE + 1}")
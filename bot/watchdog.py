@@ -0,0 +1,167 @@
+"""
+Watches the event loop for callbacks which block it.
+
+A heartbeat task measures how late the loop wakes it up. A separate thread
+notices when a heartbeat is overdue and captures the stack of the loop thread
+while it is still blocked, which points right at the offending code.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Optional
+
+from .metrics import EVENT_LOOP_LAG
+from .models import LoopLagStats
+from .settings import discord_settings
+
+_log = logging.getLogger(__name__)
+
+
+class LoopWatchdog:
+    def __init__(
+        self,
+        interval: float = 0.25,
+        slow_threshold: float = 0.1,
+        critical_threshold: float = 1.0,
+        dump_folder: str = None,
+        dump_interval: float = 300,
+        history: int = 1200,
+    ):
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self.critical_threshold = critical_threshold
+        self.dump_folder = dump_folder
+        self.dump_interval = dump_interval
+        self.samples: deque[float] = deque(maxlen=history)
+        self.slow_callbacks = 0
+        self.last_slow_stack: Optional[str] = None
+        self._beat = 0
+        self._beat_at = time.monotonic()
+        self._stall_stack: Optional[str] = None
+        self._last_dump = 0.0
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        self._loop_thread = threading.get_ident()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        if not self._thread or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._monitor, name="discordbot-watchdog", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            self._beat += 1
+            self._beat_at = start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - start - self.interval, 0)
+            self.samples.append(lag)
+            EVENT_LOOP_LAG.set(value=lag)
+
+            if lag >= self.slow_threshold:
+                self.slow_callbacks += 1
+                stack, self._stall_stack = self._stall_stack, None
+                if stack:
+                    self.last_slow_stack = stack
+                _log.warning(
+                    "Event loop was blocked for %.3fs%s",
+                    lag,
+                    ", blocking code:\n" + stack if stack else "",
+                )
+                if lag >= self.critical_threshold:
+                    self._dump(lag, stack)
+
+    def _monitor(self):
+        captured = None
+        while not self._stopped.wait(self.slow_threshold / 2):
+            beat, beat_at = self._beat, self._beat_at
+            overdue = time.monotonic() - beat_at - self.interval
+            if overdue >= self.slow_threshold and captured != beat:
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame:
+                    self._stall_stack = "".join(traceback.format_stack(frame))
+                    captured = beat
+
+    def _dump(self, lag: float, stack: Optional[str]):
+        now = time.monotonic()
+        if not self.dump_folder or now - self._last_dump < self.dump_interval:
+            return
+        self._last_dump = now
+
+        lines = [
+            f"Event loop blocked for {lag:.3f}s at {time.strftime('%Y-%m-%d %X')}",
+            f"Lag: {self.stats().json()}",
+            "",
+            "Blocking stack:",
+            stack or "not captured",
+            "",
+            "Pending tasks:",
+        ]
+        for task in asyncio.all_tasks():
+            lines.append(f"  {task.get_name()}: {task.get_coro()!r}")
+        lines += ["", "Threads:"]
+        for thread_id, frame in sys._current_frames().items():
+            lines.append(f"Thread {thread_id}:")
+            lines.append("".join(traceback.format_stack(frame)))
+
+        path = os.path.join(
+            self.dump_folder, f"discordbot-lag-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+        )
+        try:
+            with open(path, "w") as f:
+                f.write("\n".join(lines))
+            _log.warning("Wrote event loop diagnostics to %s", path)
+        except OSError:
+            _log.warning("Could not write event loop diagnostics to %s", path)
+
+    def stats(self) -> LoopLagStats:
+        samples = sorted(self.samples)
+
+        def percentile(p: float) -> float:
+            if not samples:
+                return 0
+            return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+        return LoopLagStats(
+            p50=percentile(0.5),
+            p95=percentile(0.95),
+            p99=percentile(0.99),
+            max=samples[-1] if samples else 0,
+            slow_callbacks=self.slow_callbacks,
+            last_slow_stack=self.last_slow_stack,
+        )
+
+
+watchdog = LoopWatchdog(
+    slow_threshold=discord_settings.watchdog_slow_threshold,
+    critical_threshold=discord_settings.watchdog_critical_threshold,
+    dump_interval=discord_settings.watchdog_dump_interval,
+)
+
+
+def start_watchdog(dump_folder: str):
+    """There is one loop per process, so bots share one watchdog"""
+    if not watchdog.running:
+        watchdog.dump_folder = dump_folder
+        watchdog.start()
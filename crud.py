@@ -1,31 +1,90 @@
-from typing import Optional
+import base64
+import binascii
+import json
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Iterable, Optional
+
+from lnbits.core import db as core_db
+from lnbits.core.crud import get_payments
 
 from . import db
-from .models import BotSettings, CreateBotSettings, UpdateBotSettings
+from .models import (
+    BotQuotas,
+    BotSettings,
+    CreateBotSettings,
+    CounterpartyQuery,
+    CreateUserMapping,
+    DiscordUser,
+    DiscordUsersPage,
+    JournalTip,
+    LeaderboardEntry,
+    StatsKind,
+    StatsPeriod,
+    StatTotal,
+    TipEvent,
+    TipStats,
+    UpdateBotSettings,
+    UserMapping,
+    UserMappingQuery,
+    Wallets,
+)
+
+
+# Settings are only ever changed through this module by this process, so they are
+# cached until then. admin id -> settings, None if the admin has no bot
+_settings_cache: dict[str, Optional[BotSettings]] = {}
+# Bumped on every change, a read which overlapped one must not cache what it read
+_settings_generation: defaultdict[str, int] = defaultdict(int)
+
+
+def _cache_settings(admin_id: str, bot_settings: Optional[BotSettings]):
+    # Callers get their own copies, their edits must not reach the cache
+    _settings_cache[admin_id] = bot_settings.copy(deep=True) if bot_settings else None
+
+
+def _invalidate_settings(admin_id: str):
+    _settings_generation[admin_id] += 1
+    _settings_cache.pop(admin_id, None)
 
 
 async def get_discordbot_settings(admin_id: str) -> Optional[BotSettings]:
+    if admin_id in _settings_cache:
+        cached = _settings_cache[admin_id]
+        return cached.copy(deep=True) if cached else None
+    generation = _settings_generation[admin_id]
     row = await db.fetchone(
         "SELECT * FROM discordbot.bots WHERE admin = ?", (admin_id,)
     )
-    return BotSettings(**row) if row else None
+    bot_settings = BotSettings(**row) if row else None
+    if _settings_generation[admin_id] == generation:
+        _cache_settings(admin_id, bot_settings)
+    return bot_settings
 
 
 async def get_all_discordbot_settings() -> list[BotSettings]:
+    generations = dict(_settings_generation)
     rows = await db.fetchall("SELECT * FROM discordbot.bots")
-    return [BotSettings(**row) for row in rows]
+    all_settings = [BotSettings(**row) for row in rows]
+    for bot_settings in all_settings:
+        admin_id = bot_settings.admin
+        if _settings_generation.get(admin_id, 0) == generations.get(admin_id, 0):
+            _cache_settings(admin_id, bot_settings)
+    return all_settings
 
 
 async def create_discordbot_settings(data: CreateBotSettings, admin_id: str):
     await db.execute(
-        f"""
+        """
         INSERT INTO discordbot.bots (admin, token, standalone) 
         VALUES (?, ?, ?)
         ON CONFLICT (admin) DO 
-            UPDATE SET token = '{data.token}' 
+            UPDATE SET token = excluded.token
         """,
         (admin_id, data.token, data.standalone),
     )
+    _invalidate_settings(admin_id)
     return await get_discordbot_settings(admin_id)
 
 
@@ -34,7 +93,7 @@ async def update_discordbot_settings(data: UpdateBotSettings, admin_id: str):
     values = []
     for key, val in data.dict(exclude_unset=True).items():
         updates.append(f"{key} = ?")
-        values.append(val)
+        values.append(json.dumps(val) if isinstance(val, dict) else val)
     values.append(admin_id)
     await db.execute(
         f"""
@@ -44,6 +103,18 @@ async def update_discordbot_settings(data: UpdateBotSettings, admin_id: str):
         """,
         values,
     )
+    _invalidate_settings(admin_id)
+    return await get_discordbot_settings(admin_id)
+
+
+async def update_discordbot_quotas(
+    admin_id: str, quotas: Optional[BotQuotas]
+) -> Optional[BotSettings]:
+    await db.execute(
+        "UPDATE discordbot.bots SET quotas = ? WHERE admin = ?",
+        (json.dumps(quotas.dict()) if quotas else None, admin_id),
+    )
+    _invalidate_settings(admin_id)
     return await get_discordbot_settings(admin_id)
 
 
@@ -51,4 +122,529 @@ async def delete_discordbot_settings(admin_id: str):
     result = await db.execute(
         "DELETE FROM discordbot.bots WHERE admin = ?", (admin_id,)
     )
+    _invalidate_settings(admin_id)
     assert result.rowcount == 1, "Could not create settings"
+
+
+def _encode_cursor(sort_value, user_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([sort_value, user_id]).encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple:
+    try:
+        sort_value, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    return sort_value, user_id
+
+
+def _avatar_url(extra) -> Optional[str]:
+    if isinstance(extra, str):
+        extra = json.loads(extra)
+    return (extra or {}).get("discord_avatar_url")
+
+
+def _to_discord_user(row) -> DiscordUser:
+    return DiscordUser(
+        id=row["id"],
+        name=row["name"],
+        admin=row["admin"],
+        discord_id=row["discord_id"],
+        avatar_url=_avatar_url(row["extra"]),
+    )
+
+
+async def get_discord_users_page(
+    admin_id: str,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    sort_by: str = "name",
+    descending: bool = False,
+    search: Optional[str] = None,
+    discord_id: Optional[str] = None,
+    with_total: bool = True,
+) -> DiscordUsersPage:
+    """
+    Keyset pagination over the usermanager users which are linked to discord.
+    The cursor holds the sort value and id of the last row of the previous page,
+    so deep pages cost the same as the first one.
+    """
+    columns = {"id": "u.id", "name": "u.name", "discord_id": "m.discord_id"}
+    sort_column = columns[sort_by]
+    tables = """
+        discordbot.user_mappings m
+        JOIN usermanager.users u ON u.id = m.user_id
+    """
+
+    where = ["m.admin = ?"]
+    values: list = [admin_id]
+    if search:
+        where.append("u.name LIKE ?")
+        values.append(f"%{search}%")
+    if discord_id:
+        where.append("m.discord_id = ?")
+        values.append(discord_id)
+
+    total = None
+    if with_total:
+        row = await db.fetchone(
+            f"SELECT COUNT(*) AS count FROM {tables} WHERE {' AND '.join(where)}",
+            tuple(values),
+        )
+        total = row["count"] if row else 0
+
+    if cursor:
+        sort_value, last_id = _decode_cursor(cursor)
+        op = "<" if descending else ">"
+        if sort_by == "id":
+            where.append(f"u.id {op} ?")
+            values.append(last_id)
+        else:
+            where.append(
+                f"({sort_column} {op} ? OR ({sort_column} = ? AND u.id {op} ?))"
+            )
+            values.extend((sort_value, sort_value, last_id))
+
+    order = "DESC" if descending else "ASC"
+    rows = await db.fetchall(
+        f"""
+        SELECT u.id, u.name, u.admin, u.extra, m.discord_id,
+            {sort_column} AS sort_value
+        FROM {tables}
+        WHERE {' AND '.join(where)}
+        ORDER BY {sort_column} {order}, u.id {order}
+        LIMIT ?
+        """,
+        (*values, limit + 1),
+    )
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1]["sort_value"], rows[-1]["id"])
+    return DiscordUsersPage(
+        data=[_to_discord_user(row) for row in rows],
+        total=total,
+        next_cursor=next_cursor,
+    )
+
+
+async def stream_discord_users(
+    admin_id: str, batch_size: int = 500
+) -> AsyncIterator[DiscordUser]:
+    """Yields every linked user, holding only one batch in memory at a time"""
+    cursor = None
+    while True:
+        page = await get_discord_users_page(
+            admin_id, limit=batch_size, cursor=cursor, sort_by="id", with_total=False
+        )
+        for user in page.data:
+            yield user
+        if not page.next_cursor:
+            return
+        cursor = page.next_cursor
+
+
+_MAPPING_SELECT = """
+    SELECT m.discord_id, m.user_id, u.extra,
+        w.id, w.admin, w.name, w."user", w.adminkey, w.inkey
+    FROM discordbot.user_mappings m
+    JOIN usermanager.users u ON u.id = m.user_id
+    JOIN usermanager.wallets w ON w.id = m.wallet_id
+"""
+
+
+def _to_user_mapping(row) -> UserMapping:
+    return UserMapping(
+        discord_id=row["discord_id"],
+        user_id=row["user_id"],
+        avatar_url=_avatar_url(row["extra"]),
+        wallet=Wallets(
+            id=row["id"],
+            admin=row["admin"],
+            name=row["name"],
+            user=row["user"],
+            adminkey=row["adminkey"],
+            inkey=row["inkey"],
+        ),
+    )
+
+
+async def get_user_mapping(admin_id: str, discord_id: str) -> Optional[UserMapping]:
+    row = await db.fetchone(
+        _MAPPING_SELECT + "WHERE m.admin = ? AND m.discord_id = ?",
+        (admin_id, discord_id),
+    )
+    return _to_user_mapping(row) if row else None
+
+
+async def get_user_mappings(
+    admin_id: str, query: UserMappingQuery
+) -> list[UserMapping]:
+    """Mappings of the given discord ids, or all of them ordered by discord id"""
+    clauses = ["m.admin = ?"]
+    values: list = [admin_id]
+    if query.discord_ids is not None:
+        if not query.discord_ids:
+            return []
+        clauses.append(f"m.discord_id IN ({', '.join('?' * len(query.discord_ids))})")
+        values.extend(query.discord_ids)
+    if query.after:
+        clauses.append("m.discord_id > ?")
+        values.append(query.after)
+    rows = await db.fetchall(
+        _MAPPING_SELECT
+        + f"WHERE {' AND '.join(clauses)} ORDER BY m.discord_id LIMIT ?",
+        (*values, query.limit),
+    )
+    return [_to_user_mapping(row) for row in rows]
+
+
+async def get_payment_counterparties(
+    admin_id: str, query: CounterpartyQuery
+) -> dict[str, str]:
+    """
+    Payment hash -> discord id of the user on the other end, for payments of one
+    of the admin's linked wallets with another one of them
+    """
+    if not query.payment_hashes:
+        return {}
+    owner = await db.fetchone(
+        """
+        SELECT discord_id FROM discordbot.user_mappings
+        WHERE admin = ? AND wallet_id = ?
+        """,
+        (admin_id, query.wallet_id),
+    )
+    if not owner:
+        return {}
+    rows = await core_db.fetchall(
+        f"""
+        SELECT hash, wallet FROM apipayments
+        WHERE hash IN ({', '.join('?' * len(query.payment_hashes))}) AND wallet != ?
+        """,
+        (*query.payment_hashes, query.wallet_id),
+    )
+    if not rows:
+        return {}
+    wallets = {row["wallet"] for row in rows}
+    mappings = await db.fetchall(
+        f"""
+        SELECT discord_id, wallet_id FROM discordbot.user_mappings
+        WHERE admin = ? AND wallet_id IN ({', '.join('?' * len(wallets))})
+        """,
+        (admin_id, *wallets),
+    )
+    discord_ids = {row["wallet_id"]: row["discord_id"] for row in mappings}
+    return {
+        row["hash"]: discord_ids[row["wallet"]]
+        for row in rows
+        if row["wallet"] in discord_ids
+    }
+
+
+async def create_user_mapping(admin_id: str, data: CreateUserMapping) -> bool:
+    """Links a discord id to a user of the admin, returns False if it isn't theirs"""
+    row = await db.fetchone(
+        """
+        SELECT w.id FROM usermanager.wallets w
+        JOIN usermanager.users u ON u.id = w."user"
+        WHERE w.id = ? AND u.id = ? AND u.admin = ?
+        """,
+        (data.wallet_id, data.user_id, admin_id),
+    )
+    if not row:
+        return False
+    await db.execute(
+        """
+        INSERT INTO discordbot.user_mappings (admin, discord_id, user_id, wallet_id)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (admin, discord_id) DO UPDATE
+            SET user_id = excluded.user_id, wallet_id = excluded.wallet_id
+        """,
+        (admin_id, data.discord_id, data.user_id, data.wallet_id),
+    )
+    return True
+
+
+def stat_buckets(timestamp: float) -> dict[StatsPeriod, str]:
+    """The bucket of every period a point in time falls into"""
+    day = datetime.fromtimestamp(timestamp, timezone.utc).date()
+    return {
+        StatsPeriod.day: day.isoformat(),
+        StatsPeriod.week: (day - timedelta(days=day.weekday())).isoformat(),
+        StatsPeriod.month: day.strftime("%Y-%m"),
+        StatsPeriod.all: "",
+    }
+
+
+async def _add_tip_stats(admin_id: str, events: Iterable[TipEvent]):
+    # Events are summed up first, a rain is one row for the sender per bucket
+    increments: dict[tuple, list[int]] = defaultdict(lambda: [0, 0])
+    for event in events:
+        rows = [
+            (StatsKind.sent, event.sender_id),
+            (StatsKind.received, event.receiver_id),
+            (event.source, event.sender_id),
+            (event.source, ""),
+        ]
+        for guild_id in {"", event.guild_id or ""}:
+            for period, bucket in stat_buckets(event.time).items():
+                for kind, discord_id in rows:
+                    increment = increments[
+                        (guild_id, period.value, bucket, kind.value, discord_id)
+                    ]
+                    increment[0] += event.amount
+                    increment[1] += 1
+
+    async with db.connect() as conn:
+        for key, (total, count) in increments.items():
+            await conn.execute(
+                """
+                INSERT INTO discordbot.tip_stats
+                    (admin, guild_id, period, bucket, kind, discord_id, total, count)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (admin, guild_id, period, bucket, kind, discord_id)
+                DO UPDATE SET
+                    total = tip_stats.total + excluded.total,
+                    count = tip_stats.count + excluded.count
+                """,
+                (admin_id, *key, total, count),
+            )
+
+
+async def record_tip_events(admin_id: str, events: list[TipEvent]):
+    if not events:
+        return
+    await db.execute(
+        """
+        INSERT INTO discordbot.tip_stats_state (admin, live_since) VALUES (?, ?)
+        ON CONFLICT (admin) DO NOTHING
+        """,
+        (admin_id, min(event.time for event in events)),
+    )
+    await _add_tip_stats(admin_id, events)
+
+
+async def get_leaderboard(
+    admin_id: str,
+    guild_id: str,
+    kind: StatsKind,
+    period: StatsPeriod,
+    limit: int = 10,
+) -> list[LeaderboardEntry]:
+    rows = await db.fetchall(
+        """
+        SELECT discord_id, total, count FROM discordbot.tip_stats
+        WHERE admin = ? AND guild_id = ? AND period = ? AND bucket = ? AND kind = ?
+            AND discord_id != ''
+        ORDER BY total DESC
+        LIMIT ?
+        """,
+        (
+            admin_id,
+            guild_id,
+            period.value,
+            stat_buckets(time.time())[period],
+            kind.value,
+            limit,
+        ),
+    )
+    return [LeaderboardEntry(**row) for row in rows]
+
+
+async def get_tip_stats(
+    admin_id: str, guild_id: str, period: StatsPeriod, discord_id: Optional[str]
+) -> TipStats:
+    bucket = stat_buckets(time.time())[period]
+    rows = await db.fetchall(
+        """
+        SELECT kind, discord_id, total, count FROM discordbot.tip_stats
+        WHERE admin = ? AND guild_id = ? AND period = ? AND bucket = ?
+            AND discord_id IN ('', ?)
+        """,
+        (admin_id, guild_id, period.value, bucket, discord_id or ""),
+    )
+    tip_stats = TipStats(period=period, bucket=bucket, guild={}, member={})
+    for row in rows:
+        totals = tip_stats.member if row["discord_id"] else tip_stats.guild
+        totals[StatsKind(row["kind"])] = StatTotal(
+            total=row["total"], count=row["count"]
+        )
+    return tip_stats
+
+
+async def claim_tip_stats_backfill(admin_id: str) -> Optional[int]:
+    """
+    Claims the one-off backfill of the statistics, returns until when payments
+    have to be backfilled, or None if it already happened
+    """
+    now = int(time.time())
+    await db.execute(
+        """
+        INSERT INTO discordbot.tip_stats_state (admin, live_since) VALUES (?, ?)
+        ON CONFLICT (admin) DO NOTHING
+        """,
+        (admin_id, now),
+    )
+    result = await db.execute(
+        """
+        UPDATE discordbot.tip_stats_state SET backfilled_at = ?
+        WHERE admin = ? AND backfilled_at IS NULL
+        """,
+        (now, admin_id),
+    )
+    if result.rowcount != 1:
+        return None
+    row = await db.fetchone(
+        "SELECT live_since FROM discordbot.tip_stats_state WHERE admin = ?",
+        (admin_id,),
+    )
+    return row["live_since"]
+
+
+async def release_tip_stats_backfill(admin_id: str):
+    await db.execute(
+        "UPDATE discordbot.tip_stats_state SET backfilled_at = NULL WHERE admin = ?",
+        (admin_id,),
+    )
+
+
+async def backfill_tip_stats(
+    admin_id: str, until: int, guild_id: Optional[str] = None
+) -> int:
+    """
+    Adds the internal payments between linked users before ``until`` to the
+    statistics, as tips in ``guild_id``, the history doesn't know the guild.
+    Returns how many payments were added.
+    """
+    # payment hash -> discord id, for both ends of the internal payments
+    senders: dict[str, str] = {}
+    receivers: dict[str, tuple[str, int, int]] = {}
+    query = UserMappingQuery()
+    while True:
+        mappings = await get_user_mappings(admin_id, query)
+        for mapping in mappings:
+            payments = await get_payments(wallet_id=mapping.wallet.id, complete=True)
+            for payment in payments:
+                if payment.time >= until:
+                    continue
+                if payment.is_out and payment.checking_id.startswith("internal_"):
+                    senders[payment.payment_hash] = mapping.discord_id
+                elif payment.is_in:
+                    receivers[payment.payment_hash] = (
+                        mapping.discord_id,
+                        payment.sat,
+                        payment.time,
+                    )
+        if len(mappings) < query.limit:
+            break
+        query = UserMappingQuery(after=mappings[-1].discord_id)
+
+    events = [
+        TipEvent(
+            guild_id=guild_id,
+            source=StatsKind.tip,
+            sender_id=senders[payment_hash],
+            receiver_id=receiver_id,
+            amount=amount,
+            time=paid_at,
+        )
+        for payment_hash, (receiver_id, amount, paid_at) in receivers.items()
+        if payment_hash in senders and amount > 0
+    ]
+    await _add_tip_stats(admin_id, events)
+    return len(events)
+
+
+async def _insert_journal_entry(
+    conn, admin_id: str, tip: JournalTip, payment_hash: Optional[str] = None
+) -> int:
+    row = await conn.fetchone(
+        """
+        INSERT INTO discordbot.tip_journal
+            (admin, sender_id, receiver_id, amount, memo, payment_hash, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        RETURNING id
+        """,
+        (
+            admin_id,
+            tip.sender_id,
+            tip.receiver_id,
+            tip.amount,
+            tip.memo,
+            payment_hash,
+            int(time.time()),
+        ),
+    )
+    return row["id"]
+
+
+async def add_journal_entry(
+    admin_id: str, tip: JournalTip, payment_hash: Optional[str] = None
+) -> int:
+    async with db.connect() as conn:
+        return await _insert_journal_entry(conn, admin_id, tip, payment_hash)
+
+
+async def delete_journal_entry(entry_id: int):
+    await db.execute("DELETE FROM discordbot.tip_journal WHERE id = ?", (entry_id,))
+
+
+_JOURNAL_FLOWS = """
+    SELECT receiver_id AS discord_id, amount FROM discordbot.tip_journal
+    WHERE admin = ? AND settled_at IS NULL
+    UNION ALL
+    SELECT sender_id AS discord_id, -amount AS amount FROM discordbot.tip_journal
+    WHERE admin = ? AND settled_at IS NULL
+"""
+
+
+async def get_journal_positions(admin_id: str) -> dict[str, int]:
+    """Net sats every user is owed (positive) or owes (negative), zeros left out"""
+    rows = await db.fetchall(
+        f"""
+        SELECT discord_id, SUM(amount) AS net FROM ({_JOURNAL_FLOWS}) flows
+        GROUP BY discord_id
+        """,
+        (admin_id, admin_id),
+    )
+    return {row["discord_id"]: row["net"] for row in rows if row["net"]}
+
+
+async def get_journal_position(admin_id: str, discord_id: str) -> int:
+    row = await db.fetchone(
+        f"""
+        SELECT SUM(amount) AS net FROM ({_JOURNAL_FLOWS}) flows
+        WHERE discord_id = ?
+        """,
+        (admin_id, admin_id, discord_id),
+    )
+    return (row["net"] if row else None) or 0
+
+
+async def count_unsettled_journal_entries(admin_id: str) -> int:
+    row = await db.fetchone(
+        """
+        SELECT COUNT(*) AS count FROM discordbot.tip_journal
+        WHERE admin = ? AND settled_at IS NULL
+        """,
+        (admin_id,),
+    )
+    return row["count"] if row else 0
+
+
+async def settle_journal_entries(admin_id: str, carried: list[JournalTip]):
+    """
+    Marks every unsettled entry settled, and journals ``carried`` instead. They
+    have to add up to the same positions, which aren't settled yet.
+    """
+    async with db.connect() as conn:
+        await conn.execute(
+            """
+            UPDATE discordbot.tip_journal SET settled_at = ?
+            WHERE admin = ? AND settled_at IS NULL
+            """,
+            (int(time.time()), admin_id),
+        )
+        for tip in carried:
+            await _insert_journal_entry(conn, admin_id, tip)
@@ -107,3 +107,123 @@ async def m003_add_start_to_settings(db: Database):
         ALTER TABLE discordbot.settings RENAME TO bots;
         """
     )
+
+
+async def m004_add_limits_to_bots(db: Database):
+    await db.execute(
+        """
+        ALTER TABLE discordbot.bots
+        ADD COLUMN limits TEXT NULL
+        """
+    )
+
+
+async def m005_add_user_mappings(db: Database):
+    """
+    Indexed discord id -> usermanager user / wallet lookups, instead of scanning
+    the json `extra` column of usermanager users.
+    """
+    await db.execute(
+        """
+        CREATE TABLE discordbot.user_mappings (
+            admin TEXT NOT NULL,
+            discord_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            wallet_id TEXT NOT NULL,
+            PRIMARY KEY (admin, discord_id)
+        )
+        """
+    )
+    if db.type == SQLITE:
+        discord_id = "json_extract(u.extra, '$.discord_id')"
+    else:
+        discord_id = "(u.extra::json)->>'discord_id'"
+    await db.execute(
+        f"""
+        INSERT INTO discordbot.user_mappings (admin, discord_id, user_id, wallet_id)
+        SELECT u.admin, {discord_id}, u.id, MIN(w.id)
+        FROM usermanager.users u
+        JOIN usermanager.wallets w ON w."user" = u.id
+        WHERE {discord_id} IS NOT NULL
+        GROUP BY u.admin, {discord_id}, u.id
+        ON CONFLICT (admin, discord_id) DO NOTHING
+        """
+    )
+
+
+async def m006_add_quotas_to_bots(db: Database):
+    await db.execute(
+        """
+        ALTER TABLE discordbot.bots
+        ADD COLUMN quotas TEXT NULL
+        """
+    )
+
+
+async def m007_add_tip_stats(db: Database):
+    """
+    Tipping statistics, maintained as payments settle. One row per guild, period
+    bucket, kind and discord id, guild "" sums all guilds and discord id "" the
+    whole guild. Leaderboards read the top rows of one bucket from the index.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE discordbot.tip_stats (
+            admin TEXT NOT NULL,
+            guild_id TEXT NOT NULL,
+            period TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            discord_id TEXT NOT NULL,
+            total {db.big_int} NOT NULL DEFAULT 0,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (admin, guild_id, period, bucket, kind, discord_id)
+        )
+        """
+    )
+    if db.type == SQLITE:
+        index = "discordbot.tip_stats_leaderboard ON tip_stats"
+    else:
+        index = "tip_stats_leaderboard ON discordbot.tip_stats"
+    await db.execute(
+        f"""
+        CREATE INDEX {index} (admin, guild_id, period, bucket, kind, total)
+        """
+    )
+    # When the bot started reporting payments, the backfill covers what came before
+    await db.execute(
+        """
+        CREATE TABLE discordbot.tip_stats_state (
+            admin TEXT PRIMARY KEY,
+            live_since INTEGER NOT NULL,
+            backfilled_at INTEGER NULL
+        )
+        """
+    )
+
+
+async def m008_add_tip_journal(db: Database):
+    """
+    Journal of netted micro-tips. Unsettled entries are what users owe each
+    other, settlement payments are journaled the other way round.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE discordbot.tip_journal (
+            id {db.serial_primary_key},
+            admin TEXT NOT NULL,
+            sender_id TEXT NOT NULL,
+            receiver_id TEXT NOT NULL,
+            amount {db.big_int} NOT NULL,
+            memo TEXT NULL,
+            payment_hash TEXT NULL,
+            created_at INTEGER NOT NULL,
+            settled_at INTEGER NULL
+        )
+        """
+    )
+    if db.type == SQLITE:
+        index = "discordbot.tip_journal_unsettled ON tip_journal"
+    else:
+        index = "tip_journal_unsettled ON discordbot.tip_journal"
+    await db.execute(f"CREATE INDEX {index} (admin, settled_at)")
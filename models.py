@@ -1,16 +1,32 @@
 from __future__ import annotations
 
+import json
 from sqlite3 import Row
 from typing import Optional
 
-from usermanager import User, UserFilters
+from usermanager import User
 
 try:
     import discord
 except ImportError:
     discord = None
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, validator
+
+from .bot.models import (
+    AdmissionLimits,
+    BotQuotas,
+    LeaderboardEntry,
+    LoopLagStats,
+    PoolStats,
+    QuotaUsage,
+    StatsKind,
+    StatsPeriod,
+    StatTotal,
+    TipEvent,
+    TipEvents,
+    TipStats,
+)
 
 
 class DiscordUser(BaseModel):
@@ -21,9 +37,11 @@ class DiscordUser(BaseModel):
     avatar_url: Optional[str]
 
 
-class DiscordFilters(UserFilters):
-    __search_fields__ = ["name"]
-    discord_id: str
+class DiscordUsersPage(BaseModel):
+    data: list[DiscordUser]
+    # Only counted when asked for
+    total: Optional[int]
+    next_cursor: Optional[str]
 
 
 class Wallets(BaseModel):
@@ -39,12 +57,64 @@ class Wallets(BaseModel):
         return cls(**dict(row))
 
 
+class CreateUserMapping(BaseModel):
+    discord_id: str
+    user_id: str
+    wallet_id: str
+
+
+class UserMappingQuery(BaseModel):
+    discord_ids: Optional[list[str]] = Field(None, max_items=500)
+    # Keyset pagination over all mappings when no ids are given
+    after: Optional[str] = None
+    limit: int = Field(500, ge=1, le=500)
+
+
+class CounterpartyQuery(BaseModel):
+    wallet_id: str
+    payment_hashes: list[str] = Field(..., max_items=100)
+
+
+class UserMapping(BaseModel):
+    discord_id: str
+    user_id: str
+    avatar_url: Optional[str]
+    wallet: Wallets
+
+
+class JournalTip(BaseModel):
+    sender_id: str
+    receiver_id: str
+    amount: int = Field(..., gt=0)
+    memo: Optional[str]
+
+
+class JournalBalance(BaseModel):
+    # Wallet balance plus the pending netted tips, in sats
+    balance: int
+    pending: int
+
+
+class JournalSettlement(BaseModel):
+    transfers: int
+    failed: int
+    # Journal entries still waiting for a settlement
+    unsettled: int
+
+
 class BotSettings(BaseModel):
     admin: str
     token: str
     name: Optional[str]
     avatar_url: Optional[str]
     standalone: bool
+    limits: Optional[AdmissionLimits]
+    # Only the super user can change these
+    quotas: Optional[BotQuotas]
+
+    @validator("limits", "quotas", pre=True)
+    def parse_json(cls, v):
+        return json.loads(v) if isinstance(v, str) else v
 
 
 class CreateBotSettings(BaseModel):
@@ -56,15 +126,45 @@ class UpdateBotSettings(BaseModel):
     name: Optional[str]
     avatar_url: Optional[str]
     standalone: Optional[bool]
+    limits: Optional[AdmissionLimits]
 
 
 class BotInfo(BotSettings):
     online: Optional[bool]
+    http_pool: Optional[PoolStats]
+    lnbits_circuit: Optional[str]
+    event_loop: Optional[LoopLagStats]
+    quota_usage: Optional[QuotaUsage]
 
     @classmethod
-    def from_client(cls, settings: BotSettings, client: discord.Client = None):
+    def from_client(
+        cls, settings: BotSettings, client: discord.Client = None, stack: bool = False
+    ):
+        """
+        ``stack`` includes the last slow stack of the event loop. It is a dump of
+        the whole instance, only for the super user.
+        """
         if client:
+            from .bot.watchdog import watchdog
+
             online = client.is_ready()
+            http_pool = client.api.get_pool_stats()
+            lnbits_circuit = client.api.breaker.state
+            event_loop = watchdog.stats()
+            if not stack:
+                event_loop.last_slow_stack = None
+            quota_usage = client.quota_usage()
         else:
             online = None
-        return cls(online=online, **settings.dict())
+            http_pool = None
+            lnbits_circuit = None
+            event_loop = None
+            quota_usage = None
+        return cls(
+            online=online,
+            http_pool=http_pool,
+            lnbits_circuit=lnbits_circuit,
+            event_loop=event_loop,
+            quota_usage=quota_usage,
+            **settings.dict(),
+        )
@@ -0,0 +1,175 @@
+"""
+Netting of micro-tips. Bots journal small tips here instead of paying each one,
+and settlements turn the net positions of the users into as few internal
+payments as possible.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Optional
+
+from lnbits.core.crud import get_wallet
+from lnbits.core.services import (
+    InvoiceFailure,
+    PaymentFailure,
+    create_invoice,
+    pay_invoice,
+)
+
+from .crud import (
+    add_journal_entry,
+    count_unsettled_journal_entries,
+    delete_journal_entry,
+    get_journal_position,
+    get_journal_positions,
+    get_user_mapping,
+    settle_journal_entries,
+)
+from .models import JournalBalance, JournalSettlement, JournalTip
+
+_log = logging.getLogger(__name__)
+
+# Journaling checks balances against the positions, settling changes them
+_locks: dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+
+class JournalError(Exception):
+    pass
+
+
+async def _wallet_balance(wallet_id: str) -> int:
+    wallet = await get_wallet(wallet_id)
+    return wallet.balance_msat // 1000 if wallet else 0
+
+
+async def journal_tip(admin_id: str, tip: JournalTip):
+    async with _locks[admin_id]:
+        sender = await get_user_mapping(admin_id, tip.sender_id)
+        if not sender or not await get_user_mapping(admin_id, tip.receiver_id):
+            raise JournalError("Sender or receiver has no wallet")
+        balance = await _wallet_balance(sender.wallet.id)
+        pending = await get_journal_position(admin_id, tip.sender_id)
+        if balance + pending < tip.amount:
+            raise JournalError("Insufficient balance.")
+        await add_journal_entry(admin_id, tip)
+
+
+async def get_journal_balance(
+    admin_id: str, discord_id: str
+) -> Optional[JournalBalance]:
+    mapping = await get_user_mapping(admin_id, discord_id)
+    if not mapping:
+        return None
+    pending = await get_journal_position(admin_id, discord_id)
+    balance = await _wallet_balance(mapping.wallet.id)
+    return JournalBalance(balance=balance + pending, pending=pending)
+
+
+def net_transfers(positions: dict[str, int]) -> list[tuple[str, str, int]]:
+    """
+    (debtor, creditor, sats) payments which clear the positions, largest first,
+    at most one less than there are users with a position
+    """
+    debtors = sorted(
+        ([user, -net] for user, net in positions.items() if net < 0),
+        key=lambda debtor: -debtor[1],
+    )
+    creditors = sorted(
+        ([user, net] for user, net in positions.items() if net > 0),
+        key=lambda creditor: -creditor[1],
+    )
+    transfers = []
+    i = j = 0
+    while i < len(debtors) and j < len(creditors):
+        amount = min(debtors[i][1], creditors[j][1])
+        transfers.append((debtors[i][0], creditors[j][0], amount))
+        debtors[i][1] -= amount
+        creditors[j][1] -= amount
+        if not debtors[i][1]:
+            i += 1
+        if not creditors[j][1]:
+            j += 1
+    return transfers
+
+
+async def _transfer(admin_id: str, debtor: str, creditor: str, amount: int):
+    debtor_mapping = await get_user_mapping(admin_id, debtor)
+    creditor_mapping = await get_user_mapping(admin_id, creditor)
+    if not debtor_mapping or not creditor_mapping:
+        raise JournalError("User without a wallet")
+    memo = "Netted discord tips"
+    payment_hash, payment_request = await create_invoice(
+        wallet_id=creditor_mapping.wallet.id,
+        amount=amount,
+        memo=memo,
+        extra={"tag": "discordbot"},
+        internal=True,
+    )
+    # Journaled first, a payment must never happen without being accounted for
+    entry_id = await add_journal_entry(
+        admin_id,
+        JournalTip(sender_id=creditor, receiver_id=debtor, amount=amount, memo=memo),
+        payment_hash=payment_hash,
+    )
+    try:
+        await pay_invoice(
+            wallet_id=debtor_mapping.wallet.id,
+            payment_request=payment_request,
+            description=memo,
+        )
+    except (InvoiceFailure, PaymentFailure):
+        # Nothing was paid. After anything else, like a cancellation, the payment
+        # might have gone through and its entry has to stay
+        await delete_journal_entry(entry_id)
+        raise
+
+
+async def settle_journal(
+    admin_id: str, discord_id: Optional[str] = None
+) -> JournalSettlement:
+    """
+    Pays out the net positions, only those of ``discord_id`` if given. Entries
+    are marked settled, what is left over is journaled again.
+    """
+    async with _locks[admin_id]:
+        positions = await get_journal_positions(admin_id)
+        if discord_id:
+            own = positions.get(discord_id, 0)
+            positions = {
+                user: net
+                for user, net in positions.items()
+                if user == discord_id or (net > 0) != (own > 0)
+            }
+        transfers = net_transfers(positions)
+        failed = 0
+        for debtor, creditor, amount in transfers:
+            try:
+                await _transfer(admin_id, debtor, creditor, amount)
+            except (JournalError, InvoiceFailure, PaymentFailure, ValueError) as e:
+                _log.warning(
+                    "Could not settle %d sats from %s to %s: %s",
+                    amount,
+                    debtor,
+                    creditor,
+                    e,
+                )
+                failed += 1
+        # Whatever couldn't be paid out is carried forward in as few entries as
+        # possible, so failing transfers don't keep the journal growing
+        carried = [
+            JournalTip(
+                sender_id=debtor,
+                receiver_id=creditor,
+                amount=amount,
+                memo="Carried forward",
+            )
+            for debtor, creditor, amount in net_transfers(
+                await get_journal_positions(admin_id)
+            )
+        ]
+        await settle_journal_entries(admin_id, carried)
+        return JournalSettlement(
+            transfers=len(transfers) - failed,
+            failed=failed,
+            unsettled=await count_unsettled_journal_entries(admin_id),
+        )
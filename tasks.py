@@ -1,4 +1,5 @@
 import asyncio
+import time
 from typing import Optional
 
 import httpx
@@ -7,35 +8,56 @@ from lnbits.core import get_user
 from lnbits.settings import settings
 
 from . import discordbot_ext
+from lnbits.extensions.discordbot.bot.api import create_http_client
 from lnbits.extensions.discordbot.bot.client import LnbitsClient, create_client
+from lnbits.extensions.discordbot.bot.recorder import recorder
+from lnbits.extensions.discordbot.bot.tracing import tracer
+from lnbits.extensions.discordbot.bot.watchdog import watchdog
 from lnbits.extensions.discordbot.crud import get_all_discordbot_settings
-from lnbits.extensions.discordbot.models import BotSettings
+from lnbits.extensions.discordbot.models import BotQuotas, BotSettings
 
 http_client: Optional[httpx.AsyncClient] = None
 
 clients: dict[str, LnbitsClient] = {}
 
+# Discord allows one IDENTIFY per 5 seconds per bot, every start of a client is one
+IDENTIFY_INTERVAL = 5.0
+_next_identify: dict[str, float] = {}
+
 
 def get_client(token: str) -> Optional[LnbitsClient]:
     return clients.get(token)
 
 
+async def wait_for_identify(token: str):
+    now = time.monotonic()
+    at = max(now, _next_identify.get(token, now))
+    _next_identify[token] = at + IDENTIFY_INTERVAL
+    if at > now:
+        await asyncio.sleep(at - now)
+
+
 async def start_bot(bot_settings: BotSettings):
     token = bot_settings.token
 
-    admin_user = await get_user(bot_settings.admin)
-    admin_key = admin_user.wallets[0].adminkey
-
     client = clients.get(token)
 
-    if not client or client.is_closed:
+    if not client or client.is_closed():
+        admin_user = await get_user(bot_settings.admin)
+        admin_key = admin_user.wallets[0].adminkey
         client = create_client(
-            admin_key, http_client, settings.lnbits_baseurl, settings.lnbits_data_folder
+            admin_key,
+            http_client,
+            settings.lnbits_baseurl,
+            settings.lnbits_data_folder,
+            limits=bot_settings.limits,
+            quotas=bot_settings.quotas,
         )
         clients[token] = client
     else:
         return client
 
+    await wait_for_identify(token)
     await client.login(token)
 
     async def runner():
@@ -56,10 +78,40 @@ async def stop_bot(bot_settings: BotSettings):
     token = bot_settings.token
     client = clients.get(token)
     if client:
-        await client.close()
+        await client.shutdown()
     return client
 
 
+async def reconfigure_bot(bot_settings: BotSettings) -> Optional[LnbitsClient]:
+    """Brings a hosted bot in line with its changed settings"""
+    if bot_settings.standalone:
+        return await stop_bot(bot_settings)
+    client = clients.get(bot_settings.token)
+    if not client or client.is_closed():
+        return await start_bot(bot_settings)
+    admin_user = await get_user(bot_settings.admin)
+    await client.reconfigure(
+        name=bot_settings.name,
+        avatar_url=bot_settings.avatar_url,
+        limits=bot_settings.limits,
+        quotas=bot_settings.quotas or BotQuotas(),
+        admin_key=admin_user.wallets[0].adminkey,
+        lnbits_url=settings.lnbits_baseurl,
+    )
+    return client
+
+
+async def replace_bot(
+    old_settings: BotSettings, bot_settings: BotSettings
+) -> Optional[LnbitsClient]:
+    """Moves a hosted bot to a new token, the only change which needs a reconnect"""
+    await stop_bot(old_settings)
+    clients.pop(old_settings.token, None)
+    if bot_settings.standalone:
+        return None
+    return await start_bot(bot_settings)
+
+
 async def launch_all():
     await asyncio.sleep(1)
     for settings in await get_all_discordbot_settings():
@@ -70,13 +122,17 @@ async def launch_all():
 @discordbot_ext.on_event("startup")
 async def on_startup():
     global http_client
-    http_client = httpx.AsyncClient()
+    http_client = create_http_client()
     asyncio.create_task(launch_all())
 
 
 @discordbot_ext.on_event("shutdown")
 async def on_shutdown():
     global http_client
-    for client in clients.values():
-        await client.close()
+    # All bots drain their payments at the same time, the shared http client
+    # has to stay open until the last one is done
+    await asyncio.gather(*(client.shutdown() for client in clients.values()))
     await http_client.aclose()
+    await tracer.close()
+    recorder.close()
+    watchdog.stop()
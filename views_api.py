@@ -1,32 +1,67 @@
+import asyncio
+import csv
+import io
+import logging
+from enum import Enum
 from http import HTTPStatus
+from typing import Optional
 
 from fastapi import APIRouter, Depends, Query
 from starlette.exceptions import HTTPException
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
 
-from lnbits.db import Filter, Filters, Operator
-from lnbits.decorators import WalletTypeInfo, parse_filters, require_admin_key
-from lnbits.extensions.usermanager.crud import get_usermanager_users
-from lnbits.helpers import generate_filter_params_openapi
+from lnbits.decorators import WalletTypeInfo, require_admin_key
 from lnbits.settings import settings
 
 from . import discordbot_ext
+from .bot.profiler import ProfileMode, ProfilerBusy, profiler
 from .crud import (
+    backfill_tip_stats,
+    claim_tip_stats_backfill,
     create_discordbot_settings,
+    create_user_mapping,
     delete_discordbot_settings,
+    get_discord_users_page,
+    get_all_discordbot_settings,
     get_discordbot_settings,
+    get_leaderboard,
+    get_payment_counterparties,
+    get_tip_stats,
+    get_user_mapping,
+    get_user_mappings,
+    record_tip_events,
+    release_tip_stats_backfill,
+    stream_discord_users,
+    update_discordbot_quotas,
     update_discordbot_settings,
 )
 from .models import (
     BotInfo,
+    BotQuotas,
     BotSettings,
+    CounterpartyQuery,
     CreateBotSettings,
-    DiscordFilters,
+    CreateUserMapping,
     DiscordUser,
+    DiscordUsersPage,
+    JournalBalance,
+    JournalSettlement,
+    JournalTip,
+    LeaderboardEntry,
+    StatsKind,
+    StatsPeriod,
+    TipEvents,
+    TipStats,
     UpdateBotSettings,
+    UserMapping,
+    UserMappingQuery,
 )
+from .netting import JournalError, get_journal_balance, journal_tip, settle_journal
 
 try:
-    from .tasks import get_client, start_bot, stop_bot
+    from .bot.metrics import registry
+    from .bot.client import ProfileUpdateFailed
+    from .tasks import get_client, reconfigure_bot, replace_bot, start_bot, stop_bot
 
     can_run_bot = True
 except ImportError as e:
@@ -46,6 +81,8 @@ except ImportError as e:
 
 discordbot_api: APIRouter = APIRouter(prefix="/api/v1", tags=["discordbot"])
 
+_log = logging.getLogger(__name__)
+
 
 async def require_bot_settings(
     wallet_info: WalletTypeInfo = Depends(require_admin_key),
@@ -68,6 +105,26 @@ async def api_extension_delete(usr: str = Query(...)):
         await delete_discordbot_settings(settings.admin)
 
 
+@discordbot_api.get(
+    "/metrics",
+    description="Prometheus metrics of the bots running on this instance. "
+    "The super user gets all bots, everyone else only their own.",
+    response_class=PlainTextResponse,
+)
+async def api_metrics(wallet_info: WalletTypeInfo = Depends(require_admin_key)):
+    if wallet_info.wallet.user == settings.super_user:
+        match = None
+    else:
+        bot_settings = await get_discordbot_settings(wallet_info.wallet.user)
+        client = get_client(bot_settings.token) if bot_settings else None
+        if not client:
+            raise HTTPException(status_code=400, detail="Bot is not running")
+        match = {"bot": client.api.bot_id}
+    return PlainTextResponse(
+        registry.render(match), media_type="text/plain; version=0.0.4"
+    )
+
+
 # Users
 
 
@@ -79,7 +136,9 @@ async def api_extension_delete(usr: str = Query(...)):
 )
 async def api_bot_status(bot_settings: BotSettings = Depends(require_bot_settings)):
     client = get_client(bot_settings.token)
-    return BotInfo.from_client(bot_settings, client)
+    return BotInfo.from_client(
+        bot_settings, client, stack=bot_settings.admin == settings.super_user
+    )
 
 
 @discordbot_api.post(
@@ -91,15 +150,18 @@ async def api_bot_status(bot_settings: BotSettings = Depends(require_bot_setting
 async def api_create_bot(
     data: CreateBotSettings, wallet_type: WalletTypeInfo = Depends(require_admin_key)
 ):
+    old_settings = await get_discordbot_settings(wallet_type.wallet.user)
     bot_settings = await create_discordbot_settings(data, wallet_type.wallet.user)
     if not bot_settings.standalone:
-        if wallet_type.wallet.id == settings.super_user:
-            client = await start_bot(bot_settings)
-        else:
+        if wallet_type.wallet.id != settings.super_user:
             raise HTTPException(
                 status_code=400,
                 detail="Only the super user can host directly on the instance",
             )
+        if old_settings and old_settings.token != bot_settings.token:
+            client = await replace_bot(old_settings, bot_settings)
+        else:
+            client = await start_bot(bot_settings)
     else:
         client = None
     return BotInfo.from_client(bot_settings, client)
@@ -122,9 +184,79 @@ async def api_delete_bot(bot_settings: BotSettings = Depends(require_bot_setting
 async def api_update_bot(
     data: UpdateBotSettings, bot_settings: BotSettings = Depends(require_bot_settings)
 ):
+    # Hosted bots run on the instance, and it downloads their avatars. Only the
+    # super user's bot and those the super user gave quotas are trusted with that
+    approved = bot_settings.admin == settings.super_user or bot_settings.quotas
+    if not approved:
+        if data.standalone is False:
+            raise HTTPException(
+                status_code=400,
+                detail="Only the super user can host directly on the instance",
+            )
+        if data.avatar_url and not bot_settings.standalone:
+            raise HTTPException(
+                status_code=403,
+                detail="Only bots approved by the super user can change their avatar",
+            )
     bot_settings = await update_discordbot_settings(data, bot_settings.admin)
-    if not bot_settings.standalone:
-        await start_bot(bot_settings)
+    error = None
+    try:
+        client = await reconfigure_bot(bot_settings)
+    except ProfileUpdateFailed as e:
+        client = get_client(bot_settings.token)
+        error = str(e)
+    if client and client.user and not client.is_closed():
+        # Store the profile discord actually has, it rehosts avatars under its own url
+        profile = UpdateBotSettings(
+            name=client.user.name, avatar_url=client.user.display_avatar.url
+        )
+        if (profile.name, profile.avatar_url) != (
+            bot_settings.name,
+            bot_settings.avatar_url,
+        ):
+            await update_discordbot_settings(profile, bot_settings.admin)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+
+
+async def require_super_user(
+    wallet_info: WalletTypeInfo = Depends(require_admin_key),
+):
+    if wallet_info.wallet.user != settings.super_user:
+        raise HTTPException(status_code=403, detail="Only for the super user")
+    return wallet_info
+
+
+@discordbot_api.get(
+    "/bots",
+    description="Status, quotas and quota usage of every bot. Super user only.",
+    status_code=HTTPStatus.OK,
+    response_model=list[BotInfo],
+    dependencies=[Depends(require_super_user)],
+)
+async def api_list_bots():
+    return [
+        BotInfo.from_client(bot_settings, get_client(bot_settings.token), stack=True)
+        for bot_settings in await get_all_discordbot_settings()
+    ]
+
+
+@discordbot_api.put(
+    "/bots/{admin_id}/quotas",
+    description="Cap the resources a bot hosted on this instance can use, "
+    "unset fields are unlimited. Applies right away. Super user only.",
+    status_code=HTTPStatus.OK,
+    response_model=BotInfo,
+    dependencies=[Depends(require_super_user)],
+)
+async def api_update_bot_quotas(admin_id: str, quotas: BotQuotas):
+    bot_settings = await update_discordbot_quotas(admin_id, quotas)
+    if not bot_settings:
+        raise HTTPException(status_code=404, detail="No bot for this user")
+    client = get_client(bot_settings.token)
+    if client:
+        client.apply_quotas(quotas)
+    return BotInfo.from_client(bot_settings, client)
 
 
 @discordbot_api.get("/bot/start", status_code=HTTPStatus.OK, response_model=BotInfo)
@@ -143,32 +275,288 @@ async def api_bot_stop(bot_settings: BotSettings = Depends(require_bot_settings)
     return BotInfo.from_client(bot_settings, client)
 
 
+@discordbot_api.get(
+    "/bot/profile",
+    description="Profile the bots hosted on this instance for a while and download "
+    "the result, either collapsed stacks or a pstats file. Super user only.",
+    status_code=HTTPStatus.OK,
+    response_class=Response,
+)
+async def api_bot_profile(
+    duration: float = Query(30, ge=1, le=300),
+    mode: ProfileMode = Query(ProfileMode.SAMPLING),
+    wallet_info: WalletTypeInfo = Depends(require_admin_key),
+):
+    if wallet_info.wallet.user != settings.super_user:
+        raise HTTPException(
+            status_code=403, detail="Only the super user can profile the instance"
+        )
+    if not can_run_bot:
+        raise HTTPException(
+            status_code=400, detail="Can not run discord bots on this instance"
+        )
+    try:
+        profile = await profiler.profile(duration, mode)
+    except ProfilerBusy:
+        raise HTTPException(status_code=409, detail="Already profiling")
+    return Response(
+        profile.data,
+        media_type=profile.media_type,
+        headers={"Content-Disposition": f'attachment; filename="{profile.filename}"'},
+    )
+
+
+class UserSort(str, Enum):
+    name = "name"
+    discord_id = "discord_id"
+    id = "id"
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
 @discordbot_api.get(
     "/users",
-    description="Get a list of users registered for your bot",
+    description="Get a page of the users registered for your bot. "
+    "Pass the returned next_cursor to get the following page.",
     status_code=HTTPStatus.OK,
-    response_model=list[DiscordUser],
-    openapi_extra=generate_filter_params_openapi(DiscordFilters),
+    response_model=DiscordUsersPage,
 )
 async def api_discordbot_users(
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    sort_by: UserSort = UserSort.name,
+    descending: bool = False,
+    search: Optional[str] = None,
+    discord_id: Optional[str] = None,
+    total: bool = True,
     bot_settings: BotSettings = Depends(require_bot_settings),
-    filters: Filters = Depends(parse_filters(DiscordFilters)),
-):
-    for filter in filters.filters:
-        if filter.field == "discord_id":
-            filter.field = "extra"
-            filter.nested = ["discord_id"]
-    filters.filters.append(
-        Filter(field="extra", nested=["discord_id"], values=["null"], op=Operator.NE)
-    )
-    users = await get_usermanager_users(bot_settings.admin, filters=filters)
-    results = []
-    for user in users:
-        user_dict = user.dict()
-        user_dict["discord_id"] = user.extra["discord_id"]
-        user_dict["avatar_url"] = user.extra.get("discord_avatar_url")
-        results.append(user_dict)
-    return results
+):
+    try:
+        return await get_discord_users_page(
+            bot_settings.admin,
+            limit=limit,
+            cursor=cursor,
+            sort_by=sort_by.value,
+            descending=descending,
+            search=search,
+            discord_id=discord_id,
+            with_total=total,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@discordbot_api.get(
+    "/users/export",
+    description="Stream all users registered for your bot as NDJSON or CSV",
+    status_code=HTTPStatus.OK,
+    response_class=StreamingResponse,
+)
+async def api_discordbot_users_export(
+    format: ExportFormat = ExportFormat.ndjson,
+    bot_settings: BotSettings = Depends(require_bot_settings),
+):
+    fields = list(DiscordUser.__fields__)
+
+    async def ndjson():
+        async for user in stream_discord_users(bot_settings.admin):
+            yield user.json() + "\n"
+
+    async def csv_rows():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=fields)
+
+        def flush() -> str:
+            value = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return value
+
+        writer.writeheader()
+        yield flush()
+        async for user in stream_discord_users(bot_settings.admin):
+            writer.writerow(user.dict())
+            yield flush()
+
+    if format == ExportFormat.csv:
+        return StreamingResponse(
+            csv_rows(),
+            media_type="text/csv",
+            headers={"Content-Disposition": 'attachment; filename="users.csv"'},
+        )
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
+@discordbot_api.get(
+    "/users/mapping/{discord_id}",
+    description="Look up the user and wallet linked to a discord id",
+    status_code=HTTPStatus.OK,
+    response_model=UserMapping,
+)
+async def api_get_user_mapping(
+    discord_id: str, wallet_info: WalletTypeInfo = Depends(require_admin_key)
+):
+    mapping = await get_user_mapping(wallet_info.wallet.user, discord_id)
+    if not mapping:
+        raise HTTPException(status_code=404, detail="No user for this discord id")
+    return mapping
+
+
+@discordbot_api.post(
+    "/users/mapping/query",
+    description="Bulk look up of the users and wallets linked to discord ids",
+    status_code=HTTPStatus.OK,
+    response_model=list[UserMapping],
+)
+async def api_query_user_mappings(
+    query: UserMappingQuery, wallet_info: WalletTypeInfo = Depends(require_admin_key)
+):
+    return await get_user_mappings(wallet_info.wallet.user, query)
+
+
+@discordbot_api.post(
+    "/payments/counterparties",
+    description="The linked users on the other end of payments of a linked wallet",
+    status_code=HTTPStatus.OK,
+    response_model=dict[str, str],
+)
+async def api_payment_counterparties(
+    query: CounterpartyQuery, wallet_info: WalletTypeInfo = Depends(require_admin_key)
+):
+    return await get_payment_counterparties(wallet_info.wallet.user, query)
+
+
+@discordbot_api.post(
+    "/users/mapping",
+    description="Link a discord id to one of your users and their wallet",
+    status_code=HTTPStatus.CREATED,
+)
+async def api_create_user_mapping(
+    data: CreateUserMapping, wallet_info: WalletTypeInfo = Depends(require_admin_key)
+):
+    if not await create_user_mapping(wallet_info.wallet.user, data):
+        raise HTTPException(status_code=400, detail="User or wallet not found")
+
+
+# Netting journal
+
+
+@discordbot_api.post(
+    "/journal",
+    description="Journal a micro-tip, it is paid out netted in the next settlement",
+    status_code=HTTPStatus.CREATED,
+)
+async def api_journal_tip(
+    tip: JournalTip, wallet_info: WalletTypeInfo = Depends(require_admin_key)
+):
+    try:
+        await journal_tip(wallet_info.wallet.user, tip)
+    except JournalError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@discordbot_api.get(
+    "/journal/balance/{discord_id}",
+    description="Wallet balance of a user including their pending netted tips",
+    status_code=HTTPStatus.OK,
+    response_model=JournalBalance,
+)
+async def api_journal_balance(
+    discord_id: str, wallet_info: WalletTypeInfo = Depends(require_admin_key)
+):
+    balance = await get_journal_balance(wallet_info.wallet.user, discord_id)
+    if not balance:
+        raise HTTPException(status_code=404, detail="No user for this discord id")
+    return balance
+
+
+@discordbot_api.post(
+    "/journal/settle",
+    description="Pay out the netted tips, only those of one user if given",
+    status_code=HTTPStatus.OK,
+    response_model=JournalSettlement,
+)
+async def api_settle_journal(
+    discord_id: Optional[str] = None,
+    wallet_info: WalletTypeInfo = Depends(require_admin_key),
+):
+    return await settle_journal(wallet_info.wallet.user, discord_id)
+
+
+# Statistics
+
+
+@discordbot_api.post(
+    "/stats/events",
+    description="Add settled payments to the statistics, used by the bot",
+    status_code=HTTPStatus.OK,
+)
+async def api_record_tip_events(
+    data: TipEvents, wallet_info: WalletTypeInfo = Depends(require_admin_key)
+):
+    await record_tip_events(wallet_info.wallet.user, data.events)
+
+
+@discordbot_api.get(
+    "/stats/leaderboard",
+    description="Top members of a guild, or of all guilds without one",
+    status_code=HTTPStatus.OK,
+    response_model=list[LeaderboardEntry],
+)
+async def api_leaderboard(
+    kind: StatsKind = StatsKind.sent,
+    period: StatsPeriod = StatsPeriod.week,
+    guild_id: str = "",
+    limit: int = Query(10, ge=1, le=100),
+    wallet_info: WalletTypeInfo = Depends(require_admin_key),
+):
+    return await get_leaderboard(wallet_info.wallet.user, guild_id, kind, period, limit)
+
+
+@discordbot_api.get(
+    "/stats",
+    description="Volume of a guild (or all guilds) by source, and of one member",
+    status_code=HTTPStatus.OK,
+    response_model=TipStats,
+)
+async def api_tip_stats(
+    period: StatsPeriod = StatsPeriod.week,
+    guild_id: str = "",
+    discord_id: Optional[str] = None,
+    wallet_info: WalletTypeInfo = Depends(require_admin_key),
+):
+    return await get_tip_stats(wallet_info.wallet.user, guild_id, period, discord_id)
+
+
+@discordbot_api.post(
+    "/stats/backfill",
+    description="Add the payments between your users from before the bot reported "
+    "them to the statistics, as tips in the given guild. Runs once, in the "
+    "background.",
+    status_code=HTTPStatus.ACCEPTED,
+)
+async def api_backfill_tip_stats(
+    guild_id: Optional[str] = None,
+    wallet_info: WalletTypeInfo = Depends(require_admin_key),
+):
+    admin_id = wallet_info.wallet.user
+    until = await claim_tip_stats_backfill(admin_id)
+    if until is None:
+        raise HTTPException(status_code=409, detail="Statistics already backfilled")
+
+    async def backfill():
+        try:
+            count = await backfill_tip_stats(admin_id, until, guild_id)
+        except Exception:
+            _log.exception("Backfilling the statistics of %s failed", admin_id)
+            await release_tip_stats_backfill(admin_id)
+        else:
+            _log.info("Backfilled %d payments into the statistics", count)
+
+    asyncio.create_task(backfill())
 
 
 discordbot_ext.include_router(discordbot_api)